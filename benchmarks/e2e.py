@@ -0,0 +1,375 @@
+"""End-to-end handler benchmark with a fake Telegram bot and a scratch MongoDB.
+
+Drives SupportBot handlers directly with synthetic Update objects, so neither a
+bot token nor network access to Telegram is needed. Every Bot API call goes to
+a recording FakeBot, which can add an artificial round trip with --api-latency.
+MongoDB is either mongomock-motor (the default, pip install mongomock-motor) or
+a real server given by --mongo-uri. The bots' databases are mapped onto
+"<prefix><name>" scratch databases, which are dropped afterwards.
+
+Phases, each reported with p50/p99 latency per step and updates/s:
+  flows  - concurrent users running the Deriv VIP, mentorship and currencies
+           flows from tetttt.py and FAQ searches against bot (2).py
+  storm  - several agents racing to take and close every ticket created above
+Ticket fan-out to support groups runs in the background as in production and
+is reported as background:forward_to_support_groups.
+
+    python -m benchmarks.e2e --users 500 --concurrency 50 --groups 3
+    python -m benchmarks.e2e --mongo-uri mongodb://localhost:27017/ --api-latency 0.05 --json results.json
+"""
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from telegram import Update
+
+ROOT = Path(__file__).resolve().parent.parent
+FAQ_QUESTIONS = ["how do I login", "I forgot my password", "what are the pricing plans", "reset password please",
+                 "how much does the pro plan cost", "can't sign in to my account", "refund policy"]
+
+
+def load_module(name: str, filename: str):
+    spec = importlib.util.spec_from_file_location(name, ROOT / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ScratchClient:
+    """Wraps a Motor client so every database the bot opens is a prefixed scratch database"""
+
+    def __init__(self, client, prefix: str):
+        self._client = client
+        self._prefix = prefix
+        self._used = set()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        self._used.add(name)
+        return self._client[self._prefix + name]
+
+    async def drop(self):
+        for name in self._used:
+            await self._client.drop_database(self._prefix + name)
+
+    def close(self):
+        self._client.close()
+
+
+class FakeFile:
+    async def download_as_bytearray(self):
+        return bytearray()
+
+
+class FakeBot:
+    """Stands in for telegram.Bot: every API method is recorded and returns a stub message"""
+
+    defaults = None
+    id = 1
+    username = "bench_bot"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(10_000)
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            self.calls[method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method == "get_file":
+                return FakeFile()
+            if method == "answer_callback_query":
+                return True
+            return SimpleNamespace(message_id=next(self._message_ids), chat_id=kwargs.get("chat_id"))
+        return call
+
+
+class LatencyStats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.first_errors = {}
+
+    async def time(self, label: str, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        except Exception as e:
+            self.errors[label] += 1
+            self.first_errors.setdefault(label, repr(e))
+        finally:
+            self.samples[label].append(time.perf_counter() - started)
+
+    def summary(self) -> dict:
+        result = {}
+        for label, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            result[label] = {"count": len(samples), "p50_ms": percentile(samples, 50) * 1000,
+                             "p99_ms": percentile(samples, 99) * 1000, "max_ms": samples[-1] * 1000, "errors": self.errors[label]}
+        return result
+
+
+def percentile(sorted_samples: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, -(-len(sorted_samples) * pct // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+class FakeApplication:
+    """Enough of telegram.ext.Application for handlers that schedule background work"""
+
+    def __init__(self, stats: LatencyStats):
+        self.stats = stats
+        self._tasks = set()
+
+    def create_task(self, coroutine, update=None, name=None):
+        task = asyncio.create_task(self.stats.time(f"background:{coroutine.__name__}", coroutine))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+
+# --- synthetic updates ---
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "last_name": str(user_id), "username": f"bench_{user_id}"}
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": "Bench Support"}
+    return {"id": chat_id, "type": "private", "first_name": "Bench"}
+
+
+def _message(user_id: int, chat_id: int, **fields) -> dict:
+    return {"message_id": next(_message_ids), "date": int(time.time()), "chat": _chat(chat_id), "from": _user(user_id), **fields}
+
+
+def text_update(user_id: int, text: str) -> dict:
+    fields = {"text": text}
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": _message(user_id, user_id, **fields)}
+
+
+def photo_update(user_id: int, caption: str) -> dict:
+    unique = next(_message_ids)
+    photo = [{"file_id": f"photo-{unique}-{size}", "file_unique_id": f"u{unique}-{size}", "width": size, "height": size}
+             for size in (90, 320, 1280)]
+    return {"update_id": next(_update_ids), "message": _message(user_id, user_id, photo=photo, caption=caption)}
+
+
+def callback_update(user_id: int, data: str, chat_id: int | None = None, text: str = "menu") -> dict:
+    chat_id = user_id if chat_id is None else chat_id
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": str(next(_update_ids)), "from": _user(user_id), "chat_instance": str(chat_id), "data": data,
+        "message": _message(1, chat_id, text=text)}}
+
+
+# --- scenarios: lists of (label, bot, handler name, update) run in order for one user ---
+def deriv_vip_flow(bot, user_id: int, cr_number: str) -> list:
+    created = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    return [("start", bot, "start_command", text_update(user_id, "/start")),
+            ("callback:select_vip_type", bot, "button_callback", callback_update(user_id, "select_vip_type")),
+            ("callback:vip_deriv_start", bot, "button_callback", callback_update(user_id, "vip_deriv_start")),
+            ("callback:deriv_procedure_yes", bot, "button_callback", callback_update(user_id, "deriv_procedure_yes")),
+            ("text:deriv_creation_date", bot, "handle_message", text_update(user_id, created)),
+            ("text:deriv_cr_number", bot, "handle_message", text_update(user_id, cr_number)),
+            ("photo:deriv_funding_screenshot", bot, "handle_photo", photo_update(user_id, "Deposited $100"))]
+
+
+def mentorship_flow(bot, user_id: int, cr_number: str) -> list:
+    return [("start", bot, "start_command", text_update(user_id, "/start")),
+            ("callback:free_mentorship_start", bot, "button_callback", callback_update(user_id, "free_mentorship_start")),
+            ("callback:mentorship_account_yes", bot, "button_callback", callback_update(user_id, "mentorship_account_yes")),
+            ("text:mentorship_cr_number", bot, "handle_message", text_update(user_id, cr_number)),
+            ("photo:mentorship_funding_screenshot", bot, "handle_photo", photo_update(user_id, "$75"))]
+
+
+def currencies_flow(bot, user_id: int, cr_number: str) -> list:
+    return [("start", bot, "start_command", text_update(user_id, "/start")),
+            ("callback:select_vip_type", bot, "button_callback", callback_update(user_id, "select_vip_type")),
+            ("callback:vip_currencies_start", bot, "button_callback", callback_update(user_id, "vip_currencies_start"))]
+
+
+def faq_session(bot, user_id: int, cr_number: str) -> list:
+    return [("text:faq_search", bot, "handle_message", text_update(user_id, random.choice(FAQ_QUESTIONS))) for _ in range(3)]
+
+
+def ticket_storm(bot, agent_id: int, group_id: int, ticket_id: str) -> list:
+    card = f"🎫 New ticket {ticket_id}"
+    return [("callback:take_ticket", bot, "button_callback", callback_update(agent_id, f"take_{ticket_id}", group_id, card)),
+            ("callback:close_ticket", bot, "button_callback", callback_update(agent_id, f"close_{ticket_id}", group_id, card))]
+
+
+async def run_phase(name: str, scripts: list, concurrency: int, fake_bot: FakeBot, application: FakeApplication, stats: LatencyStats) -> dict:
+    """Run each script's steps in order (one user), up to `concurrency` scripts at a time"""
+    queue = asyncio.Queue()
+    for script in scripts:
+        queue.put_nowait(script)
+    user_data = defaultdict(dict)
+    updates = 0
+
+    async def worker():
+        nonlocal updates
+        while True:
+            try:
+                script = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            for label, bot, handler_name, data in script:
+                update = Update.de_json(data, fake_bot)
+                context = SimpleNamespace(bot=fake_bot, application=application, user_data=user_data[update.effective_user.id],
+                                          chat_data={}, bot_data={})
+                await stats.time(label, getattr(bot, handler_name)(update, context))
+                updates += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"phase": name, "updates": updates, "elapsed_s": elapsed, "updates_per_s": updates / elapsed if elapsed else 0.0}
+
+
+def print_report(phases: list, drain_s: float, stats: LatencyStats, fake_bot: FakeBot):
+    for phase in phases:
+        print(f"{phase['phase']:<8} {phase['updates']:>7} updates in {phase['elapsed_s']:>7.2f}s  {phase['updates_per_s']:>9.1f} updates/s")
+    print(f"background fan-out finished {drain_s:.2f}s after the storm phase")
+    print()
+    print(f"{'step':<44} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+    for label, row in stats.summary().items():
+        print(f"{label:<44} {row['count']:>7} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['max_ms']:>9.2f} {row['errors']:>7}")
+    for label, error in stats.first_errors.items():
+        print(f"  first error in {label}: {error}")
+    print()
+    print("Bot API calls: " + ", ".join(f"{method}={count}" for method, count in fake_bot.calls.most_common()))
+
+
+async def shutdown(bot):
+    for name in ("notifications", "cr_registry", "group_cache", "kb_search", "counters", "state", "expiry"):
+        service = getattr(bot, name, None)
+        if service is not None:
+            await service.stop()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mix", default="deriv_vip=4,mentorship=3,currencies=1,faq=4", help="scenario weights")
+    parser.add_argument("--groups", type=int, default=3, help="connected support groups receiving each ticket")
+    parser.add_argument("--agents", type=int, default=3, help="agents racing for each ticket in the storm phase")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds added to every fake Bot API call")
+    parser.add_argument("--mongo-uri", help="use this MongoDB server instead of mongomock-motor")
+    parser.add_argument("--db-prefix", default="bench_")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        def client_factory(uri, **kwargs):
+            return ScratchClient(AsyncIOMotorClient(args.mongo_uri, **kwargs), args.db_prefix)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+
+        def client_factory(uri, **kwargs):
+            return ScratchClient(AsyncMongoMockClient(), args.db_prefix)
+
+    os.environ.setdefault("OCR_WORKERS", "0")  # amounts come from captions unless OCR is asked for explicitly
+    flows_module = load_module("bench_flows_bot", "tetttt.py")
+    faq_module = load_module("bench_faq_bot", "bot (2).py")
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.modules["database"].AsyncIOMotorClient = client_factory  # both bots connect through database.MongoDatabase
+
+    flows_bot = flows_module.SupportBot("bench-token", "bench")
+    await flows_bot.init_database()
+    faq_bot = faq_module.SupportBot("bench-token", "bench")
+    try:
+        await faq_bot.init_database()
+    except Exception as e:
+        print(f"FAQ bot unavailable on this backend, skipping FAQ searches: {e!r}")
+        faq_bot = None
+
+    group_ids = [-1_000_000_000_000 - n for n in range(args.groups)]
+    for group_id in group_ids:
+        await flows_bot.db.groups.update_one({"group_id": group_id}, {"$set": {
+            "group_id": group_id, "group_name": f"Bench {group_id}", "status": "active", "connected_at": datetime.now(),
+            "tickets_forwarded": 0, "open_tickets_count": 0}}, upsert=True)
+    await flows_bot.group_cache.invalidate()
+
+    cr_number = next(line.strip() for line in (ROOT / "cr_numbers.txt").read_text().splitlines() if line.strip().startswith("CR"))
+    scenarios = {"deriv_vip": (deriv_vip_flow, flows_bot), "mentorship": (mentorship_flow, flows_bot),
+                 "currencies": (currencies_flow, flows_bot), "faq": (faq_session, faq_bot)}
+    weights = {}
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in scenarios:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(scenarios)}")
+        if scenarios[name][1] is not None:
+            weights[name] = float(weight or 1)
+
+    fake_bot = FakeBot(args.api_latency)
+    flows_bot.notifications.start(fake_bot)  # take/close DMs are delivered from the outbox, as in production
+    stats = LatencyStats()
+    application = FakeApplication(stats)
+    phases = []
+    try:
+        names = random.choices(list(weights), weights=list(weights.values()), k=args.users)
+        scripts = [scenarios[name][0](scenarios[name][1], 20_000_000 + n, cr_number) for n, name in enumerate(names)]
+        phases.append(await run_phase("flows", scripts, args.concurrency, fake_bot, application, stats))
+
+        tickets = await flows_bot.db.tickets.find({}, {"ticket_id": 1}).to_list(length=None)
+        scripts = [ticket_storm(flows_bot, 30_000_000 + agent, random.choice(group_ids), ticket["ticket_id"])
+                   for ticket in tickets for agent in range(args.agents)]
+        random.shuffle(scripts)
+        phases.append(await run_phase("storm", scripts, args.concurrency, fake_bot, application, stats))
+
+        drain_started = time.perf_counter()
+        await application.drain()
+        drain_s = time.perf_counter() - drain_started
+    finally:
+        for bot in (flows_bot, faq_bot):
+            if bot is not None:
+                await shutdown(bot)
+                await bot.db_client.drop()
+                bot.db_client.close()
+
+    print_report(phases, drain_s, stats, fake_bot)
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": vars(args), "phases": phases, "fanout_drain_s": drain_s, "steps": stats.summary(),
+                                               "api_calls": dict(fake_bot.calls)}, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
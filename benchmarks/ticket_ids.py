@@ -0,0 +1,85 @@
+"""Concurrent ticket creation benchmark for the ticket ID allocator.
+
+Creates tickets from many concurrent coroutines against a scratch database and
+reports throughput and duplicate IDs for the legacy count_documents scheme and
+for TicketIdAllocator at different block sizes.
+
+    MONGODB_URI=mongodb://localhost:27017/ python -m benchmarks.ticket_ids --tickets 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+
+from ticket_ids import TicketIdAllocator
+
+
+async def legacy_next_id(db):
+    count = await db.tickets.count_documents({"created_at": {"$gte": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)}})
+    return f"TKT-{datetime.now().strftime('%Y%m%d')}-{count+1:04d}"
+
+
+async def run_case(db, name, next_id, tickets, concurrency):
+    await db.tickets.drop()
+    await db.counters.drop()
+    await db.tickets.create_index("ticket_id", unique=True)
+
+    issued = []
+    failures = 0
+    queue = asyncio.Queue()
+    for n in range(tickets):
+        queue.put_nowait(n)
+
+    async def worker():
+        nonlocal failures
+        while True:
+            try:
+                n = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            ticket_id = await next_id()
+            issued.append(ticket_id)
+            try:
+                await db.tickets.insert_one({"ticket_id": ticket_id, "user_id": n, "status": "open", "created_at": datetime.now()})
+            except DuplicateKeyError:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    duplicates = len(issued) - len(set(issued))
+    print(f"{name:<24} {tickets / elapsed:>10.1f} tickets/s  {elapsed:>7.2f}s  duplicate IDs: {duplicates:<6} failed inserts: {failures}")
+    return duplicates
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tickets", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--db", default="support_bot_bench")
+    parser.add_argument("--skip-legacy", action="store_true", help="skip the count_documents baseline")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017/"))
+    db = client[args.db]
+    try:
+        if not args.skip_legacy:
+            await run_case(db, "legacy count_documents", lambda: legacy_next_id(db), args.tickets, args.concurrency)
+        failed = False
+        for block_size in (1, 10, 100):
+            allocator = TicketIdAllocator(db, block_size=block_size)
+            duplicates = await run_case(db, f"allocator block={block_size}", allocator.next_id, args.tickets, args.concurrency)
+            failed = failed or duplicates > 0
+        if failed:
+            raise SystemExit("TicketIdAllocator handed out duplicate IDs")
+    finally:
+        await client.drop_database(args.db)
+        client.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+"""Load generator for webhook mode.
+
+Posts synthetic Telegram updates to a running bot's webhook endpoint and reports
+how many updates per second were accepted, plus the status code breakdown.
+Rejections (503) mean the ingestion queue was full.
+
+Run the bot with BOT_MODE=webhook against a test bot token (replies to the
+synthetic users will fail at Telegram, which still exercises the full handler
+path), then:
+
+    python -m benchmarks.webhook_load --url http://localhost:8080/telegram --secret $WEBHOOK_SECRET --updates 20000 --concurrency 100
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+import aiohttp
+
+from webhook import SECRET_HEADER
+
+TEXTS = ["hi", "hello there", "how to login", "I forgot my password", "what are the pricing plans", "CR5499637", "2024-01-15"]
+CALLBACKS = ["select_vip_type", "vip_deriv_start", "free_mentorship_start", "start_command_reset", "my_tickets"]
+
+
+def synthetic_update(update_id: int, user_id: int) -> dict:
+    sender = {"id": user_id, "is_bot": False, "first_name": "Load", "last_name": str(user_id), "username": f"load_{user_id}"}
+    chat = {"id": user_id, "type": "private", "first_name": "Load"}
+    if random.random() < 0.3:
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id), "from": sender, "chat_instance": str(user_id), "data": random.choice(CALLBACKS),
+                "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": sender, "text": "menu"},
+            },
+        }
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": sender, "text": random.choice(TEXTS)},
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/telegram")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=1000, help="number of distinct synthetic users")
+    args = parser.parse_args()
+
+    statuses = Counter()
+    update_ids = itertools.count(1)
+    remaining = args.updates
+
+    async def worker(session):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            payload = synthetic_update(next(update_ids), random.randint(1, args.users) + 10_000_000)
+            try:
+                async with session.post(args.url, json=payload, headers={SECRET_HEADER: args.secret}) as response:
+                    statuses[response.status] += 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] += 1
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    accepted = statuses.get(200, 0)
+    print(f"Sent {args.updates} updates in {elapsed:.2f}s ({args.updates / elapsed:.1f} req/s)")
+    print(f"Accepted {accepted} ({accepted / elapsed:.1f} updates/s)")
+    for status, count in sorted(statuses.items(), key=lambda item: str(item[0])):
+        print(f"  {status}: {count}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
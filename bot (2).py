@@ -1,50 +1,129 @@
+import time
+STARTED_AT = time.perf_counter() # Start of the "imports" phase, see startup.py
 import os
 import logging
 import asyncio
-from aiohttp import web
+import json
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from datetime import datetime, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo import TEXT, IndexModel
+from pymongo.errors import DuplicateKeyError
 import re
 
+from database import MongoDatabase, index_step
+from expiry import ExpiryService
+from fanout import TicketFanout
+from flood_guard import FloodGuard
+from flow_engine import FlowRouter
+from group_cache import SupportGroupCache
+from metrics import InstrumentedRequest, LoopLagMonitor, instrument, observe_handler, registry
+from outbound import OutboundScheduler
+from startup import StartupProfiler
+from state_store import UserDataSync, create_state_store
+from templates import MarkdownTemplate, Raw, RenderCache, escape_md, keyboard, ticket_actions_keyboard
+from ticket_counters import TicketCounters
+from ticket_ids import TicketIdAllocator
+from ticket_store import TicketStore, encode_cursor
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+profiler = StartupProfiler(STARTED_AT); profiler.record("imports", time.perf_counter() - STARTED_AT) # `--profile-startup` prints where startup time goes
+
+INDEX_VERSION = 2 # Bump when an index definition in init_database changes, so the next boot re-runs them
+
+# Ticket texts; substituted values are Markdown-escaped (user names, descriptions, history)
+TICKET_CARD = MarkdownTemplate("🆕 **New Support Ticket**\n\n🎫 **ID:** `{ticket_id}`\n👤 **User:** {name} ({contact})\n📂 **Category:** {category}\n📅 **Created:** {created_at:%Y-%m-%d %H:%M:%S UTC}\n\n📝 **Description:**\n{description}")
+TICKET_DETAILS = MarkdownTemplate("🎫 **Ticket Details**\n\n**ID:** `{ticket_id}`\n**Status:** {status_emoji} {status}\n**Category:** {category}\n**Priority:** {priority}\n**Created:** {created_at:%Y-%m-%d %H:%M:%S UTC}\n**Last Updated:** {updated_at:%Y-%m-%d %H:%M:%S UTC}\n\n**Description:**\n{description}\n\n")
+HISTORY_LINE = MarkdownTemplate("- *{sender} ({timestamp:%Y-%m-%d %H:%M}):* {message}...\n")
+TAKEN_FOOTER = MarkdownTemplate("\n\n---\n**🧑‍💻 Taken by:** {name} at {at:%Y-%m-%d %H:%M}")
+CLOSED_FOOTER = MarkdownTemplate("\n\n---\n**🔴 Closed by:** {name} at {at:%Y-%m-%d %H:%M}")
+STATUS_EMOJIS = {"open": "🟢", "closed": "🔴", "pending": "🟡", "on-hold": "🟠"}
 
 class SupportBot:
     def __init__(self, bot_token, mongodb_uri):
         self.bot_token = bot_token
         self.mongodb_uri = mongodb_uri
+        self.database = None # Pooled client, warm-up and index migrations, see database.py
         self.db_client = None
         self.db = None
-        self.pending_tickets = {}
-        self.pending_connections = {}  # Store pending group connections
+        self.ticket_ids = None
+        self.tickets = None
+        self.counters = None
+        self.fanout = None
+        self.notifications = None # Durable outbox for messages to users, see notifications.py
+        self.group_cache = None
+        self.kb_search = None # Built by init_kb_search, see kb_search.py
+        self._kb_setup = None # init_kb_search task when KB_PRELOAD=0
+        self.expiry = None # Background eviction of TTL'd state, see expiry.py
+        self.state = None # Shared conversation state (memory or MongoDB), see state_store.py
+        self.pending_tickets = None
+        self.pending_connections = None  # Store pending group connections
+        self.ticket_cards = RenderCache() # Support-group ticket cards by (ticket_id, updated_at)
+        self.ticket_details = RenderCache() # "Ticket Details" headers, same key; history is appended per view
+        self.router = self._build_router()
 
     async def init_database(self):
         """Initialize MongoDB connection"""
         try:
-            self.db_client = AsyncIOMotorClient(self.mongodb_uri)
-            self.db = self.db_client.support_bot
-
-            # Create indexes
-            await self.db.tickets.create_index("ticket_id", unique=True)
-            await self.db.tickets.create_index("user_id")
-            await self.db.groups.create_index("group_id", unique=True)
-            await self.db.knowledge_base.create_index("question") 
-            await self.db.knowledge_base.create_index("keywords")
-
-            if await self.db.knowledge_base.count_documents({}) == 0:
-                await self.init_default_knowledge_base()
+            with profiler.phase("database.connect"):
+                self.database = MongoDatabase(self.mongodb_uri, "support_bot"); self.db_client = self.database.client; self.db = self.database.db
+                await self.database.warm_up()
+            self.ticket_ids = TicketIdAllocator(self.db, block_size=int(os.getenv('TICKET_ID_BLOCK_SIZE', 1)))
+            self.counters = TicketCounters(self.db, reconcile_interval=float(os.getenv('TICKET_COUNTERS_RECONCILE_SECONDS', 3600)))
+            self.fanout = TicketFanout(self.counters, max_concurrency=int(os.getenv('FANOUT_CONCURRENCY', 10)))
+            self.group_cache = SupportGroupCache(self.db, ttl=float(os.getenv('GROUP_CACHE_TTL', 300)))
+            self.expiry = ExpiryService()
+            state_backend = os.getenv('STATE_BACKEND', 'memory'); self.state = create_state_store(state_backend, self.db, expiry=self.expiry, cache_ttl=float(os.getenv('STATE_CACHE_TTL', 5))) # 0 with several replicas
+            self.pending_tickets = self.state.namespace("pending_tickets", ttl=3600); self.pending_connections = self.state.namespace("pending_connections", ttl=600)
+
+            self.tickets = TicketStore(self.db.tickets, self.db.ticket_messages)
+            from notifications import NotificationOutbox
+            self.notifications = NotificationOutbox(self.db.notifications, workers=int(os.getenv('NOTIFICATION_WORKERS', 4)))
+
+            # Create indexes (concurrently, and only when INDEX_VERSION is new to this database) and start the
+            # background tasks; a --profile-startup run does neither, so it measures a cold start and writes nothing
+            if not profiler.profiling:
+                with profiler.phase("database.indexes"):
+                    await self.database.migrate(INDEX_VERSION, {
+                        "tickets": index_step(self.db.tickets, IndexModel("ticket_id", unique=True), IndexModel("user_id")),
+                        "groups": index_step(self.db.groups, IndexModel("group_id", unique=True)),
+                        "knowledge_base": index_step(self.db.knowledge_base, IndexModel("question"), IndexModel("keywords"),
+                                                     IndexModel([("question", TEXT), ("keywords", TEXT)])), # text index for the $text fallback backend
+                        "ticket_counters": self.counters.ensure_indexes, "ticket_store": self.tickets.ensure_indexes,
+                        f"state:{state_backend}": self.state.ensure_indexes, "notifications": self.notifications.ensure_indexes})
+                self.group_cache.watch(); self.expiry.start(); self.counters.start(); self.state.start()
+
+            with profiler.phase("knowledge_base"):
+                if not profiler.profiling and await self.db.knowledge_base.find_one({}, {"_id": 1}) is None:
+                    await self.init_default_knowledge_base()
+                # KB_PRELOAD=0: import kb_search.py and build its index in the background; a search only waits for the import
+                if os.getenv('KB_PRELOAD', '1') == '1': await self.init_kb_search()
+                else: self._kb_setup = asyncio.create_task(self.init_kb_search())
             logger.info("Database initialized successfully")
         except Exception as e:
             logger.error(f"Database initialization failed: {e}")
             raise
 
+    async def init_kb_search(self):
+        """Build the knowledge base searcher; with KB_PRELOAD=0 it runs as a background task and start() builds the index"""
+        from kb_search import KnowledgeBaseSearch
+        kb_search = KnowledgeBaseSearch(self.db.knowledge_base, backend=os.getenv('KB_SEARCH_BACKEND', 'memory'))
+        if kb_search.backend != "mongo" and os.getenv('KB_PRELOAD', '1') == '1': await kb_search.load()
+        if not profiler.profiling: kb_search.start() # searches use $text until the index is ready
+        self.kb_search = kb_search
+
+    async def close(self):
+        """Stop the background services init_database started and flush their pending writes"""
+        for service in (self.kb_search, self.group_cache, self.counters, self.state, self.expiry):
+            if service: await service.stop()
+        if self.database: self.database.close()
+
     async def init_default_knowledge_base(self):
         default_kb = [
             {"question": "how to login", "answer": "To login, visit our website and click 'Sign In' in the top right corner.", "category": "account", "keywords": ["login", "sign in", "access", "enter"]},
@@ -57,8 +136,7 @@ class SupportBot:
         logger.info("Default knowledge base initialized")
 
     async def get_support_groups(self):
-        cursor = self.db.groups.find({"status": "active"})
-        return await cursor.to_list(length=None)
+        return await self.group_cache.get_active()
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.effective_chat.type in ['group', 'supergroup']:
@@ -79,9 +157,10 @@ class SupportBot:
         existing_group = await self.db.groups.find_one({"group_id": chat.id})
         if existing_group:
             if existing_group.get("status") == "active": await update.message.reply_text(f"✅ This group is already connected as a support group!\nConnected on: {existing_group.get('connected_at', 'Unknown').strftime('%Y-%m-%d %H:%M:%S') if existing_group.get('connected_at') else 'Unknown'}"); return
-            else: await self.db.groups.update_one({"group_id": chat.id}, {"$set": {"status": "active", "reactivated_at": datetime.now()}}); await update.message.reply_text("✅ Support group reactivated successfully!"); return
+            else: await self.db.groups.update_one({"group_id": chat.id}, {"$set": {"status": "active", "reactivated_at": datetime.now()}}); await self.group_cache.invalidate(); await update.message.reply_text("✅ Support group reactivated successfully!"); return
         connection_code = f"CONNECT_{chat.id}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
-        self.pending_connections[connection_code] = {"group_id": chat.id, "group_name": chat.title, "admin_id": user.id, "admin_name": f"{user.first_name or ''} {user.last_name or ''}".strip() or user.username or "Admin", "expires_at": datetime.now() + timedelta(minutes=10)}
+        # One pending request per group: repeating /connect replaces it instead of piling up entries
+        await self.pending_connections.set(chat.id, {"code": connection_code, "group_id": chat.id, "group_name": chat.title, "admin_id": user.id, "admin_name": f"{user.first_name or ''} {user.last_name or ''}".strip() or user.username or "Admin", "expires_at": datetime.now() + timedelta(minutes=10)})
         keyboard = [[InlineKeyboardButton("🔗 Connect as Support Group", callback_data=f"connect_{connection_code}")], [InlineKeyboardButton("❌ Cancel", callback_data="cancel_connection")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(f"🔗 **Connect Support Group**\n\nGroup: {chat.title}\nAdmin: {user.first_name or user.username}\n\nClick the button below to connect this group as a support group. Support tickets will be forwarded here for your team to handle.\n\n⏰ This connection request expires in 10 minutes.", reply_markup=reply_markup, parse_mode='Markdown')
@@ -103,17 +182,12 @@ class SupportBot:
         group_check = await self.db.groups.find_one({"group_id": chat.id, "status": "active"})
         if not group_check: await update.message.reply_text("❌ This group is not currently connected as an active support group."); return
         result = await self.db.groups.update_one({"group_id": chat.id}, {"$set": {"status": "inactive", "disconnected_at": datetime.now()}})
-        if result.modified_count > 0: await update.message.reply_text("✅ Support group disconnected successfully. No new tickets will be forwarded to this group.")
+        if result.modified_count > 0: await self.group_cache.invalidate(); await update.message.reply_text("✅ Support group disconnected successfully. No new tickets will be forwarded to this group.")
         else: await update.message.reply_text("❌ This group is not connected as a support group or was already inactive.")
 
     async def search_knowledge_base(self, query: str):
-        query_lower = query.lower().strip();
-        if not query_lower: return []
-        exact_match = await self.db.knowledge_base.find_one({"question": {"$regex": f"^{re.escape(query_lower)}$", "$options": "i"}})
-        if exact_match: return [exact_match]
-        query_words = [re.escape(word) for word in query_lower.split() if len(word) > 2]
-        pipeline = [{"$match": {"$or": [{"keywords": {"$in": [re.compile(word, re.IGNORECASE) for word in query_words]}}, {"question": {"$regex": query_lower, "$options": "i"}}]}}, {"$limit": 3}]
-        cursor = self.db.knowledge_base.aggregate(pipeline); return await cursor.to_list(length=None)
+        if self.kb_search is None: await self._kb_setup
+        return await self.kb_search.search(query, limit=3)
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.message or not update.message.text: return
@@ -125,7 +199,7 @@ class SupportBot:
         user_message_full = update.message.text; user_id = update.effective_user.id; user_message_cleaned = user_message_full
         if context.bot.username: user_message_cleaned = re.sub(f'@{context.bot.username}', '', user_message_full, flags=re.IGNORECASE).strip()
         if not user_message_cleaned: await update.message.reply_text("Yes? How can I help you today? Try /start or ask a question."); return
-        if user_id in self.pending_tickets: await self.process_ticket_input(update, context, user_message_cleaned); return
+        if await self.pending_tickets.contains(user_id): await self.process_ticket_input(update, context, user_message_cleaned); return
         results = await self.search_knowledge_base(user_message_cleaned)
         if results:
             response = "🔍 **Found these relevant answers:**\n\n";
@@ -136,32 +210,46 @@ class SupportBot:
             keyboard = [[InlineKeyboardButton("🎫 Create Support Ticket", callback_data="create_ticket")], [InlineKeyboardButton("📚 Browse FAQ", callback_data="faq")]]; reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text("🤔 I couldn't find a specific answer to your question.\nWould you like to create a support ticket or browse our FAQ?", reply_markup=reply_markup)
 
+    def _build_router(self) -> FlowRouter:
+        """Callback dispatch table: exact callback data first, then prefixes carrying a payload"""
+        router = FlowRouter(observer=observe_handler)
+        router.callback("faq", lambda update, context: self.show_faq_categories(update.callback_query))
+        router.callback("create_ticket", lambda update, context: self.start_ticket_creation(update.callback_query))
+        router.callback("my_tickets", lambda update, context: self.show_user_tickets(update.callback_query))
+        router.prefix("tickets_older_", lambda update, context, cursor: self.show_user_tickets(update.callback_query, cursor, older=True))
+        router.prefix("tickets_newer_", lambda update, context, cursor: self.show_user_tickets(update.callback_query, cursor, older=False))
+        router.callback("help", lambda update, context: self.show_help_inline(update.callback_query))
+        router.callback("cancel_connection", lambda update, context: update.callback_query.edit_message_text("❌ Connection request cancelled by user."))
+        router.callback("back_to_menu", self.start_command)
+        router.prefix("connect_", lambda update, context, code: self.process_group_connection(update.callback_query, code))
+        router.prefix("category_", lambda update, context, category: self.set_ticket_category(update.callback_query, category))
+        router.prefix("faq_cat_", lambda update, context, category_name: self.show_faq_for_category(update.callback_query, category_name))
+        router.prefix("faq_item_", lambda update, context, item_id_str: self.show_faq_answer(update.callback_query, item_id_str))
+        router.prefix("ticket_", lambda update, context, ticket_id: self.show_ticket_details(update.callback_query, ticket_id))
+        router.prefix("take_", lambda update, context, ticket_id: self.handle_take_ticket(update.callback_query, context, ticket_id))
+        router.prefix("close_", lambda update, context, ticket_id: self.handle_close_ticket(update.callback_query, context, ticket_id))
+        router.expect_callbacks("faq", "create_ticket", "my_tickets", "tickets_older_0_0", "tickets_newer_0_0", "help", "cancel_connection", "back_to_menu", "connect_CONNECT_0", "category_general",
+                                "faq_cat_General", "faq_item_0", "ticket_TKT-0", "take_TKT-0", "close_TKT-0")
+        router.validate()
+        return router
+
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query; await query.answer(); data = query.data
-        if data == "faq": await self.show_faq_categories(query)
-        elif data == "create_ticket": await self.start_ticket_creation(query)
-        elif data == "my_tickets": await self.show_user_tickets(query)
-        elif data == "help": await self.show_help_inline(query)
-        elif data.startswith("connect_"): connection_code = data; await self.process_group_connection(query, connection_code)
-        elif data == "cancel_connection": await query.edit_message_text("❌ Connection request cancelled by user.")
-        elif data.startswith("category_"): category = data.replace("category_", ""); await self.set_ticket_category(query, category)
-        elif data.startswith("faq_cat_"): category_name = data.replace("faq_cat_", ""); await self.show_faq_for_category(query, category_name)
-        elif data.startswith("faq_item_"): item_id_str = data.replace("faq_item_", ""); await self.show_faq_answer(query, item_id_str)
-        elif data.startswith("ticket_"): ticket_id = data.replace("ticket_", ""); await self.show_ticket_details(query, ticket_id)
-        elif data == "back_to_menu": await self.start_command(update, context)
-        elif data.startswith("take_"): ticket_id = data.split("_", 1)[1]; await self.handle_take_ticket(query, context, ticket_id)
-        elif data.startswith("close_"): ticket_id = data.split("_", 1)[1]; await self.handle_close_ticket(query, context, ticket_id)
+        query = update.callback_query; await query.answer()
+        if not await self.router.dispatch_callback(update, context): logger.info(f"Unhandled callback_data: {query.data}")
 
     async def process_group_connection(self, query: Update.callback_query, connection_code_from_button: str):
         actual_code = connection_code_from_button.replace("connect_", "")
-        connection_data = self.pending_connections.get(actual_code)
-        if not connection_data: await query.edit_message_text("❌ Connection request invalid or already processed."); return
-        if datetime.now() > connection_data["expires_at"]: del self.pending_connections[actual_code]; await query.edit_message_text("❌ Connection request expired."); return
+        try: group_id = int(actual_code.split("_")[1])  # CONNECT_<group id>_<timestamp>
+        except (IndexError, ValueError): group_id = None
+        connection_data = await self.pending_connections.get(group_id) if group_id is not None else None
+        if not connection_data or connection_data.get("code") != actual_code: await query.edit_message_text("❌ Connection request invalid or already processed."); return
+        if datetime.now() > connection_data["expires_at"]: await self.pending_connections.delete(group_id); await query.edit_message_text("❌ Connection request expired."); return
         if query.from_user.id != connection_data["admin_id"]: await query.answer("Only the admin who initiated this can connect the group.", show_alert=True); return
         group_doc = {"group_id": connection_data["group_id"], "group_name": connection_data["group_name"], "admin_id": connection_data["admin_id"], "admin_name": connection_data["admin_name"], "status": "active", "connected_at": datetime.now(), "tickets_forwarded": 0}
         try:
             await self.db.groups.update_one({"group_id": connection_data["group_id"]}, {"$set": group_doc}, upsert=True)
-            del self.pending_connections[actual_code]
+            await self.group_cache.invalidate()
+            await self.pending_connections.delete(group_id)
             await query.edit_message_text(f"✅ **Support Group Connected Successfully!**\n\nGroup: {connection_data['group_name']}\nConnected by: {connection_data['admin_name']}\n\n🎫 Support tickets will now be forwarded to this group.\n📋 Use /disconnect to disconnect this group later.", parse_mode='Markdown')
             logger.info(f"Support group connected: {connection_data['group_name']} ({connection_data['group_id']})")
         except Exception as e: logger.error(f"Error connecting support group: {e}"); await query.edit_message_text("❌ Error connecting support group. Please try again.")
@@ -199,59 +287,72 @@ class SupportBot:
 
     async def set_ticket_category(self, query: Update.callback_query, category: str):
         user_id = query.from_user.id
-        self.pending_tickets[user_id] = {"category": category.replace('_', ' ').title(), "created_at": datetime.now(), "user": {"id": user_id, "username": query.from_user.username, "name": f"{query.from_user.first_name or ''} {query.from_user.last_name or ''}".strip() or query.from_user.username or "N/A"}}
-        await query.edit_message_text(f"🎫 **Support Ticket - {self.pending_tickets[user_id]['category']}**\n\nPlease describe your issue in detail. Include:\n• What happened?\n• What were you trying to do?\n• Any error messages (copy-paste if possible)\n• Steps to reproduce the issue\n\n💬 Type your message below. Send photos/screenshots separately if needed *after* sending this text.", parse_mode='Markdown')
+        ticket_data = {"category": category.replace('_', ' ').title(), "created_at": datetime.now(), "user": {"id": user_id, "username": query.from_user.username, "name": f"{query.from_user.first_name or ''} {query.from_user.last_name or ''}".strip() or query.from_user.username or "N/A"}}
+        await self.pending_tickets.set(user_id, ticket_data)
+        await query.edit_message_text(f"🎫 **Support Ticket - {ticket_data['category']}**\n\nPlease describe your issue in detail. Include:\n• What happened?\n• What were you trying to do?\n• Any error messages (copy-paste if possible)\n• Steps to reproduce the issue\n\n💬 Type your message below. Send photos/screenshots separately if needed *after* sending this text.", parse_mode='Markdown')
 
     async def process_ticket_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE, description: str):
-        user_id = update.effective_user.id; ticket_data = self.pending_tickets.get(user_id)
+        user_id = update.effective_user.id; ticket_data = await self.pending_tickets.get(user_id)
         if not ticket_data: await update.message.reply_text("❌ Ticket session error. Please start over with /start and create a ticket."); return
         if not description.strip(): await update.message.reply_text("📝 Please provide a description for your ticket. Your ticket has not been created yet."); return
-        count = await self.db.tickets.count_documents({"created_at": {"$gte": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)}})
-        ticket_id = f"TKT-{datetime.now().strftime('%Y%m%d')}-{count+1:04d}"
-        ticket_doc = {"ticket_id": ticket_id, "user_id": user_id, "user_info": ticket_data["user"], "category": ticket_data["category"], "description": description, "status": "open", "priority": "normal", "created_at": datetime.now(), "updated_at": datetime.now(), "messages": [{"from_user_id": user_id, "from_support": False, "sender_name": ticket_data["user"]["name"], "message": description, "timestamp": datetime.now()}], "assigned_to": None, "resolution": None}
+        ticket_id = await self.ticket_ids.next_id()
+        ticket_doc = {"ticket_id": ticket_id, "user_id": user_id, "user_info": ticket_data["user"], "category": ticket_data["category"], "description": description, "status": "open", "priority": "normal", "created_at": datetime.now(), "updated_at": datetime.now(), "assigned_to": None, "resolution": None}
         try:
-            await self.db.tickets.insert_one(ticket_doc)
+            for attempt in range(3):
+                try: await self.db.tickets.insert_one(ticket_doc); break
+                except DuplicateKeyError:
+                    if attempt == 2: raise
+                    ticket_doc.pop("_id", None); ticket_id = ticket_doc["ticket_id"] = await self.ticket_ids.next_id()
+            self.counters.opened(); context.application.create_task(self.tickets.add_message(ticket_id, {"from_user_id": user_id, "from_support": False, "sender_name": ticket_data["user"]["name"], "message": description, "timestamp": ticket_doc["created_at"]}))
             confirmation_text = f"✅ **Ticket Created Successfully!**\n\n🎫 **Ticket ID:** `{ticket_id}`\n📂 **Category:** {ticket_data['category']}\n📝 **Description:** {description[:100]}{'...' if len(description) > 100 else ''}\n\n⏰ **Status:** Open\n\nOur support team will review your ticket. You can view its status via 'My Tickets'."
             keyboard = [[InlineKeyboardButton("📊 My Tickets", callback_data="my_tickets")], [InlineKeyboardButton("🔙 Main Menu", callback_data="back_to_menu")]]; reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(confirmation_text, reply_markup=reply_markup, parse_mode='Markdown')
-            await self.forward_to_support_groups(context, ticket_doc)
+            context.application.create_task(self.forward_to_support_groups(context, ticket_doc))
         except Exception as e: logger.error(f"Error creating ticket: {e}"); await update.message.reply_text("❌ Error creating ticket. Please try again or contact support directly if the issue persists.")
         finally:
-            if user_id in self.pending_tickets: del self.pending_tickets[user_id]
+            await self.pending_tickets.delete(user_id)
 
     async def forward_to_support_groups(self, context: ContextTypes.DEFAULT_TYPE, ticket_doc):
         support_groups = await self.get_support_groups()
         if not support_groups: logger.warning(f"Ticket {ticket_doc['ticket_id']} created, but no active support groups connected to forward to."); return
-        user_contact = f"@{ticket_doc['user_info']['username']}" if ticket_doc['user_info']['username'] else f"User ID: {ticket_doc['user_info']['id']}"
-        support_text = f"🆕 **New Support Ticket**\n\n🎫 **ID:** `{ticket_doc['ticket_id']}`\n👤 **User:** {ticket_doc['user_info']['name']} ({user_contact})\n📂 **Category:** {ticket_doc['category']}\n📅 **Created:** {ticket_doc['created_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n📝 **Description:**\n{ticket_doc['description']}"
-        keyboard = [[InlineKeyboardButton("🙋‍♂️ Take Ticket", callback_data=f"take_{ticket_doc['ticket_id']}")], [InlineKeyboardButton("🔒 Close Ticket", callback_data=f"close_{ticket_doc['ticket_id']}")]]; reply_markup = InlineKeyboardMarkup(keyboard)
-        for group in support_groups:
-            try:
-                await context.bot.send_message(chat_id=group["group_id"], text=support_text, reply_markup=reply_markup, parse_mode='Markdown')
-                await self.db.groups.update_one({"_id": group["_id"]}, {"$inc": {"tickets_forwarded": 1, "open_tickets_count": 1}})
-            except Exception as e: logger.error(f"Failed to forward ticket {ticket_doc['ticket_id']} to group {group['group_name']} ({group['group_id']}): {e}")
-
-    async def show_user_tickets(self, query: Update.callback_query):
-        user_id = query.from_user.id; tickets_cursor = self.db.tickets.find({"user_id": user_id}).sort("created_at", -1).limit(10); tickets = await tickets_cursor.to_list(length=None)
-        if not tickets: await query.edit_message_text("📊 **My Tickets**\n\nYou don't have any support tickets yet.\nCreate one by clicking the button below or from the main menu!", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🎫 Create New Ticket", callback_data="create_ticket")], [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_menu")]]), parse_mode='Markdown'); return
-        keyboard = []; status_emojis = {"open": "🟢", "closed": "🔴", "pending": "🟡", "on-hold": "🟠"}
-        for ticket in tickets: emoji = status_emojis.get(ticket["status"], "⚪️"); keyboard.append([InlineKeyboardButton(f"{emoji} {ticket['ticket_id']} - {ticket['category'].title()} ({ticket['status']})", callback_data=f"ticket_{ticket['ticket_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_menu")]); reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"📊 **My Tickets** (Showing last {len(tickets)})\n\nSelect a ticket to view details:", reply_markup=reply_markup, parse_mode='Markdown')
+        return await self.fanout.broadcast(context.bot, ticket_doc['ticket_id'], support_groups, self.support_ticket_text(ticket_doc), ticket_actions_keyboard(ticket_doc['ticket_id']))
+
+    def support_ticket_text(self, ticket_doc) -> str:
+        """The ticket card posted to support groups (and re-rendered when it is taken or closed)"""
+        return self.ticket_cards.get(ticket_doc, self._render_ticket_card)
+
+    def _render_ticket_card(self, ticket_doc) -> str:
+        user_info = ticket_doc['user_info']; user_contact = f"@{user_info['username']}" if user_info['username'] else f"User ID: {user_info['id']}"
+        return TICKET_CARD.render(ticket_id=Raw(ticket_doc['ticket_id']), name=user_info['name'], contact=user_contact, category=ticket_doc['category'], created_at=ticket_doc['created_at'], description=ticket_doc['description'])
+
+    async def show_user_tickets(self, query: Update.callback_query, cursor: str | None = None, older: bool = True):
+        user_id = query.from_user.id; tickets, has_newer, has_older = await self.tickets.user_tickets_page(user_id, cursor, older)
+        if not tickets and cursor: tickets, has_newer, has_older = await self.tickets.user_tickets_page(user_id) # Nothing past a stale cursor: start again from the newest
+        if not tickets: await query.edit_message_text("📊 **My Tickets**\n\nYou don't have any support tickets yet.\nCreate one by clicking the button below or from the main menu!", reply_markup=keyboard((("🎫 Create New Ticket", "create_ticket"),), (("🔙 Back to Menu", "back_to_menu"),)), parse_mode='Markdown'); return
+        rows = []
+        for ticket in tickets: emoji = STATUS_EMOJIS.get(ticket["status"], "⚪️"); rows.append([InlineKeyboardButton(f"{emoji} {ticket['ticket_id']} - {ticket['category'].title()} ({ticket['status']})", callback_data=f"ticket_{ticket['ticket_id']}")])
+        pager = []
+        if has_newer: pager.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"tickets_newer_{encode_cursor(tickets[0])}"))
+        if has_older: pager.append(InlineKeyboardButton("Older ➡️", callback_data=f"tickets_older_{encode_cursor(tickets[-1])}"))
+        if pager: rows.append(pager)
+        rows.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_menu")]); reply_markup = InlineKeyboardMarkup(rows)
+        await query.edit_message_text(f"📊 **My Tickets** (Showing {len(tickets)})\n\nSelect a ticket to view details:", reply_markup=reply_markup, parse_mode='Markdown')
 
     async def show_ticket_details(self, query: Update.callback_query, ticket_id_str: str):
-        ticket = await self.db.tickets.find_one({"ticket_id": ticket_id_str, "user_id": query.from_user.id})
-        if not ticket: await query.edit_message_text("❌ Ticket not found or you don't have permission to view it.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📊 My Tickets", callback_data="my_tickets")]])); return
-        status_emojis = {"open": "🟢", "closed": "🔴", "pending": "🟡", "on-hold": "🟠"}; status_emoji = status_emojis.get(ticket["status"], "⚪️")
-        details_text = f"🎫 **Ticket Details**\n\n**ID:** `{ticket['ticket_id']}`\n**Status:** {status_emoji} {ticket['status'].title()}\n**Category:** {ticket['category'].title()}\n**Priority:** {ticket.get('priority', 'Normal').title()}\n**Created:** {ticket['created_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}\n**Last Updated:** {ticket['updated_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n**Description:**\n{ticket['description']}\n\n"
-        if ticket.get('assigned_to_name'): details_text += f"**Assigned To:** {ticket['assigned_to_name']}\n"
-        if ticket.get('resolution'): details_text += f"**Resolution:**\n{ticket['resolution']}\n"
-        details_text += "\n**History:**\n";
-        if ticket.get("messages"):
-            for msg in ticket["messages"][:5]: sender = msg.get("sender_name", "Support" if msg.get("from_support") else "You"); details_text += f"- *{sender} ({msg['timestamp'].strftime('%Y-%m-%d %H:%M')}):* {msg['message'][:80]}...\n"
+        ticket = await self.tickets.get(ticket_id_str, "details", user_id=query.from_user.id)
+        if not ticket: await query.edit_message_text("❌ Ticket not found or you don't have permission to view it.", reply_markup=keyboard((("📊 My Tickets", "my_tickets"),))); return
+        details_text = self.ticket_details.get(ticket, self._render_ticket_details) + "\n**History:**\n"
+        history = ticket.get("messages") or await self.tickets.first_messages(ticket_id_str, 5) # Legacy tickets still embed their history
+        if history:
+            for msg in history[:5]: details_text += HISTORY_LINE.render(sender=msg.get("sender_name", "Support" if msg.get("from_support") else "You"), timestamp=msg['timestamp'], message=msg['message'][:80])
         else: details_text += "No messages in history yet beyond initial description.\n"
-        keyboard = [[InlineKeyboardButton("📊 Back to My Tickets", callback_data="my_tickets")], [InlineKeyboardButton("🔙 Main Menu", callback_data="back_to_menu")]]; reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(details_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(details_text, reply_markup=keyboard((("📊 Back to My Tickets", "my_tickets"),), (("🔙 Main Menu", "back_to_menu"),)), parse_mode='Markdown')
+
+    def _render_ticket_details(self, ticket) -> str:
+        details_text = TICKET_DETAILS.render(ticket_id=Raw(ticket['ticket_id']), status_emoji=STATUS_EMOJIS.get(ticket["status"], "⚪️"), status=ticket['status'].title(), category=ticket['category'].title(), priority=ticket.get('priority', 'Normal').title(), created_at=ticket['created_at'], updated_at=ticket['updated_at'], description=ticket['description'])
+        if ticket.get('assigned_to_name'): details_text += f"**Assigned To:** {escape_md(ticket['assigned_to_name'])}\n"
+        if ticket.get('resolution'): details_text += f"**Resolution:**\n{escape_md(ticket['resolution'])}\n"
+        return details_text
 
     async def show_help_inline(self, query: Update.callback_query):
         help_text = "❓ **How to use this bot:**\n\n🔍 **Quick Search:** Just type your question directly in the chat.\n📚 **FAQ:** Use the 'Browse FAQ' button to see common questions by category.\n🎫 **Support Tickets:** Click 'Create Support Ticket' to submit a detailed request.\n📊 **Track Tickets:** 'My Tickets' shows your past and current support requests.\n\n💡 **Tips for Tickets:**\n• Be specific: The more details, the faster we can help.\n• Include error messages or screenshots if relevant.\n\n👥 **For Group Admins:**\n• Add me to your support group.\n• Use `/connect` (or click the button when I join) to link it for receiving tickets.\n• Use `/disconnect` to stop receiving tickets in that group."
@@ -259,41 +360,94 @@ class SupportBot:
         await query.edit_message_text(help_text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def handle_take_ticket(self, query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
-        agent_user = query.from_user; agent_name = f"{agent_user.first_name or ''} {agent_user.last_name or ''}".strip() or agent_user.username
-        ticket = await self.db.tickets.find_one({"ticket_id": ticket_id})
-        if not ticket: await query.answer("Ticket not found.", show_alert=True); return
-        if ticket.get("assigned_to") and ticket.get("assigned_to") != agent_user.id: await query.answer(f"This ticket is already assigned to {ticket.get('assigned_to_name', 'another agent')}.", show_alert=True); return
-        elif ticket.get("assigned_to") == agent_user.id: await query.answer("You have already taken this ticket.", show_alert=True); return
-        if ticket.get("status") == "closed": await query.answer("This ticket is already closed.", show_alert=True); return
-        update_result = await self.db.tickets.update_one({"ticket_id": ticket_id, "status": {"$ne": "closed"}}, {"$set": {"assigned_to": agent_user.id, "assigned_to_name": agent_name, "status": "pending", "updated_at": datetime.now(), "$push": {"messages": {"from_support": True, "sender_name": "System", "message": f"Ticket taken by agent {agent_name}.", "timestamp": datetime.now()}}}})
-        if update_result.modified_count > 0:
-            await query.answer(f"You've taken ticket {ticket_id}.", show_alert=True)
-            original_message = query.message; new_text = original_message.text + f"\n\n---\n**🧑‍💻 Taken by:** {agent_name} at {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-            new_keyboard = [[InlineKeyboardButton("🔒 Close Ticket", callback_data=f"close_{ticket_id}")]]; await query.edit_message_text(text=new_text, reply_markup=InlineKeyboardMarkup(new_keyboard), parse_mode='Markdown')
-            try: await context.bot.send_message(chat_id=ticket["user_id"], text=f"ℹ️ Ticket `{ticket_id}` has been assigned to agent {agent_name}. They will review your issue shortly.", parse_mode='Markdown')
-            except Exception as e: logger.error(f"Failed to notify user {ticket['user_id']} about assignment: {e}")
-        else: await query.answer("Could not take the ticket. It might be closed or already assigned.", show_alert=True)
+        agent_user = query.from_user; agent_name = f"{agent_user.first_name or ''} {agent_user.last_name or ''}".strip() or agent_user.username; now = datetime.now()
+        # Precondition in the filter: of several agents clicking at once exactly one gets the ticket back
+        ticket = await self.tickets.take(ticket_id, agent_user.id, agent_name, now)
+        if not ticket:
+            # Only a refused click pays for a second read, to say why
+            current = await self.tickets.get(ticket_id, "status")
+            if not current: await query.answer("Ticket not found.", show_alert=True)
+            elif current.get("status") == "closed": await query.answer("This ticket is already closed.", show_alert=True)
+            elif current.get("assigned_to") == agent_user.id: await query.answer("You have already taken this ticket.", show_alert=True)
+            else: await query.answer(f"This ticket is already assigned to {current.get('assigned_to_name', 'another agent')}.", show_alert=True)
+            return
+        context.application.create_task(self.tickets.add_message(ticket_id, {"from_support": True, "sender_name": "System", "message": f"Ticket taken by agent {agent_name}.", "timestamp": now}))
+        await query.answer(f"You've taken ticket {ticket_id}.", show_alert=True)
+        new_text = self.support_ticket_text(ticket) + TAKEN_FOOTER.render(name=ticket['assigned_to_name'], at=ticket['updated_at'])
+        await query.edit_message_text(text=new_text, reply_markup=ticket_actions_keyboard(ticket_id, take=False), parse_mode='Markdown')
+        await self.notifications.enqueue(f"ticket:{ticket_id}:taken", ticket["user_id"], f"ℹ️ Ticket `{ticket_id}` has been assigned to agent {escape_md(agent_name)}. They will review your issue shortly.") # Delivered in the background, the agent's click doesn't wait on it
 
     async def handle_close_ticket(self, query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
-        agent_user = query.from_user; agent_name = f"{agent_user.first_name or ''} {agent_user.last_name or ''}".strip() or agent_user.username
-        ticket = await self.db.tickets.find_one({"ticket_id": ticket_id})
-        if not ticket: await query.answer("Ticket not found.", show_alert=True); return
-        if ticket.get("status") == "closed": await query.answer("This ticket is already closed.", show_alert=True); return
-        update_result = await self.db.tickets.update_one({"ticket_id": ticket_id}, {"$set": {"status": "closed", "closed_by_name": agent_name, "closed_by_id": agent_user.id, "updated_at": datetime.now(), "resolution": ticket.get("resolution", "Closed by support agent."), "$push": {"messages": {"from_support": True, "sender_name": "System", "message": f"Ticket closed by agent {agent_name}.", "timestamp": datetime.now()}}}})
-        if update_result.modified_count > 0:
-            await query.answer(f"Ticket {ticket_id} has been closed.", show_alert=True)
-            original_message = query.message; new_text = original_message.text.split("\n\n---")[0] + f"\n\n---\n**🔴 Closed by:** {agent_name} at {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-            await query.edit_message_text(text=new_text, reply_markup=None, parse_mode='Markdown')
-            if query.message and query.message.chat: await self.db.groups.update_one({"group_id": query.message.chat.id}, {"$inc": {"open_tickets_count": -1}})
-            try: await context.bot.send_message(chat_id=ticket["user_id"], text=f"✅ Ticket `{ticket_id}` has been marked as closed by our support team. If your issue is not resolved, please create a new ticket.", parse_mode='Markdown')
-            except Exception as e: logger.error(f"Failed to notify user {ticket['user_id']} about ticket closure: {e}")
-        else: await query.answer("Could not close the ticket.", show_alert=True)
+        agent_user = query.from_user; agent_name = f"{agent_user.first_name or ''} {agent_user.last_name or ''}".strip() or agent_user.username; now = datetime.now()
+        ticket = await self.tickets.close(ticket_id, agent_user.id, agent_name, now)
+        if not ticket:
+            exists = await self.tickets.get(ticket_id, "status")
+            await query.answer("This ticket is already closed." if exists else "Ticket not found.", show_alert=True); return
+        context.application.create_task(self.tickets.add_message(ticket_id, {"from_support": True, "sender_name": "System", "message": f"Ticket closed by agent {agent_name}.", "timestamp": now}))
+        await query.answer(f"Ticket {ticket_id} has been closed.", show_alert=True)
+        new_text = self.support_ticket_text(ticket) + CLOSED_FOOTER.render(name=ticket['closed_by_name'], at=ticket['updated_at'])
+        await query.edit_message_text(text=new_text, reply_markup=None, parse_mode='Markdown')
+        # Every group the ticket went to counts it as open; tickets from before forwarded_to was recorded fall back to this group
+        self.counters.closed(ticket.get("forwarded_to") or ([query.message.chat.id] if query.message and query.message.chat else []))
+        await self.notifications.enqueue(f"ticket:{ticket_id}:closed", ticket["user_id"], f"✅ Ticket `{ticket_id}` has been marked as closed by our support team. If your issue is not resolved, please create a new ticket.")
 # === End of SupportBot class ===
 
 
+def build_web_app(support_bot, outbound, flood_guard):
+    """Health, stats and /metrics routes; aiohttp is only imported when the server is wanted"""
+    from aiohttp import web
+
+    # 🔧 Add health check endpoint for Koyeb
+    async def health_check(request):
+        return web.Response(text="OK")
+
+    web_app = web.Application()
+    web_app.router.add_get("/", health_check)
+    web_app.router.add_get("/health", health_check)
+
+    async def expiry_stats(request):
+        return web.json_response(support_bot.expiry.stats())
+
+    web_app.router.add_get("/stats/expiry", expiry_stats)
+
+    async def group_cache_stats(request):
+        return web.json_response(support_bot.group_cache.stats())
+
+    web_app.router.add_get("/stats/groups", group_cache_stats)
+
+    async def ticket_stats(request):
+        return web.json_response(await support_bot.counters.read(), dumps=lambda obj: json.dumps(obj, default=str))
+
+    web_app.router.add_get("/stats/tickets", ticket_stats)
+
+    async def outbound_stats(request):
+        return web.json_response(outbound.stats())
+
+    web_app.router.add_get("/stats/outbound", outbound_stats)
+
+    async def notification_stats(request):
+        return web.json_response(await support_bot.notifications.stats())
+
+    web_app.router.add_get("/stats/notifications", notification_stats)
+
+    async def flood_stats(request):
+        return web.json_response(flood_guard.stats())
+
+    web_app.router.add_get("/stats/flood", flood_stats)
+
+    async def mongo_stats(request):
+        return web.json_response(support_bot.database.stats())
+
+    web_app.router.add_get("/stats/mongo", mongo_stats)
+    if os.getenv('ADMIN_API_TOKEN'):
+        from ticket_export import install_export
+        install_export(web_app, support_bot.db.tickets, os.getenv('ADMIN_API_TOKEN'))
+    registry.install(web_app)
+    return web_app
+
+
 async def main_async_logic():
     import logging
-    from aiohttp import web
 
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -313,59 +467,91 @@ async def main_async_logic():
         raise ValueError("MONGODB_URI environment variable is required.")
 
     support_bot = SupportBot(bot_token, mongodb_uri)
-    await support_bot.init_database()
-
-    app_builder = Application.builder().token(bot_token)
-    app = app_builder.build()
-
-    # Add handlers
-    app.add_handler(CommandHandler("start", support_bot.start_command))
-    app.add_handler(CommandHandler("help", support_bot.help_command))
-    app.add_handler(CommandHandler("connect", support_bot.connect_command))
-    app.add_handler(CommandHandler("disconnect", support_bot.disconnect_command))
-    app.add_handler(CallbackQueryHandler(support_bot.button_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, support_bot.handle_message))
-
-    await app.initialize()
-    await app.start()
-    logger.info("PTB Application initialized and started.")
+    app = runner = ingestor = loop_lag = None
+    try:
+        with profiler.phase("init_database"):
+            await support_bot.init_database()
+
+        outbound = OutboundScheduler(max_queue=int(os.getenv('OUTBOUND_MAX_QUEUE', 5000))) # Queues and paces sends/edits to Telegram's limits
+        app_builder = Application.builder().token(bot_token).request(InstrumentedRequest(connection_pool_size=256)).rate_limiter(outbound)
+        app = app_builder.build()
+
+        # Per-user flood limits run first, so spam is dropped before the state load and KB search
+        flood_guard = FloodGuard({"text": int(os.getenv('FLOOD_TEXT_PER_MINUTE', 20))}, shared=support_bot.db.flood_windows if os.getenv('FLOOD_SHARED') == '1' else None)
+        if not profiler.profiling: await flood_guard.ensure_indexes()
+        flood_guard.install(app)
+
+        # Add handlers
+        app.add_handler(CommandHandler("start", instrument("start_command", support_bot.start_command)))
+        app.add_handler(CommandHandler("help", instrument("help_command", support_bot.help_command)))
+        app.add_handler(CommandHandler("connect", instrument("connect_command", support_bot.connect_command)))
+        app.add_handler(CommandHandler("disconnect", instrument("disconnect_command", support_bot.disconnect_command)))
+        app.add_handler(CallbackQueryHandler(instrument("button_callback", support_bot.button_callback)))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("handle_message", support_bot.handle_message)))
+        UserDataSync(support_bot.state, ttl=int(os.getenv('USER_STATE_TTL', 86400)), expiry=support_bot.expiry, idle_ttl=float(os.getenv('USER_DATA_IDLE_TTL', 900))).install(app)
+
+        with profiler.phase("ptb.initialize"): await app.initialize()
+        if profiler.profiling: # Report and stop before the outbox or PTB start, so nothing can reach Telegram or its users
+            profiler.ready(); print(profiler.report())
+            return
+        with profiler.phase("ptb.start"): await app.start()
+        support_bot.notifications.start(app.bot)
+        logger.info("PTB Application initialized and started.")
+
+        bot_mode = os.getenv('BOT_MODE', 'polling').lower()
+        if os.getenv('WEB_SERVER', '1') == '1' or bot_mode == 'webhook': # WEB_SERVER=0: no health/metrics server (nor aiohttp) when polling
+            with profiler.phase("web_server"):
+                from aiohttp import web
+                web_app = build_web_app(support_bot, outbound, flood_guard)
+                if bot_mode == 'webhook':
+                    from webhook import WebhookIngestor
+                    webhook_url = os.getenv('WEBHOOK_URL'); webhook_secret = os.getenv('WEBHOOK_SECRET')
+                    if not webhook_url or not webhook_secret:
+                        raise ValueError("WEBHOOK_URL and WEBHOOK_SECRET environment variables are required in webhook mode.")
+                    webhook_path = os.getenv('WEBHOOK_PATH', '/telegram')
+                    ingestor = WebhookIngestor(app, webhook_secret, workers=int(os.getenv('WEBHOOK_WORKERS', 4)), queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+                    ingestor.install(web_app, webhook_path)
+
+                # Start the web server
+                runner = web.AppRunner(web_app)
+                await runner.setup()
+                port = int(os.getenv('PORT', 8080))
+                site = web.TCPSite(runner, '0.0.0.0', port)
+                await site.start()
+                logger.info(f"Web server started on port {port}")
+
+        registry.gauge("bot_update_queue_depth", "Updates waiting to be processed", lambda: app.update_queue.qsize() + (ingestor.queue_depth() if ingestor else 0))
+        registry.gauge("bot_expiring_entries", "Live entries awaiting expiry, by kind", lambda: support_bot.expiry.stats()["live_by_kind"], ("kind",))
+        loop_lag = LoopLagMonitor(); loop_lag.start()
+        profiler.ready()
+
+        if ingestor:
+            await ingestor.start()
+            await app.bot.set_webhook(url=webhook_url.rstrip('/') + webhook_path, secret_token=webhook_secret, allowed_updates=Update.ALL_TYPES, max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)))
+            logger.info(f"Webhook registered at {webhook_url.rstrip('/')}{webhook_path}. Receiving updates.")
+        else:
+            # ✅ Start polling
+            await app.bot.delete_webhook(drop_pending_updates=True)
+            logger.info("Deleted webhook. Starting polling...")
 
-    # 🔧 Add health check endpoint for Koyeb
-    async def health_check(request):
-        return web.Response(text="OK")
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info("Bot is now polling Telegram for updates.")
 
-    # Create and start the web server
-    web_app = web.Application()
-    web_app.router.add_get("/", health_check)
-    web_app.router.add_get("/health", health_check)
-    
-    # Start the web server
-    runner = web.AppRunner(web_app)
-    await runner.setup()
-    
-    port = int(os.getenv('PORT', 8080))
-    site = web.TCPSite(runner, '0.0.0.0', port)
-    await site.start()
-    logger.info(f"Web server started on port {port}")
-
-    # ✅ Start polling
-    await app.bot.delete_webhook(drop_pending_updates=True)
-    logger.info("Deleted webhook. Starting polling...")
-
-    await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
-    logger.info("Bot is now polling Telegram for updates.")
-
-    stop_event = asyncio.Event()
-    try:
+        stop_event = asyncio.Event()
         await stop_event.wait()
     except (KeyboardInterrupt, SystemExit):
         logger.info("Shutdown signal received.")
     finally:
         logger.info("Stopping poller and shutting down application...")
-        await app.updater.stop()
-        await app.stop()
-        await app.shutdown()
-        await runner.cleanup()
+        if ingestor: await ingestor.stop()
+        if app:
+            if app.updater and app.updater.running: await app.updater.stop()
+            await support_bot.notifications.stop()
+            if app.running: await app.stop()
+            await app.shutdown()
+        if loop_lag: await loop_lag.stop()
+        if runner: await runner.cleanup()
+        await support_bot.close()
         logger.info("Application shut down gracefully.")
 
 
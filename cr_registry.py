@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+CR_PREFIX = "CR"
+_MAX_CR_NUMBER = 0xFFFFFFFF  # array('I') holds unsigned 32-bit values
+MARKER_KEY = "cr_registry"
+
+
+def _cr_digits(value) -> str | None:
+    value = str(value).strip().upper()
+    if not value.startswith(CR_PREFIX):
+        return None
+    digits = value[len(CR_PREFIX):]
+    if not (digits.isascii() and digits.isdigit()):  # isdigit() alone accepts "²" and "①", which int() rejects
+        return None
+    return digits
+
+
+def parse_cr_number(value) -> int | None:
+    """Return the numeric part of a CR number like 'CR5499637', or None if it isn't one.
+
+    Leading zeros are ignored, so 'CR0123' and 'CR123' are the same number.
+    """
+    digits = _cr_digits(value)
+    if digits is None:
+        return None
+    number = int(digits)
+    return number if number <= _MAX_CR_NUMBER else None
+
+
+def build_index(values) -> array:
+    """Build the sorted, de-duplicated array('I') used for lookups"""
+    numbers = set()
+    skipped = 0
+    normalised = []
+    for value in values:
+        digits = _cr_digits(value)
+        number = int(digits) if digits is not None else None
+        if number is None or number > _MAX_CR_NUMBER:
+            skipped += 1
+            continue
+        if len(digits) > 1 and digits[0] == "0":
+            normalised.append(value)
+        numbers.add(number)
+    if skipped:
+        logger.warning(f"Skipped {skipped} malformed CR numbers while building the registry")
+    if normalised:
+        logger.warning(f"{len(normalised)} CR numbers had leading zeros and were loaded without them, "
+                       f"e.g. {', '.join(str(v) for v in normalised[:5])}")
+    return array('I', sorted(numbers))
+
+
+class FileCRSource:
+    """Reads CR numbers from a text file, one per line; '#' starts a comment"""
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+
+    def describe(self):
+        return f"file:{self.path}"
+
+    async def changed(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        return mtime != self._mtime
+
+    def _read(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, encoding="utf-8") as f:
+            values = [line.split("#", 1)[0].strip() for line in f]
+        return mtime, [v for v in values if v]
+
+    async def load(self):
+        mtime, values = await asyncio.to_thread(self._read)
+        self._mtime = mtime
+        return values
+
+
+class MongoCRSource:
+    """Reads CR numbers from a MongoDB collection of {"cr_number": "CR..."} documents"""
+
+    def __init__(self, collection, batch_size=5000):
+        self.collection = collection
+        self.batch_size = batch_size
+
+    def describe(self):
+        return f"mongo:{self.collection.name}"
+
+    async def changed(self) -> bool:
+        # Cheap enough to just reload on every interval; the swap is atomic either way
+        return True
+
+    async def load(self):
+        values = []
+        cursor = self.collection.find({}, {"cr_number": 1, "_id": 0}, batch_size=self.batch_size)
+        async for doc in cursor:
+            if doc.get("cr_number"):
+                values.append(doc["cr_number"])
+        return values
+
+
+class CRRegistry:
+    """Set of affiliated CR numbers stored as a sorted array('I') and searched with bisect.
+
+    Reloads build a fresh array off to the side and swap the reference in one
+    assignment, so lookups never block and never see a half-built index.
+
+    When several processes share the sources, give them all the same `marker`
+    collection and make all but one `follow`: the leader reloads every
+    reload_interval and bumps the marker's version when the numbers changed,
+    and followers only reload (from the sources) when that version moves.
+    """
+
+    def __init__(self, sources, reload_interval: float = 300, marker=None, follow: bool = False):
+        self.sources = list(sources)
+        self.reload_interval = reload_interval
+        self.marker = marker
+        self.follow = follow and marker is not None
+        self._numbers = array('I')
+        self._version = None  # marker version of the loaded numbers (followers)
+        self._task = None
+        self.last_loaded_at = None
+
+    def __contains__(self, cr_number) -> bool:
+        number = parse_cr_number(cr_number)
+        if number is None:
+            return False
+        numbers = self._numbers  # take one reference so a concurrent swap can't affect this lookup
+        i = bisect_left(numbers, number)
+        return i < len(numbers) and numbers[i] == number
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def memory_usage(self) -> int:
+        """Approximate bytes used by the lookup index"""
+        return sys.getsizeof(self._numbers)
+
+    def stats(self) -> dict:
+        return {
+            "count": len(self._numbers),
+            "memory_bytes": self.memory_usage(),
+            "sources": [source.describe() for source in self.sources],
+            "last_loaded_at": self.last_loaded_at,
+        }
+
+    async def _marker_version(self):
+        doc = await self.marker.find_one({"_id": MARKER_KEY})
+        return doc["version"] if doc else None
+
+    async def reload(self, force: bool = False) -> bool:
+        """Rebuild the index from all sources; keeps the current index if any source fails"""
+        version = None
+        if self.follow:
+            version = await self._marker_version()  # read first, so a bump during the load is seen next time
+            if not force and version == self._version:
+                return False
+        elif not force:
+            changed = await asyncio.gather(*(source.changed() for source in self.sources))
+            if not any(changed):
+                return False
+        try:
+            loaded = await asyncio.gather(*(source.load() for source in self.sources))
+        except Exception as e:
+            logger.error(f"CR registry reload failed, keeping {len(self._numbers)} numbers loaded previously: {e}")
+            return False
+        numbers = await asyncio.to_thread(build_index, (value for values in loaded for value in values))
+        if self.marker is not None and not self.follow and numbers != self._numbers:
+            await self.marker.update_one({"_id": MARKER_KEY}, {"$inc": {"version": 1}}, upsert=True)
+        self._numbers = numbers
+        self._version = version
+        self.last_loaded_at = datetime.now(timezone.utc)
+        logger.info(f"CR registry loaded {len(numbers)} numbers ({self.memory_usage() / 1024:.1f} KiB) from {', '.join(s.describe() for s in self.sources)}")
+        return True
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"CR registry background reload error: {e}")
+
+    def start(self):
+        """Start reloading in the background every reload_interval seconds"""
+        if self._task is None and self.reload_interval > 0:
+            self._task = asyncio.create_task(self._reload_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
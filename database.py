@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from metrics import MongoCommandMetrics, registry
+
+logger = logging.getLogger(__name__)
+
+POOL_CHECKOUT_SECONDS = registry.histogram("bot_mongo_pool_checkout_seconds", "Time spent waiting for a pooled MongoDB connection",
+                                           buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+POOL_CHECKOUT_FAILURES = registry.counter("bot_mongo_pool_checkout_failures_total", "Connection checkouts that failed", ("reason",))
+
+# Client option -> (environment variable, default)
+POOL_SETTINGS = {
+    "maxPoolSize": ("MONGO_MAX_POOL_SIZE", 100),
+    "minPoolSize": ("MONGO_MIN_POOL_SIZE", 10),
+    "maxIdleTimeMS": ("MONGO_MAX_IDLE_MS", 300_000),
+    "maxConnecting": ("MONGO_MAX_CONNECTING", 4),
+    "waitQueueTimeoutMS": ("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5_000),
+    "connectTimeoutMS": ("MONGO_CONNECT_TIMEOUT_MS", 5_000),
+    "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10_000),
+    "socketTimeoutMS": ("MONGO_SOCKET_TIMEOUT_MS", 20_000),
+}
+
+
+def pool_options(environ=None) -> dict:
+    """Client pool and timeout options from the MONGO_* environment variables (see POOL_SETTINGS)"""
+    environ = os.environ if environ is None else environ
+    return {option: int(environ.get(variable, default)) for option, (variable, default) in POOL_SETTINGS.items()}
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """pymongo pool listener counting open, checked-out and waiting connections per server.
+
+    Motor runs pymongo on executor threads, so the counts are kept under a lock,
+    and a checkout's wait is timed on the thread that makes it.
+    """
+
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pools = {}  # "host:port" -> {"open": n, "in_use": n, "waiting": n}
+        registry.gauge("bot_mongo_pool_connections", "Pooled MongoDB connections by server and state",
+                       self._gauge, ("address", "state"))
+        registry.gauge("bot_mongo_pool_utilization", "Checked-out connections as a share of maxPoolSize, by server",
+                       lambda: {address: pool["utilization"] for address, pool in self.stats().items()}, ("address",))
+
+    def _add(self, address, **deltas):
+        key = f"{address[0]}:{address[1]}"
+        with self._lock:
+            pool = self._pools.setdefault(key, {"open": 0, "in_use": 0, "waiting": 0})
+            for state, delta in deltas.items():
+                pool[state] += delta
+
+    def _gauge(self) -> dict:
+        return {(address, state): value for address, pool in self.stats().items()
+                for state, value in pool.items() if state != "utilization"}
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = {address: dict(pool) for address, pool in self._pools.items()}
+        for pool in pools.values():
+            pool["utilization"] = round(pool["in_use"] / self.max_pool_size, 3) if self.max_pool_size else 0
+        return pools
+
+    def open_connections(self) -> int:
+        return sum(pool["open"] for pool in self.stats().values())
+
+    # --- listener events ---
+    def pool_created(self, event):
+        self._add(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self._add(event.address, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(event.address, open=-1)
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        self._add(event.address, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(event.address, waiting=-1)
+        POOL_CHECKOUT_FAILURES.inc_threadsafe(str(event.reason))
+
+    def connection_checked_out(self, event):
+        self._add(event.address, waiting=-1, in_use=1)
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            POOL_CHECKOUT_SECONDS.observe_threadsafe(time.perf_counter() - started)
+
+    def connection_checked_in(self, event):
+        self._add(event.address, in_use=-1)
+
+
+class MongoDatabase:
+    """The bot's MongoDB client: a tuned, instrumented pool plus startup helpers.
+
+    Pool size and timeouts come from pool_options() unless `options` overrides
+    them. Commands are timed by MongoCommandMetrics and the pool is watched by
+    PoolMonitor, so /metrics and stats() show how busy it is.
+
+    warm_up() opens connections before the first update arrives. migrate() runs
+    index steps concurrently and records the version it applied, so later
+    boots skip index creation.
+    """
+
+    def __init__(self, uri: str, name: str, options: dict | None = None):
+        self.options = {**pool_options(), **(options or {})}
+        self.pool = PoolMonitor(self.options["maxPoolSize"])
+        self.client = AsyncIOMotorClient(uri, event_listeners=[MongoCommandMetrics(), self.pool], **self.options)
+        self.db = self.client[name]
+        self.migrations = self.db.migrations
+
+    async def warm_up(self, connections: int | None = None, timeout: float = 10):
+        """Open `connections` pooled connections (default minPoolSize) with concurrent pings"""
+        connections = self.options["minPoolSize"] if connections is None else connections
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self.client.admin.command("ping") for _ in range(max(1, connections)))), timeout)
+        except Exception as e:
+            logger.warning(f"MongoDB warm-up incomplete: {e}")
+            return
+        logger.info(f"MongoDB pool warmed up: {self.pool.open_connections()} connections in {time.perf_counter() - started:.2f}s")
+
+    async def migrate(self, version: int, steps: dict, name: str = "indexes") -> bool:
+        """Run `steps` (name -> coroutine function) concurrently unless `version` already covers them.
+
+        Every step must be idempotent (create_index is): two processes booting
+        at once both run them. The record only moves forward, and a step added
+        without bumping `version` still runs once. Steps that depend on
+        configuration carry it in their name ("state:mongo"), so changing the
+        configuration counts as a new step. Returns whether anything ran.
+        """
+        record = await self.migrations.find_one({"_id": name}) or {}
+        if record.get("version", 0) >= version and set(steps) <= set(record.get("steps", [])):
+            logger.info(f"Migration '{name}' is at version {record['version']}; skipping")
+            return False
+        started = time.perf_counter()
+        results = await asyncio.gather(*(step() for step in steps.values()), return_exceptions=True)
+        failures = [(step, result) for step, result in zip(steps, results) if isinstance(result, Exception)]
+        for step, error in failures:
+            logger.error(f"Migration '{name}' step '{step}' failed: {error}")
+        if failures:
+            raise failures[0][1]
+        await self.migrations.update_one({"_id": name}, {
+            "$max": {"version": version}, "$addToSet": {"steps": {"$each": list(steps)}},
+            "$set": {"applied_at": datetime.now(timezone.utc)}}, upsert=True)
+        logger.info(f"Migration '{name}' version {version} applied ({len(steps)} steps) in {time.perf_counter() - started:.2f}s")
+        return True
+
+    def stats(self) -> dict:
+        return {"options": self.options, "pools": self.pool.stats()}
+
+    def close(self):
+        self.client.close()
+
+
+def index_step(collection, *indexes):
+    """A migration step creating `indexes` (pymongo IndexModels) on `collection` in one command"""
+    async def step():
+        await collection.create_indexes(list(indexes))
+    return step
@@ -0,0 +1,107 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryService:
+    """Runs a callback when a key's deadline passes, from one background task.
+
+    Deadlines sit in a heap. Rescheduling or cancelling a key only updates the
+    key -> deadline map; the outdated heap entry is skipped when it surfaces, and
+    the heap is rebuilt whenever such dead entries outnumber live ones, so every
+    operation stays amortized O(log n) and memory stays proportional to live keys.
+
+    Keys are tuples whose first element names the kind of entry (for example
+    ("state:pending_connections", group_id)); live counts are kept per kind.
+    """
+
+    def __init__(self, max_sleep: float = 1.0):
+        self.max_sleep = max_sleep
+        self._heap = []
+        self._deadlines = {}  # key -> (deadline, callback)
+        self._live_by_kind = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.expired_total = 0
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _count(self, key, delta: int):
+        kind = key[0]
+        self._live_by_kind[kind] = self._live_by_kind.get(kind, 0) + delta
+
+    def schedule(self, key: tuple, ttl: float, callback):
+        """Call callback() once `ttl` seconds from now, replacing any earlier schedule for key"""
+        deadline = time.monotonic() + ttl
+        if key not in self._deadlines:
+            self._count(key, 1)
+        self._deadlines[key] = (deadline, callback)
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        self._maybe_compact()
+        if earliest is None or deadline < earliest:
+            self._wakeup.set()
+
+    def cancel(self, key: tuple):
+        if self._deadlines.pop(key, None) is not None:
+            self._count(key, -1)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(deadline, next(self._seq), key) for key, (deadline, _cb) in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def sweep(self) -> int:
+        """Expire everything whose deadline has passed; returns how many callbacks ran"""
+        now = time.monotonic()
+        expired = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _seq, key = heapq.heappop(self._heap)
+            current = self._deadlines.get(key)
+            if current is None or current[0] != deadline:
+                continue  # rescheduled or cancelled since this entry was pushed
+            del self._deadlines[key]
+            self._count(key, -1)
+            expired += 1
+            try:
+                current[1]()
+            except Exception as e:
+                logger.error(f"Expiry callback for {key} failed: {e}")
+        self.expired_total += expired
+        return expired
+
+    def stats(self) -> dict:
+        return {"live": len(self._deadlines), "heap_size": len(self._heap), "expired_total": self.expired_total,
+                "live_by_kind": {kind: n for kind, n in self._live_by_kind.items() if n}}
+
+    async def _run(self):
+        while True:
+            self.sweep()
+            delay = self.max_sleep
+            if self._heap:
+                delay = min(delay, max(0.0, self._heap[0][0] - time.monotonic()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from outbound import LOW
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeliveryReport:
+    """Outcome of broadcasting one ticket to the support groups"""
+    ticket_id: str
+    delivered: list = field(default_factory=list)  # group_ids that received the ticket
+    failed: dict = field(default_factory=dict)  # group_id -> error message
+    elapsed: float = 0.0
+
+    @property
+    def attempted(self) -> int:
+        return len(self.delivered) + len(self.failed)
+
+
+class TicketFanout:
+    """Sends a ticket card to every support group concurrently.
+
+    At most `max_concurrency` sends are in flight. Pacing and RetryAfter retries
+    are left to the application's OutboundScheduler; fan-out sends go at LOW
+    priority so they queue behind replies to users and agents' edits. The groups
+    that received the ticket are reported to `counters` (a TicketCounters) once
+    all sends have finished.
+    """
+
+    def __init__(self, counters, max_concurrency: int = 10):
+        self.counters = counters
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _send_one(self, bot, group, text, reply_markup, parse_mode):
+        async with self._semaphore:
+            await bot.send_message(chat_id=group["group_id"], text=text, reply_markup=reply_markup, parse_mode=parse_mode,
+                                   rate_limit_args={"priority": LOW})
+
+    async def broadcast(self, bot, ticket_id, groups, text, reply_markup=None, parse_mode='Markdown') -> DeliveryReport:
+        """Send `text` to every group and return a per-group DeliveryReport"""
+        report = DeliveryReport(ticket_id=ticket_id)
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(self._send_one(bot, group, text, reply_markup, parse_mode) for group in groups),
+            return_exceptions=True,
+        )
+        for group, result in zip(groups, results):
+            if isinstance(result, BaseException):
+                report.failed[group["group_id"]] = str(result)
+                logger.error(f"Failed to forward ticket {ticket_id} to group {group.get('group_name')} ({group['group_id']}): {result}")
+            else:
+                report.delivered.append(group["group_id"])
+        self.counters.forwarded(ticket_id, report.delivered)
+
+        report.elapsed = time.perf_counter() - started
+        logger.info(f"Ticket {ticket_id} forwarded to {len(report.delivered)}/{report.attempted} groups in {report.elapsed:.2f}s")
+        return report
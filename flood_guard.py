@@ -0,0 +1,131 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+THROTTLED_UPDATES = registry.counter("bot_throttled_updates_total", "Private messages dropped by the flood guard", ("kind",))
+
+DEFAULT_LIMITS = {"text": 20, "photo": 5}  # messages per window
+
+
+class _Window:
+    """Sliding-window counter for one user and kind: this fixed window's count plus the previous one's"""
+    __slots__ = ("index", "current", "previous", "warned")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.current = 0
+        self.previous = 0
+        self.warned = False
+
+    def roll(self, index: int):
+        self.previous = self.current if index == self.index + 1 else 0
+        self.current = 0
+        self.index = index
+        self.warned = False
+
+
+class FloodGuard:
+    """Per-user rate limit on private text messages and photos, applied before any other handler.
+
+    A TypeHandler in group -2 runs ahead of UserDataSync (group -1) and the bot's
+    handlers. A user over the limit has the update dropped with
+    ApplicationHandlerStop, so it costs no state load, KB search or ticket write.
+    The user is told once per window.
+
+    Limits are `limits[kind]` messages per `window` seconds. The count is a
+    sliding-window estimate: the previous fixed window's count weighted by how
+    much of it still overlaps, plus the current one's. That takes a few integers
+    per user, and users idle for two windows are pruned.
+
+    With `shared` (a collection), a message that passes the local check is also
+    counted in MongoDB, in fixed windows, so the limit holds across bot
+    processes. That costs one round trip per allowed message; dropped messages
+    never reach the database.
+    """
+
+    def __init__(self, limits: dict | None = None, window: float = 60.0, shared=None,
+                 warning: str = "⏳ You're sending messages too quickly. Please wait a moment and try again."):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.window = window
+        self.shared = shared
+        self.warning = warning
+        self._windows = {}  # (kind, user_id) -> _Window
+        self._next_prune = time.monotonic() + window
+        self.throttled = {kind: 0 for kind in self.limits}
+        registry.gauge("bot_flood_throttled_users", "Users currently over a flood limit", self.throttled_users)
+
+    async def ensure_indexes(self):
+        if self.shared is not None:
+            await self.shared.create_index("expires_at", expireAfterSeconds=0)
+
+    def allow(self, kind: str, user_id: int, now: float | None = None) -> bool:
+        """Count a message from `user_id` if it is within the limit; False if it is over"""
+        now = time.monotonic() if now is None else now
+        if now >= self._next_prune:
+            self._prune(now)
+        index = int(now // self.window)
+        state = self._windows.get((kind, user_id))
+        if state is None:
+            state = self._windows[(kind, user_id)] = _Window(index)
+        elif state.index != index:
+            state.roll(index)
+        overlap = 1.0 - (now % self.window) / self.window
+        if state.previous * overlap + state.current >= self.limits[kind]:
+            return False
+        state.current += 1
+        return True
+
+    def _prune(self, now: float):
+        oldest = int(now // self.window) - 1
+        for key in [key for key, state in self._windows.items() if state.index < oldest]:
+            del self._windows[key]
+        self._next_prune = now + self.window
+
+    async def _allow_shared(self, kind: str, user_id: int) -> bool:
+        index = int(time.time() // self.window)
+        doc = await self.shared.find_one_and_update(
+            {"_id": f"{kind}:{user_id}:{index}"},
+            {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=2 * self.window)}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        return doc["count"] <= self.limits[kind]
+
+    async def check(self, update: Update, context):
+        message = update.message
+        user = update.effective_user
+        if message is None or user is None or message.chat.type != "private":
+            return
+        kind = "photo" if message.photo else "text"
+        if self.allow(kind, user.id):
+            try:
+                if self.shared is None or await self._allow_shared(kind, user.id):
+                    return
+            except Exception as e:
+                logger.error(f"Shared flood counter unavailable, using the local limit only: {e}")
+                return
+        self.throttled[kind] += 1
+        THROTTLED_UPDATES.inc(kind)
+        state = self._windows[(kind, user.id)]
+        if not state.warned:
+            state.warned = True
+            logger.info(f"Throttling {kind} from user {user.id}")
+            context.application.create_task(message.reply_text(self.warning))
+        raise ApplicationHandlerStop
+
+    def throttled_users(self) -> int:
+        index = int(time.monotonic() // self.window)
+        return sum(1 for state in self._windows.values() if state.warned and state.index == index)
+
+    def stats(self) -> dict:
+        return {"limits": self.limits, "window_s": self.window, "tracked": len(self._windows),
+                "throttled_users": self.throttled_users(), "throttled_updates": self.throttled}
+
+    def install(self, application):
+        application.add_handler(TypeHandler(Update, self.check), group=-2)
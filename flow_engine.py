@@ -0,0 +1,141 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RouteStats:
+    """Call count and latency for one route"""
+    __slots__ = ("calls", "errors", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed: float, failed: bool = False):
+        self.calls += 1
+        self.errors += failed
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self) -> dict:
+        return {"calls": self.calls, "errors": self.errors, "avg_ms": self.total / self.calls * 1000 if self.calls else 0.0, "max_ms": self.max * 1000}
+
+
+class FlowRouter:
+    """Dispatch table for callback buttons and multi-step conversation flows.
+
+    Callback data is resolved by an exact dict lookup, then by registered prefixes
+    such as "take_" (longest first, bounded by the most underscores any prefix
+    has), so dispatch cost does not grow with the number of routes. Text and photo
+    replies are routed by (flow, step) from context.user_data.
+
+    Every dispatch is timed per route; see stats(). If given, `observer(route,
+    elapsed, failed)` is also called after each dispatch (e.g. to feed metrics).
+    """
+
+    def __init__(self, flow_key: str = "vip_or_mentorship_flow", step_key: str = "current_step", observer=None):
+        self.flow_key = flow_key
+        self.step_key = step_key
+        self.observer = observer
+        self._exact = {}
+        self._prefixes = {}
+        self._prefix_depth = 0
+        self._steps = {}  # (kind, flow, step) -> handler
+        self._expected_callbacks = set()
+        self._declared_steps = set()  # (kind, flow, step) that some transition leads to
+        self._stats = {}
+
+    # --- registration ---
+    def callback(self, data: str, handler):
+        if data in self._exact:
+            raise ValueError(f"Duplicate callback route: {data}")
+        self._exact[data] = handler
+
+    def prefix(self, prefix: str, handler):
+        if not prefix.endswith("_"):
+            raise ValueError(f"Callback prefix must end with '_': {prefix}")
+        self._prefixes[prefix] = handler
+        self._prefix_depth = max(self._prefix_depth, prefix.count("_"))
+
+    def step(self, flow: str, step: str, handler, kind: str = "text"):
+        self._steps[(kind, flow, step)] = handler
+
+    def expect_callbacks(self, *datas):
+        """Declare callback data the bot's keyboards emit, checked by validate()"""
+        self._expected_callbacks.update(datas)
+
+    def expect_step(self, flow: str, step: str, kind: str = "text"):
+        """Declare a step some transition leads to that needs a reply handler, checked by validate()"""
+        self._declared_steps.add((kind, flow, step))
+
+    def validate(self):
+        """Raise ValueError if any declared button or step has no handler"""
+        missing = sorted(data for data in self._expected_callbacks if self.resolve(data)[0] is None)
+        missing_steps = sorted(f"{kind}:{flow}/{step}" for kind, flow, step in self._declared_steps if (kind, flow, step) not in self._steps)
+        if missing or missing_steps:
+            raise ValueError(f"Flow graph incomplete. Unrouted callbacks: {missing}; unhandled steps: {missing_steps}")
+        logger.info(f"Flow router validated: {len(self._exact)} callbacks, {len(self._prefixes)} prefixes, {len(self._steps)} steps")
+
+    # --- dispatch ---
+    def resolve(self, data: str):
+        """Return (handler, payload, route_name) for callback data, or (None, None, None)"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, None, data
+        # Try "a_b_" before "a_": only as many candidates as the deepest registered prefix
+        cuts = []
+        start = 0
+        for _ in range(self._prefix_depth):
+            i = data.find("_", start)
+            if i < 0:
+                break
+            cuts.append(i + 1)
+            start = i + 1
+        for cut in reversed(cuts):
+            handler = self._prefixes.get(data[:cut])
+            if handler is not None:
+                return handler, data[cut:], data[:cut]
+        return None, None, None
+
+    async def _timed(self, route: str, call):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await call
+        except Exception:
+            failed = True
+            raise
+        finally:
+            stats = self._stats.get(route)
+            if stats is None:
+                stats = self._stats[route] = RouteStats()
+            elapsed = time.perf_counter() - started
+            stats.record(elapsed, failed)
+            if self.observer is not None:
+                self.observer(route, elapsed, failed)
+
+    async def dispatch_callback(self, update, context) -> bool:
+        data = update.callback_query.data or ""
+        handler, payload, route = self.resolve(data)
+        if handler is None:
+            return False
+        call = handler(update, context) if payload is None else handler(update, context, payload)
+        await self._timed(f"callback:{route}", call)
+        return True
+
+    async def dispatch_step(self, update, context, kind: str = "text", *args) -> bool:
+        """Run the handler registered for the user's current (flow, step), if any"""
+        user_data = context.user_data
+        key = (kind, user_data.get(self.flow_key), user_data.get(self.step_key))
+        handler = self._steps.get(key)
+        if handler is None:
+            return False
+        await self._timed(f"{kind}:{key[1]}/{key[2]}", handler(update, context, *args))
+        return True
+
+    def stats(self) -> dict:
+        return {route: stats.as_dict() for route, stats in self._stats.items()}
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "support_groups:version"
+# Group fields callers of get_active() depend on; updates touching only others (ticket counters) keep the cache
+CACHED_FIELDS = ("status", "group_name")
+_WATCH_PIPELINE = [{"$match": {"$or": [
+    {"operationType": {"$ne": "update"}},  # insert, replace, delete, invalidate, ...
+    *({f"updateDescription.updatedFields.{field}": {"$exists": True}} for field in CACHED_FIELDS),
+    {"updateDescription.removedFields": {"$in": list(CACHED_FIELDS)}},
+]}}]
+
+
+class SupportGroupCache:
+    """In-process cache of active support groups.
+
+    Entries live for `ttl` seconds. Other replicas are kept in sync through a
+    version stamp in the counters collection, which invalidate() bumps and every
+    replica re-reads at most every `version_check_interval` seconds. When the
+    deployment is a replica set, watch() uses a change stream on `groups` instead
+    and the version polling is skipped. The stream is filtered server-side to
+    inserts, replaces, deletes and updates of CACHED_FIELDS, so the steady
+    stream of counter updates on group documents doesn't empty the cache.
+
+    The returned list is shared between callers and must not be modified.
+    """
+
+    def __init__(self, db, ttl: float = 300, version_check_interval: float = 5):
+        self.db = db
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self._groups = None
+        self._version = None
+        self._expires_at = 0.0
+        self._version_checked_at = 0.0
+        self._generation = 0  # bumped by every local expiry, so a load that raced one is not trusted
+        self._lock = asyncio.Lock()
+        self._watch_task = None
+        self._watching = False
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached_groups": len(self._groups) if self._groups is not None else 0,
+            "version": self._version,
+            "change_stream": self._watching,
+        }
+
+    async def _read_version(self):
+        doc = await self.db.counters.find_one({"_id": VERSION_KEY}, {"seq": 1})
+        return doc["seq"] if doc else 0
+
+    def _expire_local(self):
+        self._expires_at = 0.0
+        self._generation += 1
+
+    async def _load(self):
+        generation = self._generation
+        version = await self._read_version()
+        groups = await self.db.groups.find({"status": "active"}).to_list(length=None)
+        now = time.monotonic()
+        self._groups, self._version = groups, version
+        # An invalidation that arrived mid-load may postdate what we read: serve it to this caller only
+        self._expires_at = now + self.ttl if generation == self._generation else 0.0
+        self._version_checked_at = now
+
+    async def get_active(self) -> list:
+        """Return the active support groups, hitting MongoDB only when the cache is stale"""
+        now = time.monotonic()
+        if self._groups is not None and now < self._expires_at:
+            if self._watching or now - self._version_checked_at < self.version_check_interval:
+                self.hits += 1
+                return self._groups
+            self._version_checked_at = now
+            if await self._read_version() == self._version:
+                self.hits += 1
+                return self._groups
+            self._expire_local()
+
+        async with self._lock:
+            # Another caller may have refreshed the cache while we waited for the lock
+            if self._groups is None or time.monotonic() >= self._expires_at:
+                self.misses += 1
+                await self._load()
+            else:
+                self.hits += 1
+            return self._groups
+
+    async def invalidate(self):
+        """Drop the local copy and tell other replicas the group set changed"""
+        self._expire_local()
+        try:
+            await self.db.counters.update_one({"_id": VERSION_KEY}, {"$inc": {"seq": 1}}, upsert=True)
+        except Exception as e:
+            logger.error(f"Failed to bump support group cache version: {e}")
+
+    async def _watch(self):
+        try:
+            async with self.db.groups.watch(_WATCH_PIPELINE) as stream:
+                self._watching = True
+                logger.info("Support group cache is following the groups change stream")
+                async for _change in stream:
+                    self._expire_local()
+        except OperationFailure as e:
+            # Standalone servers have no change streams; version polling covers us instead
+            logger.info(f"Change streams unavailable, support group cache will poll its version stamp: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Support group change stream stopped, falling back to version polling: {e}")
+        finally:
+            self._watching = False
+            self._expire_local()
+
+    def watch(self):
+        """Start following the groups change stream in the background, if the server supports it"""
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
@@ -0,0 +1,247 @@
+import asyncio
+import heapq
+import logging
+import math
+import re
+from bisect import bisect_left, insort
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "can", "do", "does", "for", "how", "i", "in", "is", "it",
+    "me", "my", "of", "on", "or", "the", "to", "what", "when", "where", "why", "with", "you", "your",
+})
+# (suffix, replacement) pairs tried longest first; a deliberately light stemmer
+_SUFFIXES = (("ational", "ate"), ("ization", "ize"), ("fulness", "ful"), ("ings", ""), ("ing", ""),
+             ("ies", "y"), ("ied", "y"), ("edly", ""), ("ed", ""), ("ly", ""), ("es", ""), ("s", ""))
+
+QUESTION_WEIGHT = 2.0
+KEYWORD_WEIGHT = 1.5
+PREFIX_DISCOUNT = 0.5
+MAX_PREFIX_EXPANSIONS = 20
+
+
+def stem(word: str) -> str:
+    if len(word) <= 3:
+        return word
+    for suffix, replacement in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) + len(replacement) >= 3:
+            return word[: -len(suffix)] + replacement
+    return word
+
+
+def tokenize(text: str) -> list:
+    return [stem(t) for t in _TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def normalize_question(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class InvertedIndex:
+    """BM25-ranked inverted index over knowledge base questions and keywords.
+
+    Documents are keyed by their MongoDB _id and can be added, replaced or removed
+    one at a time, so the index follows KB edits without a full rebuild.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # doc_id -> KB document
+        self.postings = {}  # term -> {doc_id: weighted term frequency}
+        self.doc_lengths = {}  # doc_id -> weighted length
+        self.doc_terms = {}  # doc_id -> terms, so removals don't need the old document
+        self.exact = {}  # normalized question -> doc_id
+        self.terms = []  # sorted vocabulary for prefix lookups
+        self._total_length = 0.0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _weighted_terms(self, doc) -> dict:
+        weights = {}
+        for term in tokenize(doc.get("question") or ""):
+            weights[term] = weights.get(term, 0.0) + QUESTION_WEIGHT
+        for keyword in doc.get("keywords") or []:
+            for term in tokenize(str(keyword)):
+                weights[term] = weights.get(term, 0.0) + KEYWORD_WEIGHT
+        return weights
+
+    def add(self, doc):
+        doc_id = doc["_id"]
+        if doc_id in self.docs:
+            self.remove(doc_id)
+        weights = self._weighted_terms(doc)
+        for term, weight in weights.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                insort(self.terms, term)
+            postings[doc_id] = weight
+        length = sum(weights.values())
+        self.docs[doc_id] = doc
+        self.doc_lengths[doc_id] = length
+        self.doc_terms[doc_id] = tuple(weights)
+        self._total_length += length
+        if doc.get("question"):
+            self.exact[normalize_question(doc["question"])] = doc_id
+
+    def remove(self, doc_id):
+        doc = self.docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for term in self.doc_terms.pop(doc_id, ()):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+                i = bisect_left(self.terms, term)
+                if i < len(self.terms) and self.terms[i] == term:
+                    del self.terms[i]
+        self._total_length -= self.doc_lengths.pop(doc_id, 0.0)
+        question = normalize_question(doc.get("question") or "")
+        if self.exact.get(question) == doc_id:
+            del self.exact[question]
+
+    def _expand_prefix(self, prefix: str):
+        i = bisect_left(self.terms, prefix)
+        expanded = []
+        while i < len(self.terms) and len(expanded) < MAX_PREFIX_EXPANSIONS and self.terms[i].startswith(prefix):
+            if self.terms[i] != prefix:
+                expanded.append(self.terms[i])
+            i += 1
+        return expanded
+
+    def search(self, query: str, limit: int = 3) -> list:
+        """Return up to `limit` KB documents ranked by BM25, exact question matches first"""
+        exact_id = self.exact.get(normalize_question(query))
+        if exact_id is not None:
+            return [self.docs[exact_id]]
+        if not self.docs:
+            return []
+
+        # Raw words (unstemmed) drive prefix matching so "pass" still finds "password"
+        raw_words = [w for w in _TOKEN_RE.findall(query.lower()) if w not in STOPWORDS]
+        query_terms = {}
+        for word in raw_words:
+            term = stem(word)
+            query_terms[term] = max(query_terms.get(term, 0.0), 1.0)
+            if len(word) >= 3:
+                for expanded in self._expand_prefix(word):
+                    query_terms[expanded] = max(query_terms.get(expanded, 0.0), PREFIX_DISCOUNT)
+
+        n_docs = len(self.docs)
+        avg_length = self._total_length / n_docs if n_docs else 1.0
+        scores = {}
+        for term, query_weight in query_terms.items():
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + query_weight * idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [self.docs[doc_id] for doc_id, _score in best]
+
+
+class MongoTextSearch:
+    """Fallback backend using the knowledge_base $text index"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def search(self, query: str, limit: int = 3) -> list:
+        cursor = self.collection.find(
+            {"$text": {"$search": query}},
+            {"score": {"$meta": "textScore"}},
+        ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+        return await cursor.to_list(length=limit)
+
+
+class KnowledgeBaseSearch:
+    """Knowledge base search served from an in-memory InvertedIndex.
+
+    The index is loaded once, at startup or in the background by start(), and
+    then kept current from a change stream on the collection, or by periodic
+    reloads where change streams are unavailable. With backend="mongo", or until
+    the index has loaded, queries go to MongoDB's $text index instead.
+    """
+
+    def __init__(self, collection, backend: str = "memory", reload_interval: float = 300):
+        self.collection = collection
+        self.backend = backend
+        self.reload_interval = reload_interval
+        self.index = None
+        self.text_search = MongoTextSearch(collection)
+        self._task = None
+        self._loaded_at = None  # cluster time just before the last load; the change stream starts there
+
+    async def load(self):
+        reply = await self.collection.database.command("ping")
+        self._loaded_at = reply.get("operationTime")  # only replica sets (the ones with change streams) report it
+        index = InvertedIndex()
+        async for doc in self.collection.find({}):
+            index.add(doc)
+        self.index = index  # swap in one assignment so searches never see a partial index
+        logger.info(f"Knowledge base index built with {len(index)} entries and {len(index.terms)} terms")
+
+    async def search(self, query: str, limit: int = 3) -> list:
+        query = query.strip()
+        if not query:
+            return []
+        if self.backend == "mongo" or self.index is None:
+            return await self.text_search.search(query, limit)
+        return self.index.search(query, limit)
+
+    async def _follow_changes(self):
+        if self.index is None:
+            await self.load()  # started without a load (KB_PRELOAD=0)
+        # Starting at the load's cluster time replays anything written since, instead of loading twice
+        async with self.collection.watch(full_document="updateLookup", start_at_operation_time=self._loaded_at) as stream:
+            logger.info("Knowledge base index is following the change stream")
+            async for change in stream:
+                op = change["operationType"]
+                if op in ("insert", "update", "replace") and change.get("fullDocument"):
+                    self.index.add(change["fullDocument"])
+                elif op == "delete":
+                    self.index.remove(change["documentKey"]["_id"])
+                elif op in ("drop", "rename", "invalidate"):
+                    await self.load()
+
+    async def _run(self):
+        try:
+            await self._follow_changes()
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            logger.info(f"Change streams unavailable, reloading the knowledge base index every {self.reload_interval}s: {e}")
+        except Exception as e:
+            logger.error(f"Knowledge base change stream stopped, falling back to periodic reloads: {e}")
+        delay = 0 if self.index is None else self.reload_interval  # started without a load: build the index now
+        while self.reload_interval > 0:
+            await asyncio.sleep(delay)
+            delay = self.reload_interval
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Knowledge base index reload failed: {e}")
+
+    def start(self):
+        if self._task is None and self.backend != "mongo":
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,289 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from collections import deque
+
+from pymongo import monitoring
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per label tuple.
+
+    observe() is meant for the event loop thread and takes no lock; code running
+    on other threads (pymongo listeners) uses observe_threadsafe(), which queues
+    the sample on a deque that is folded in at scrape time.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._pending = deque()  # observations recorded from other threads
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def observe_threadsafe(self, value: float, *labels):
+        self._pending.append((value, labels))
+
+    def samples(self):
+        while self._pending:
+            value, labels = self._pending.popleft()
+            self.observe(value, *labels)
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield f"{self.name}_bucket", self.labelnames + ("le",), labels + (bound,), cumulative
+            yield f"{self.name}_sum", self.labelnames, labels, series[-1]
+            yield f"{self.name}_count", self.labelnames, labels, cumulative
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._pending = deque()
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def inc_threadsafe(self, *labels, amount: float = 1):
+        self._pending.append((labels, amount))
+
+    def samples(self):
+        while self._pending:
+            labels, amount = self._pending.popleft()
+            self.inc(*labels, amount=amount)
+        for labels, value in self._values.items():
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge:
+    """A value read at scrape time from `source()`: a number, or a dict of label values -> number"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, source, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.source = source
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        try:
+            value = self.source()
+        except Exception as e:
+            logger.error(f"Gauge {self.name} failed: {e}")
+            return
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                yield self.name, self.labelnames, labels, v
+        else:
+            yield self.name, (), (), value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._federated = None
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, source, labelnames=()) -> Gauge:
+        """Register a gauge; registering the same name again replaces its source"""
+        self._metrics.pop(name, None)
+        return self._register(Gauge(name, documentation, source, labelnames))
+
+    def snapshot(self) -> dict:
+        """Every metric's current samples as JSON-serialisable data, for render() in another process"""
+        return {metric.name: {"type": metric.kind, "help": metric.documentation,
+                              "samples": [list(sample) for sample in metric.samples()]}
+                for metric in self._metrics.values()}
+
+    def federate(self, source, label: str):
+        """Render the snapshots returned by `source()` ({label value: snapshot()}) along with our own metrics.
+
+        Their samples get a `label` label (e.g. shard="2"), so series from different processes stay apart.
+        """
+        self._federated = (source, label)
+
+    def render(self) -> str:
+        families = {metric.name: (metric.kind, metric.documentation, list(metric.samples()))
+                    for metric in self._metrics.values()}
+        if self._federated:
+            source, label = self._federated
+            try:
+                snapshots = source()
+            except Exception as e:
+                logger.error(f"Federated metrics source failed: {e}")
+                snapshots = {}
+            for value, snapshot in snapshots.items():
+                for name, family in snapshot.items():
+                    samples = families.setdefault(name, (family["type"], family["help"], []))[2]
+                    samples.extend((sample, (label, *names), (value, *values), v)
+                                   for sample, names, values, v in family["samples"])
+        lines = []
+        for name, (kind, documentation, samples) in families.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample, names, values, value in samples:
+                lines.append(f"{sample}{_labels(names, values)} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        from aiohttp import web  # imported here so processes without a web server never load aiohttp
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    def install(self, web_app, path: str = "/metrics"):
+        web_app.router.add_get(path, self.handle)
+
+
+registry = MetricsRegistry()
+
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Time spent in update handlers and flow routes", ("handler",))
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Update handlers that raised", ("handler",))
+MONGO_SECONDS = registry.histogram("bot_mongo_command_seconds", "MongoDB command round trips", ("collection", "command"))
+MONGO_ERRORS = registry.counter("bot_mongo_command_errors_total", "Failed MongoDB commands", ("collection", "command"))
+TELEGRAM_SECONDS = registry.histogram("bot_telegram_request_seconds", "Telegram Bot API call latency", ("method",))
+TELEGRAM_ERRORS = registry.counter("bot_telegram_request_errors_total", "Telegram Bot API calls that failed or returned an error status", ("method",))
+LOOP_LAG_SECONDS = registry.histogram("bot_event_loop_lag_seconds", "How late the event loop woke a periodic timer",
+                                      buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+def observe_handler(name: str, elapsed: float, failed: bool = False):
+    HANDLER_SECONDS.observe(elapsed, name)
+    if failed:
+        HANDLER_ERRORS.inc(name)
+
+
+def instrument(name: str, handler):
+    """Wrap an async PTB callback so its latency is recorded under `name`"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(update, context)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_handler(name, time.perf_counter() - started, failed)
+    return wrapper
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo command listener timing commands per collection; pass via event_listeners="""
+
+    def __init__(self, collections=None):
+        self.collections = set(collections) if collections else None
+        self._inflight = {}  # request_id -> collection
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection")  # getMore
+        if isinstance(collection, str) and (self.collections is None or collection in self.collections):
+            self._inflight[event.request_id] = collection
+
+    def succeeded(self, event):
+        collection = self._inflight.pop(event.request_id, None)
+        if collection is not None:
+            MONGO_SECONDS.observe_threadsafe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event):
+        collection = self._inflight.pop(event.request_id, None)
+        if collection is not None:
+            MONGO_SECONDS.observe_threadsafe(event.duration_micros / 1e6, collection, event.command_name)
+            MONGO_ERRORS.inc_threadsafe(collection, event.command_name)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call; use with Application.builder().request(...)"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            TELEGRAM_ERRORS.inc(api_method)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(api_method)
+        return code, payload
+
+
+class LoopLagMonitor:
+    """Measures how late a `interval`-second sleep wakes up, i.e. how long callbacks hog the loop"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last_lag = 0.0
+        self._task = None
+        registry.gauge("bot_event_loop_lag_last_seconds", "Most recent event loop lag sample", lambda: self.last_lag)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - started - self.interval)
+            LOOP_LAG_SECONDS.observe(self.last_lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
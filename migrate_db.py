@@ -0,0 +1,247 @@
+"""Copy bot (2).py's support_bot database into tetttt.py's support_bot_new.
+
+    python migrate_db.py                                   # everything, on MONGODB_URI
+    python migrate_db.py --collections tickets,ticket_messages --parallel 8 --pause 0.2
+    python migrate_db.py --dry-run                         # plan only, write nothing
+
+Collections are copied in _id order in batches of --batch-size. Up to
+--parallel batches are written at once, as unordered bulk upserts, and each
+such wave is checkpointed in the target's migration_checkpoints collection.
+An interrupted run picks up after the last finished wave; --restart starts a
+collection over.
+
+Every write is an upsert with $setOnInsert, so copying a document twice is a
+no-op and a document the live bot has changed since is never overwritten.
+That makes it safe to run, and re-run, against a deployment that is taking
+traffic. Batches are small and unordered, so no write holds locks for long;
+--pause spaces the waves out further.
+
+- groups merge on group_id; a group already in the target keeps its state.
+- knowledge_base entries merge on question.
+- tickets get the support_bot_new fields (ticket_type_custom from the
+  category, an empty flow_details) and a migrated_from record of where they
+  came from. A ticket whose ticket_id is already used in the target (both bots
+  number TKT-YYYYMMDD-NNNN per day) is renamed SB-<ticket_id>. The target's
+  ID counters are raised past the copied IDs so the live bot doesn't hand them
+  out again.
+- ticket_messages history buckets follow their ticket, renamed ID included.
+
+Afterwards the target's ticket counters are recomputed from the merged tickets:
+open counts per group and overall, and each group's tickets_forwarded, which
+is raised to cover the copied tickets that record the groups they went to
+(forwarded_to). Groups that already existed keep their own document, so
+forwards older than forwarded_to stay in the source's totals only.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import MongoDatabase
+from ticket_counters import TicketCounters
+from ticket_ids import counter_key, parse_ticket_id
+
+logger = logging.getLogger(__name__)
+
+COLLECTIONS = ("groups", "knowledge_base", "tickets", "ticket_messages")  # in dependency order
+RENAME_PREFIX = "SB"
+DUPLICATE_KEY = 11000
+
+
+def _fields(doc: dict) -> dict:
+    return {key: value for key, value in doc.items() if key != "_id"}
+
+
+def transform_ticket(doc: dict, source: str, rename: bool = False) -> dict:
+    """A support_bot ticket in the support_bot_new schema"""
+    ticket = dict(doc)
+    ticket.setdefault("ticket_type_custom", doc.get("category") or "Support Ticket")
+    ticket.setdefault("flow_details", {})
+    ticket["migrated_from"] = {"db": source, "ticket_id": doc["ticket_id"]}
+    if rename:
+        ticket["ticket_id"] = f"{RENAME_PREFIX}-{doc['ticket_id']}"
+    return ticket
+
+
+class Migrator:
+    """Copies COLLECTIONS from `source` to `target` (Motor databases); see the module docstring"""
+
+    def __init__(self, source, target, batch_size: int = 500, parallel: int = 4, pause: float = 0.0, dry_run: bool = False):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.parallel = max(1, parallel)
+        self.pause = pause
+        self.dry_run = dry_run
+        self.checkpoints = target.migration_checkpoints
+        self._plans = {"groups": self._group_ops, "knowledge_base": self._kb_ops,
+                       "tickets": self._ticket_ops, "ticket_messages": self._message_ops}
+
+    async def ensure_indexes(self):
+        await self.target.tickets.create_index([("migrated_from.db", 1), ("migrated_from.ticket_id", 1)], sparse=True)
+
+    # --- plans: (source doc, target write) pairs for one batch ---
+    async def _group_ops(self, batch: list) -> list:
+        return [(doc, UpdateOne({"group_id": doc["group_id"]}, {"$setOnInsert": _fields(doc)}, upsert=True)) for doc in batch]
+
+    async def _kb_ops(self, batch: list) -> list:
+        return [(doc, UpdateOne({"question": doc["question"]}, {"$setOnInsert": _fields(doc)}, upsert=True)) for doc in batch]
+
+    async def _ticket_ops(self, batch: list) -> list:
+        ids = [doc["_id"] for doc in batch]
+        copied = {doc["_id"] async for doc in self.target.tickets.find({"_id": {"$in": ids}}, {"_id": 1})}
+        fresh = [doc for doc in batch if doc["_id"] not in copied]
+        taken = {doc["ticket_id"] async for doc in self.target.tickets.find(
+            {"ticket_id": {"$in": [doc["ticket_id"] for doc in fresh]}}, {"ticket_id": 1})}
+        ops, highest = [], {}
+        for doc in fresh:
+            rename = doc["ticket_id"] in taken
+            if not rename and (parsed := parse_ticket_id(doc["ticket_id"])):
+                day, seq = parsed
+                highest[day] = max(seq, highest.get(day, 0))
+            ticket = transform_ticket(doc, self.source.name, rename)
+            ops.append((doc, UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": _fields(ticket)}, upsert=True)))
+        if highest and not self.dry_run:
+            # Same $max seeding TicketIdAllocator does, so the live bot allocates above the copied IDs
+            await self._write_ignoring_duplicates(self.target.counters, [
+                UpdateOne({"_id": counter_key(day)}, {"$max": {"seq": seq}}, upsert=True) for day, seq in highest.items()])
+        return ops
+
+    async def _message_ops(self, batch: list) -> list:
+        old_ids = list({doc["ticket_id"] for doc in batch})
+        renamed = {doc["migrated_from"]["ticket_id"]: doc["ticket_id"] async for doc in self.target.tickets.find(
+            {"migrated_from.db": self.source.name, "migrated_from.ticket_id": {"$in": old_ids}},
+            {"ticket_id": 1, "migrated_from.ticket_id": 1})}
+        ops = []
+        for doc in batch:
+            if doc["ticket_id"] not in renamed:
+                continue  # its ticket was never copied, so there is nothing to attach it to
+            ops.append((doc, UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": {**_fields(doc), "ticket_id": renamed[doc["ticket_id"]]}},
+                                       upsert=True)))
+        return ops
+
+    @staticmethod
+    async def _write_ignoring_duplicates(collection, ops: list):
+        try:
+            await collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                raise
+            await collection.bulk_write(ops, ordered=False)  # lost an upsert race; the document exists now
+
+    # --- copying ---
+    async def _write_batch(self, name: str, batch: list) -> Counter:
+        plan = self._plans[name]
+        counts = Counter(read=len(batch))
+        ops = await plan(batch)
+        for attempt in range(3):
+            if not ops or self.dry_run:
+                counts["planned"] += len(ops)
+                break
+            try:
+                result = await self.target[name].bulk_write([op for _, op in ops], ordered=False)
+                counts["copied"] += result.upserted_count
+                break
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                counts["copied"] += e.details.get("nUpserted", 0)
+                if attempt == 2 or any(error.get("code") != DUPLICATE_KEY for error in errors):
+                    raise
+                # A unique key (a ticket_id, usually) was taken between planning and writing,
+                # most likely by the live bot; plan those documents again
+                ops = await plan([ops[error["index"]][0] for error in errors])
+        return counts
+
+    async def migrate_collection(self, name: str, restart: bool = False) -> Counter:
+        key = f"{self.source.name}.{name}"
+        if restart:
+            await self.checkpoints.delete_one({"_id": key})
+        checkpoint = await self.checkpoints.find_one({"_id": key}) or {}
+        query = {"_id": {"$gt": checkpoint["last_id"]}} if "last_id" in checkpoint else {}
+        if checkpoint.get("last_id") is not None:
+            logger.info(f"{name}: resuming after {checkpoint['last_id']}")
+        totals = Counter()
+        started = time.perf_counter()
+
+        async def write_wave(wave):
+            results = await asyncio.gather(*(self._write_batch(name, batch) for batch in wave))
+            counts = sum(results, Counter())
+            totals.update(counts)
+            if not self.dry_run:
+                await self.checkpoints.update_one({"_id": key}, {
+                    "$set": {"last_id": wave[-1][-1]["_id"], "updated_at": datetime.now(timezone.utc)},
+                    "$inc": {f"counts.{field}": value for field, value in counts.items()}}, upsert=True)
+            elapsed = time.perf_counter() - started
+            logger.info(f"{name}: {totals['read']} read, {totals['copied']} copied in {elapsed:.1f}s "
+                        f"({totals['read'] / elapsed:.0f} docs/s)")
+            if self.pause:
+                await asyncio.sleep(self.pause)
+
+        wave, batch = [], []
+        async for doc in self.source[name].find(query).sort("_id", 1).batch_size(self.batch_size):
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                wave.append(batch)
+                batch = []
+                if len(wave) >= self.parallel:
+                    await write_wave(wave)
+                    wave = []
+        if batch:
+            wave.append(batch)
+        if wave:
+            await write_wave(wave)
+        return totals
+
+    async def run(self, collections=COLLECTIONS, restart: bool = False) -> dict:
+        if not self.dry_run:
+            await self.ensure_indexes()
+        summary = {}
+        for name in collections:
+            summary[name] = dict(await self.migrate_collection(name, restart))
+        if "tickets" in collections:
+            summary["tickets"]["renamed_total"] = await self.target.tickets.count_documents(
+                {"migrated_from.db": self.source.name, "ticket_id": {"$regex": f"^{RENAME_PREFIX}-"}})
+        if "tickets" in collections and not self.dry_run:
+            await TicketCounters(self.target).reconcile()
+            logger.info("Ticket counters recomputed from the merged tickets")
+        return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default=os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
+    parser.add_argument("--target-uri", help="if the target database lives elsewhere (default: --uri)")
+    parser.add_argument("--source", default="support_bot")
+    parser.add_argument("--target", default="support_bot_new")
+    parser.add_argument("--collections", default=",".join(COLLECTIONS))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--parallel", type=int, default=4, help="batches written at once")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to wait between waves")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints and start over")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    collections = [name for name in COLLECTIONS if name in args.collections.split(",")]
+    source = MongoDatabase(args.uri, args.source)
+    target = MongoDatabase(args.target_uri, args.target) if args.target_uri else None
+    try:
+        migrator = Migrator(source.db, (target or source).client[args.target], batch_size=args.batch_size,
+                            parallel=args.parallel, pause=args.pause, dry_run=args.dry_run)
+        summary = await migrator.run(collections, restart=args.restart)
+        for name, counts in summary.items():
+            logger.info(f"{name}: " + ", ".join(f"{field} {value}" for field, value in counts.items()))
+    finally:
+        source.close()
+        if target:
+            target.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(main())
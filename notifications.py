@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from telegram.error import BadRequest, Forbidden
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS_TOTAL = registry.counter("bot_notifications_total", "User notifications by outcome", ("outcome",))
+
+
+class NotificationOutbox:
+    """Durable outbox for messages to users, delivered in the background.
+
+    enqueue() costs one MongoDB upsert, and a dedupe key as the document _id
+    makes it idempotent. Callers such as the agent's Take/Close buttons
+    therefore return without waiting on Telegram, and a notification
+    enqueued twice (a retried callback, a second process) is sent once.
+
+    A delivery loop claims up to `batch_size` due notifications at a time with a
+    claim token, so several bot processes can share one outbox, and sends at
+    most `workers` of them at once. A claim is a lease: if a process dies
+    mid-batch, its notifications become due again after `lease` seconds, so
+    delivery is at least once.
+
+    Failed sends are retried with exponential backoff up to `max_attempts`
+    times. Forbidden (user blocked the bot) and BadRequest fail at once.
+    Finished notifications stay for `retention` seconds (TTL index) to dedupe
+    against.
+    """
+
+    def __init__(self, collection, workers: int = 4, batch_size: int = 50, poll_interval: float = 1.0,
+                 max_attempts: int = 5, lease: float = 120, retention: int = 7 * 86400):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = timedelta(seconds=lease)
+        self.retention = retention
+        self._semaphore = asyncio.Semaphore(max(1, workers))
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.bot = None
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("status", ASCENDING), ("next_attempt_at", ASCENDING)])
+        await self.collection.create_index("claim", sparse=True)
+        await self.collection.create_index("done_at", expireAfterSeconds=self.retention)
+
+    async def enqueue(self, key: str, chat_id: int, text: str, parse_mode: str | None = 'Markdown'):
+        """Record a message for `chat_id`; a second enqueue with the same `key` is a no-op"""
+        now = datetime.now(timezone.utc)
+        result = await self.collection.update_one({"_id": key}, {"$setOnInsert": {
+            "chat_id": chat_id, "text": text, "parse_mode": parse_mode, "status": "pending",
+            "attempts": 0, "created_at": now, "next_attempt_at": now}}, upsert=True)
+        if result.upserted_id is None:
+            NOTIFICATIONS_TOTAL.inc("deduplicated")
+            return
+        self._wakeup.set()
+
+    # --- delivery ---
+    async def _claim(self) -> list:
+        now = datetime.now(timezone.utc)
+        due = {"$or": [{"status": "pending", "next_attempt_at": {"$lte": now}},
+                       {"status": "sending", "locked_until": {"$lt": now}}]}  # lease of a dead process ran out
+        ids = [doc["_id"] for doc in await self.collection.find(due, {"_id": 1}).sort("created_at", ASCENDING).limit(self.batch_size).to_list(length=None)]
+        if not ids:
+            return []
+        claim = ObjectId()
+        await self.collection.update_many({"_id": {"$in": ids}, **due},
+                                          {"$set": {"status": "sending", "claim": claim, "locked_until": now + self.lease}})
+        return await self.collection.find({"claim": claim}).sort("created_at", ASCENDING).to_list(length=None)
+
+    async def _deliver(self, doc) -> UpdateOne:
+        """Send one notification and return the update recording the outcome"""
+        attempts = doc["attempts"] + 1
+        async with self._semaphore:
+            try:
+                await self.bot.send_message(chat_id=doc["chat_id"], text=doc["text"], parse_mode=doc.get("parse_mode"))
+            except (Forbidden, BadRequest) as e:
+                NOTIFICATIONS_TOTAL.inc("failed")
+                logger.warning(f"Notification {doc['_id']} to {doc['chat_id']} can't be delivered: {e}")
+                return self._finish(doc, "failed", attempts, str(e))
+            except Exception as e:
+                if attempts >= self.max_attempts:
+                    NOTIFICATIONS_TOTAL.inc("failed")
+                    logger.error(f"Notification {doc['_id']} to {doc['chat_id']} failed after {attempts} attempts: {e}")
+                    return self._finish(doc, "failed", attempts, str(e))
+                NOTIFICATIONS_TOTAL.inc("retried")
+                retry_at = datetime.now(timezone.utc) + timedelta(seconds=min(300, 2 ** attempts))
+                return UpdateOne({"_id": doc["_id"], "claim": doc["claim"]}, {
+                    "$set": {"status": "pending", "attempts": attempts, "next_attempt_at": retry_at, "last_error": str(e)},
+                    "$unset": {"claim": "", "locked_until": ""}})
+        NOTIFICATIONS_TOTAL.inc("sent")
+        return self._finish(doc, "sent", attempts)
+
+    @staticmethod
+    def _finish(doc, status: str, attempts: int, error: str | None = None) -> UpdateOne:
+        return UpdateOne({"_id": doc["_id"], "claim": doc["claim"]}, {
+            "$set": {"status": status, "attempts": attempts, "done_at": datetime.now(timezone.utc), "last_error": error},
+            "$unset": {"claim": "", "locked_until": "", "next_attempt_at": ""}})
+
+    async def run_once(self) -> int:
+        """Deliver one batch of due notifications; returns how many were attempted"""
+        batch = await self._claim()
+        if batch:
+            outcomes = await asyncio.gather(*(self._deliver(doc) for doc in batch))
+            await self.collection.bulk_write(outcomes, ordered=False)
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()  # before claiming, so an enqueue during the claim is not missed
+            try:
+                if await self.run_once():
+                    continue
+            except Exception as e:
+                logger.error(f"Notification delivery loop error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def stats(self) -> dict:
+        return {status: await self.collection.count_documents({"status": status}) for status in ("pending", "sending", "sent", "failed")}
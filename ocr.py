@@ -0,0 +1,145 @@
+import asyncio
+import importlib.util
+import io
+import logging
+import multiprocessing
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# OCR is optional; without it only captions are read. The modules are only imported
+# in the worker processes, so the bot process never pays for loading Pillow.
+OCR_AVAILABLE = importlib.util.find_spec("pytesseract") is not None and importlib.util.find_spec("PIL") is not None
+
+logger = logging.getLogger(__name__)
+
+_CAPTION_NUMBER = re.compile(r'\b\d+\.?\d*\b')
+# In OCR output only trust numbers next to a currency marker, not dates, times or ids
+_CURRENCY_AMOUNT = re.compile(r'(?:\$|USD\s*)\s*(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d{1,2}))?'
+                              r'|(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d{1,2}))?\s*(?:USD|\$)', re.IGNORECASE)
+
+
+def caption_amount(caption: str | None) -> float | None:
+    """First number in a photo caption, or None"""
+    if not caption:
+        return None
+    numbers = _CAPTION_NUMBER.findall(caption)
+    if not numbers:
+        return None
+    try:
+        return float(numbers[0])
+    except ValueError:
+        return None
+
+
+def text_amount(text: str) -> float | None:
+    """First currency-marked amount in OCR text, e.g. "$1,250.00" or "50 USD"; None if there is none"""
+    match = _CURRENCY_AMOUNT.search(text or "")
+    if not match:
+        return None
+    whole, cents = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+    return float(whole.replace(",", "") + (f".{cents}" if cents else ""))
+
+
+def _ocr_amount(image_bytes: bytes) -> float | None:
+    """Runs in a worker process: OCR the image and pull out the amount"""
+    import pytesseract
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return text_amount(pytesseract.image_to_string(image.convert("L")))
+
+
+class ScreenshotOCR:
+    """Reads the deposit amount from a screenshot without blocking the event loop.
+
+    Tesseract runs in a ProcessPoolExecutor. Results are cached by the photo's
+    file_unique_id, so a resent screenshot is not processed twice. At most
+    `max_pending` screenshots are in flight, from download to OCR result; beyond
+    that, or after `timeout` seconds, extract_amount() returns None and the
+    caller falls back to the caption.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8, timeout: float = 15, cache_size: int = 1024):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.enabled = OCR_AVAILABLE and workers > 0
+        self._executor = None
+        self._inflight = set()
+        self._cache = OrderedDict()  # file_unique_id -> amount or None
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+        if not OCR_AVAILABLE and workers > 0:
+            logger.info("pytesseract/Pillow not installed; screenshot amounts are read from captions only")
+
+    def queue_depth(self) -> int:
+        return len(self._inflight)
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "queue_depth": self.queue_depth(), "cached": len(self._cache), "hits": self.hits,
+                "misses": self.misses, "rejected": self.rejected, "timeouts": self.timeouts, "failures": self.failures}
+
+    def _remember(self, key, amount):
+        self._cache[key] = amount
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def extract_amount(self, photo) -> float | None:
+        """Amount shown in a PhotoSize (use the largest, message.photo[-1]), or None"""
+        key = photo.file_unique_id
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if not self.enabled:
+            return None
+        if len(self._inflight) >= self.max_pending:
+            self.rejected += 1
+            logger.warning(f"OCR queue full ({len(self._inflight)} in flight); using caption for {key}")
+            return None
+        self.misses += 1
+        slot = object()
+        self._inflight.add(slot)  # taken before the download and held until the worker finishes, even past a timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        job = None
+        try:
+            image_bytes = await asyncio.wait_for(self._download(photo), self.timeout)
+            job = self._submit(image_bytes)
+            job.add_done_callback(lambda _job: self._inflight.discard(slot))
+            amount = await asyncio.wait_for(asyncio.wrap_future(job), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"OCR of {key} timed out after {self.timeout}s; using caption")
+            return None
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"OCR of {key} failed: {e}")
+            return None
+        finally:
+            if job is None:
+                self._inflight.discard(slot)
+        self._remember(key, amount)
+        return amount
+
+    @staticmethod
+    async def _download(photo) -> bytes:
+        telegram_file = await photo.get_file()
+        return bytes(await telegram_file.download_as_bytearray())
+
+    def _submit(self, image_bytes: bytes):
+        if self._executor is None:
+            # Spawned, not forked: this process has Motor's and asyncio's threads, and a forked
+            # child could inherit one of their locks while held
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor.submit(_ocr_amount, image_bytes)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
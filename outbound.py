@@ -0,0 +1,275 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import Counter, deque
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from metrics import registry
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/second overall, 20 messages/minute into one group
+# and about one message/second into one private chat
+GLOBAL_MESSAGES_PER_SECOND = 30
+GROUP_MESSAGES_PER_MINUTE = 20
+PRIVATE_MESSAGES_PER_SECOND = 1
+
+# Priorities, lowest value first. Private chats (users waiting on a reply) default to HIGH,
+# groups to NORMAL; bulk sends such as the ticket fan-out pass rate_limit_args={"priority": LOW}.
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+# Endpoints that count against the message limits; anything else (answerCallbackQuery, getFile, ...) is sent at once
+LIMITED_ENDPOINTS = frozenset({
+    "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+})
+COALESCED_ENDPOINTS = frozenset({"editMessageText", "editMessageCaption", "editMessageReplyMarkup"})
+
+OUTBOUND_WAIT_SECONDS = registry.histogram("bot_outbound_wait_seconds", "Time a Bot API call waited in the outbound queue", ("endpoint",))
+OUTBOUND_DROPPED = registry.counter("bot_outbound_dropped_total", "Outbound calls refused or abandoned", ("endpoint", "reason"))
+OUTBOUND_RETRIES = registry.counter("bot_outbound_retries_total", "Outbound calls retried after a RetryAfter", ("endpoint",))
+OUTBOUND_COALESCED = registry.counter("bot_outbound_coalesced_total", "Edits merged into a newer edit of the same message", ("endpoint",))
+
+
+class OutboundDropped(TelegramError):
+    """Raised to the caller when its call was not sent: the queue was full, or it was still queued at shutdown"""
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "endpoint", "callback", "args", "kwargs", "futures", "enqueued_at", "attempts", "coalesce_key")
+
+    def __init__(self, priority, seq, endpoint, callback, args, kwargs, future, coalesce_key):
+        self.priority = priority
+        self.seq = seq
+        self.endpoint = endpoint
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.coalesce_key = coalesce_key
+
+    def resolve(self, result=None, error=None):
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate limiter for every Bot API call the application makes; use with Application.builder().rate_limiter(...).
+
+    Calls to a chat queue in FIFO order and only one is in flight per chat, so
+    messages keep their order. Across chats the next call sent is the one with
+    the best priority whose chat has a token in its bucket (20/min for groups,
+    1/s for private chats); every send also takes a token from the global
+    30/s bucket. A RetryAfter from Telegram drains that chat's bucket for the
+    given time and puts the call back at the head of its queue, up to
+    `max_retries` times.
+
+    An edit of a message that already has an edit waiting in the queue replaces
+    that edit's arguments instead of queueing a second one; both callers get
+    the result of the one request that is sent. When `max_queue` calls are
+    waiting, anything but HIGH priority is refused with OutboundDropped.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_MESSAGES_PER_SECOND, group_per_minute: float = GROUP_MESSAGES_PER_MINUTE,
+                 private_per_second: float = PRIVATE_MESSAGES_PER_SECOND, max_retries: int = 2, max_queue: int = 5000,
+                 max_inflight: int = 64, drain_timeout: float = 5.0):
+        self.group_per_minute = group_per_minute
+        self.private_per_second = private_per_second
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.drain_timeout = drain_timeout
+        self._global = TokenBucket(global_rate)
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._last_used = {}  # chat_id -> monotonic time of the last send, for pruning idle buckets
+        self._chats = {}  # chat_id -> deque of queued _Jobs
+        self._ready = []  # heap of (priority, seq, chat_id): chats that may send now
+        self._waiting = []  # heap of (ready_at, seq, chat_id): chats waiting for a token
+        self._edits = {}  # (endpoint, chat_id, message_id) -> queued _Job
+        self._depth = Counter()  # priority -> queued calls
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._sending = set()  # _send tasks in flight, awaited by shutdown()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.sent = 0
+        registry.gauge("bot_outbound_queue_depth", "Bot API calls waiting in the outbound queue, by priority",
+                       lambda: {PRIORITY_NAMES[p]: n for p, n in self._depth.items()}, ("priority",))
+
+    # --- BaseRateLimiter ---
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        """Give queued and in-flight calls `drain_timeout` seconds to go out, then fail the rest"""
+        deadline = time.monotonic() + self.drain_timeout
+        while self.queue_depth() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sending:
+            # Sends still running touch _chats when they finish, so they must be done before it is cleared
+            _, unfinished = await asyncio.wait(self._sending, timeout=max(0.0, deadline - time.monotonic()))
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        for chat_id, jobs in self._chats.items():
+            for job in jobs:
+                OUTBOUND_DROPPED.inc(job.endpoint, "shutdown")
+                job.resolve(error=OutboundDropped(f"{job.endpoint} to {chat_id} not sent before shutdown"))
+        if self.queue_depth():
+            logger.warning(f"Outbound scheduler stopped with {self.queue_depth()} calls unsent")
+        self._chats.clear()
+        self._edits.clear()
+        self._depth.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id") if data else None
+        if endpoint not in LIMITED_ENDPOINTS or chat_id is None:
+            return await callback(*args, **kwargs)
+
+        future = asyncio.get_running_loop().create_future()
+        coalesce_key = (endpoint, chat_id, data.get("message_id")) if endpoint in COALESCED_ENDPOINTS else None
+        pending_edit = self._edits.get(coalesce_key) if coalesce_key else None
+        if pending_edit is not None:
+            pending_edit.args, pending_edit.kwargs = args, kwargs
+            pending_edit.futures.append(future)
+            OUTBOUND_COALESCED.inc(endpoint)
+            return await future
+
+        priority = (rate_limit_args or {}).get("priority")
+        if priority is None:
+            priority = HIGH if isinstance(chat_id, int) and chat_id > 0 else NORMAL
+        if priority != HIGH and self.queue_depth() >= self.max_queue:
+            OUTBOUND_DROPPED.inc(endpoint, "queue_full")
+            raise OutboundDropped(f"Outbound queue full ({self.queue_depth()} waiting); {endpoint} to {chat_id} dropped")
+
+        job = _Job(priority, next(self._seq), endpoint, callback, args, kwargs, future, coalesce_key)
+        if coalesce_key:
+            self._edits[coalesce_key] = job
+        self._enqueue(chat_id, job)
+        return await future
+
+    # --- queueing ---
+    def queue_depth(self) -> int:
+        return sum(self._depth.values())
+
+    def stats(self) -> dict:
+        return {"queued": {PRIORITY_NAMES[p]: n for p, n in self._depth.items()}, "chats_queued": len(self._chats),
+                "chats_waiting_for_tokens": len(self._waiting), "buckets": len(self._buckets), "sent": self.sent}
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_per_second, 3)
+            else:
+                bucket = TokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _enqueue(self, chat_id, job):
+        jobs = self._chats.get(chat_id)
+        idle = jobs is None
+        if idle:
+            jobs = self._chats[chat_id] = deque()
+        jobs.append(job)
+        self._depth[job.priority] += 1
+        if idle:  # otherwise the chat is already in a heap or in flight
+            self._schedule(chat_id)
+
+    def _schedule(self, chat_id):
+        head = self._chats[chat_id][0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _prune_buckets(self, now: float):
+        # A bucket unused for two minutes is full again; forget it rather than keep one per chat forever
+        for chat_id in [c for c, used in self._last_used.items() if now - used > 120 and c not in self._chats]:
+            del self._last_used[chat_id]
+            self._buckets.pop(chat_id, None)
+
+    # --- sending ---
+    async def _dispatch(self):
+        next_prune = time.monotonic() + 60
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._waiting)
+                self._schedule(chat_id)
+            if now >= next_prune:
+                self._prune_buckets(now)
+                next_prune = now + 60
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            wait = self._bucket(chat_id).try_take()
+            if wait:
+                heapq.heappush(self._waiting, (now + wait, next(self._seq), chat_id))
+                continue
+            await self._global.acquire()
+            await self._inflight.acquire()
+            job = self._chats[chat_id].popleft()
+            self._depth[job.priority] -= 1
+            if not self._depth[job.priority]:
+                del self._depth[job.priority]
+            if job.coalesce_key and self._edits.get(job.coalesce_key) is job:
+                del self._edits[job.coalesce_key]  # edits from here on queue behind this one
+            self._last_used[chat_id] = time.monotonic()
+            task = asyncio.create_task(self._send(chat_id, job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat_id, job):
+        OUTBOUND_WAIT_SECONDS.observe(time.monotonic() - job.enqueued_at, job.endpoint)
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            self._bucket(chat_id).penalize(retry_after)
+            if job.attempts < self.max_retries:
+                job.attempts += 1
+                OUTBOUND_RETRIES.inc(job.endpoint)
+                logger.warning(f"Rate limited on {job.endpoint} to {chat_id}, retrying in {retry_after}s")
+                self._chats[chat_id].appendleft(job)
+                self._depth[job.priority] += 1
+            else:
+                OUTBOUND_DROPPED.inc(job.endpoint, "retries_exhausted")
+                job.resolve(error=e)
+        except asyncio.CancelledError:
+            OUTBOUND_DROPPED.inc(job.endpoint, "shutdown")
+            job.resolve(error=OutboundDropped(f"{job.endpoint} to {chat_id} cancelled at shutdown"))
+            raise
+        except Exception as e:
+            job.resolve(error=e)
+        else:
+            self.sent += 1
+            job.resolve(result)
+        finally:
+            self._inflight.release()
+            if self._chats[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self._chats[chat_id]
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, bursting up to `capacity`.
+
+    Single-event-loop use only; no locking is needed because refills and takes
+    happen between awaits.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_take(self, tokens: float = 1) -> float:
+        """Take tokens if available; otherwise return how many seconds until they will be"""
+        now = time.monotonic()
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    def penalize(self, seconds: float):
+        """Drain the bucket so nothing is allowed for `seconds` (used for Telegram retry_after)"""
+        self._refill(time.monotonic())
+        # Leave the bucket exactly `seconds` away from its next whole token
+        self._tokens = min(self._tokens, 1.0 - seconds * self.rate)
+
+    async def acquire(self, tokens: float = 1):
+        """Wait until tokens are available and take them"""
+        while True:
+            wait = self.try_take(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
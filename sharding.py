@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from aiohttp import web
+
+from webhook import WebhookIngestor, read_update, routing_key
+
+logger = logging.getLogger(__name__)
+
+SHARD_FLAG = "--shard"
+REPORT_INTERVAL = 1.0
+REPORT_LINE_LIMIT = 16 * 1024 * 1024  # reports carry a metrics snapshot, far beyond asyncio's 64 KiB default
+STALE_REPORT_SECONDS = 5.0
+
+
+def shard_index(argv=None) -> int | None:
+    """The shard number this process was started as (`--shard N`), or None for the front process"""
+    argv = sys.argv if argv is None else argv
+    if SHARD_FLAG not in argv:
+        return None
+    return int(argv[argv.index(SHARD_FLAG) + 1])
+
+
+class _Shard:
+    __slots__ = ("index", "process", "reader", "sent", "restarts", "report", "reported_at", "started_at")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.reader = None
+        self.sent = 0
+        self.restarts = 0
+        self.report = {}
+        self.reported_at = None
+        self.started_at = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+
+class ShardSupervisor:
+    """Front half of the sharded runtime: routes raw updates to N worker processes.
+
+    Each worker is `command` plus `--shard <i>`, started with pipes. Updates are
+    written to a worker's stdin as JSON lines, picked by routing_key() modulo N,
+    so one user's (or group's) updates always go to the same worker and keep
+    their order. Workers report their counters on stdout every second; see
+    stats() for each shard's liveness, backlog (sent but not yet processed) and
+    event loop lag. The reports also carry each worker's metrics snapshot;
+    metric_snapshots() hands them to MetricsRegistry.federate() so the front's
+    /metrics covers every shard. A worker that exits is restarted; updates it
+    had not processed yet are lost, as with a crash in single-process mode.
+
+    submit() refuses an update when the worker's pipe already buffers
+    `max_buffer` bytes (the webhook answers 503 and Telegram redelivers);
+    send() waits for the pipe to drain instead (polling).
+    """
+
+    def __init__(self, command: list, shards: int, max_buffer: int = 4 * 1024 * 1024):
+        self.command = list(command)
+        self.max_buffer = max_buffer
+        self._shards = [_Shard(i) for i in range(max(1, shards))]
+        self._stopping = False
+        self.secret_token = None
+        self.rejected = 0
+
+    # --- processes ---
+    async def _spawn(self, shard: _Shard):
+        shard.process = await asyncio.create_subprocess_exec(
+            *self.command, SHARD_FLAG, str(shard.index), stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=REPORT_LINE_LIMIT)
+        shard.sent = 0
+        shard.report = {}
+        shard.reported_at = None
+        shard.started_at = time.monotonic()
+        shard.reader = asyncio.create_task(self._read_reports(shard))
+        logger.info(f"Shard {shard.index} started (pid {shard.process.pid})")
+
+    async def _read_reports(self, shard: _Shard):
+        process = shard.process
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            try:
+                shard.report = json.loads(line)
+                shard.reported_at = time.monotonic()
+            except ValueError:
+                logger.warning(f"Shard {shard.index} wrote a non-report line to stdout: {line[:200]!r}")
+        returncode = await process.wait()
+        if self._stopping:
+            return
+        shard.restarts += 1
+        logger.error(f"Shard {shard.index} exited with {returncode}; restarting")
+        await asyncio.sleep(1)
+        await self._spawn(shard)
+
+    async def start(self):
+        for shard in self._shards:
+            await self._spawn(shard)
+
+    async def stop(self, timeout: float = 15):
+        """Close every worker's stdin so it drains and exits; kill whatever is left after `timeout`"""
+        self._stopping = True
+        for shard in self._shards:
+            if shard.alive:
+                shard.process.stdin.close()
+        for shard in self._shards:
+            if shard.process is None:
+                continue
+            try:
+                await asyncio.wait_for(shard.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Shard {shard.index} did not exit in {timeout}s; killing it")
+                shard.process.kill()
+                await shard.process.wait()
+        await asyncio.gather(*(shard.reader for shard in self._shards if shard.reader), return_exceptions=True)
+
+    # --- routing ---
+    def _shard_for(self, data: dict) -> _Shard:
+        return self._shards[routing_key(data) % len(self._shards)]
+
+    def submit(self, data: dict) -> bool:
+        """Hand an update to its shard without waiting; False if the shard is down or backed up"""
+        shard = self._shard_for(data)
+        if not shard.alive or shard.process.stdin.transport.get_write_buffer_size() > self.max_buffer:
+            self.rejected += 1
+            return False
+        shard.process.stdin.write(json.dumps(data).encode() + b"\n")
+        shard.sent += 1
+        return True
+
+    async def send(self, data: dict):
+        """Hand an update to its shard, waiting while the shard's pipe is full or it restarts"""
+        shard = self._shard_for(data)
+        while not shard.alive:
+            await asyncio.sleep(0.5)
+        shard.process.stdin.write(json.dumps(data).encode() + b"\n")
+        shard.sent += 1
+        await shard.process.stdin.drain()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        data = await read_update(request, self.secret_token)
+        return web.Response() if self.submit(data) else web.Response(status=503)
+
+    def install(self, web_app: web.Application, path: str, secret_token: str):
+        """Receive webhook posts on `path` and route them to the shards"""
+        self.secret_token = secret_token
+        web_app.router.add_post(path, self.handle)
+
+    # --- health ---
+    def stats(self) -> dict:
+        now = time.monotonic()
+        shards = []
+        for shard in self._shards:
+            report = shard.report
+            age = now - shard.reported_at if shard.reported_at is not None else None
+            shards.append({
+                "shard": shard.index, "pid": shard.process.pid if shard.process else None, "alive": shard.alive,
+                "healthy": shard.alive and age is not None and age < STALE_REPORT_SECONDS, "restarts": shard.restarts,
+                "sent": shard.sent, "processed": report.get("processed", 0), "failed": report.get("failed", 0),
+                "backlog": shard.sent - report.get("processed", 0) - report.get("failed", 0),
+                "queue_depth": report.get("queue_depth", 0), "loop_lag_s": report.get("loop_lag_s"),
+                "report_age_s": age})
+        return {"shards": shards, "rejected": self.rejected}
+
+    def metric_snapshots(self) -> dict:
+        """Latest metrics snapshot reported by each shard, keyed by shard number"""
+        return {str(shard.index): shard.report["metrics"] for shard in self._shards if "metrics" in shard.report}
+
+    def healthy(self) -> bool:
+        return all(shard["healthy"] for shard in self.stats()["shards"])
+
+    def install_health(self, web_app: web.Application):
+        async def shard_stats(request):
+            return web.json_response(self.stats())
+
+        async def shard_health(request):
+            return web.Response(text="OK") if self.healthy() else web.Response(status=503, text="Shard down or stalled")
+
+        web_app.router.add_get("/stats/shards", shard_stats)
+        web_app.router.add_get("/health/shards", shard_health)
+
+
+async def serve_shard(application, shards: int, workers: int = 4, queue_size: int = 1000, lag_monitor=None, metrics=None):
+    """Worker half: feed updates from stdin into `application` until stdin closes.
+
+    Updates are spread over `workers` ordered queues by routing_key() (as in
+    webhook mode, but divided by `shards`, the front's shard count), and a JSON report of the counters goes to stdout every
+    REPORT_INTERVAL seconds for the front's ShardSupervisor, with `metrics` (a MetricsRegistry) snapshotted into it.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    ingestor = WebhookIngestor(application, secret_token="", workers=workers, queue_size=queue_size, shards=shards)
+    await ingestor.start()
+
+    def report():
+        stats = ingestor.stats()
+        stats["loop_lag_s"] = lag_monitor.last_lag if lag_monitor else None
+        if metrics is not None:
+            stats["metrics"] = metrics.snapshot()
+        sys.stdout.write(json.dumps(stats) + "\n")
+        sys.stdout.flush()
+
+    async def report_loop():
+        while True:
+            report()
+            await asyncio.sleep(REPORT_INTERVAL)
+
+    reporter = asyncio.create_task(report_loop())
+    try:
+        while line := await reader.readline():
+            # While the queue is full we stop reading, so the pipe fills and the front pushes back
+            await ingestor.put(json.loads(line))
+    finally:
+        await ingestor.stop()
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        report()
@@ -0,0 +1,292 @@
+import asyncio
+import copy
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import DeleteOne, ReplaceOne
+from telegram import Update
+from telegram.ext import TypeHandler
+
+logger = logging.getLogger(__name__)
+
+USER_DATA_NAMESPACE = "user_data"
+
+
+class InMemoryStateStore:
+    """Process-local key/value state with per-key TTL, grouped by namespace.
+
+    Expired entries are dropped on read and, when an ExpiryService is given,
+    evicted in the background so abandoned keys don't accumulate.
+    """
+
+    def __init__(self, expiry=None):
+        self.expiry = expiry
+        self._data = {}  # (namespace, key) -> (value, expires_at monotonic or None)
+
+    def _live(self, entry):
+        return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def _track_expiry(self, namespace, key, ttl):
+        if self.expiry is None:
+            return
+        if ttl:
+            self.expiry.schedule((f"state:{namespace}", key), ttl, lambda: self._evict(namespace, key))
+        else:
+            self.expiry.cancel((f"state:{namespace}", key))
+
+    def _evict(self, namespace, key):
+        self._data.pop((namespace, key), None)
+
+    async def get(self, namespace: str, key):
+        entry = self._data.get((namespace, key))
+        if not self._live(entry):
+            self._data.pop((namespace, key), None)
+            return None
+        return copy.deepcopy(entry[0])
+
+    async def set(self, namespace: str, key, value: dict, ttl: float | None = None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[(namespace, key)] = (copy.deepcopy(value), expires_at)
+        self._track_expiry(namespace, key, ttl)
+
+    async def delete(self, namespace: str, key):
+        self._data.pop((namespace, key), None)
+        self._track_expiry(namespace, key, None)
+
+    def count(self, namespace: str | None = None) -> int:
+        if namespace is None:
+            return len(self._data)
+        return sum(1 for ns, _key in self._data if ns == namespace)
+
+    async def ensure_indexes(self):
+        pass
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def namespace(self, name: str, ttl: float | None = None) -> "StateNamespace":
+        return StateNamespace(self, name, ttl)
+
+
+class MongoStateStore(InMemoryStateStore):
+    """State shared by every bot process through the conversation_state collection.
+
+    Reads go through a small local cache that is trusted for `cache_ttl` seconds.
+    Writes land in the local cache immediately and are flushed to MongoDB in
+    batches every `flush_interval` seconds (write-behind), so a handler never
+    waits on a state write. Expired documents are removed by a TTL index.
+
+    The cache only sees this process's writes. That is fine while every user's
+    updates reach one process (single process, or sharded); when several
+    replicas serve the same users, use cache_ttl=0 so every read goes to MongoDB.
+    """
+
+    def __init__(self, collection, cache_ttl: float = 5, flush_interval: float = 0.2, max_batch: int = 500, max_cached: int = 50000, expiry=None):
+        super().__init__(expiry)
+        self.collection = collection
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_cached = max_cached
+        self._cached_at = {}  # (namespace, key) -> monotonic time the cache entry was filled
+        self._dirty = {}  # _id -> pending write (ReplaceOne/DeleteOne)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @staticmethod
+    def _doc_id(namespace, key) -> str:
+        return f"{namespace}:{key}"
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def _evict(self, namespace, key):
+        # Only the local copy goes; MongoDB's TTL index removes the document itself
+        self._data.pop((namespace, key), None)
+        self._cached_at.pop((namespace, key), None)
+
+    def _cache(self, namespace, key, value, ttl):
+        if len(self._data) >= self.max_cached and (namespace, key) not in self._data:
+            # Drop the oldest cached entry; dict order is insertion order
+            oldest = next(iter(self._data))
+            if self._doc_id(*oldest) not in self._dirty:
+                self._evict(*oldest)
+                self._track_expiry(*oldest, None)
+        self._data[(namespace, key)] = (value, time.monotonic() + ttl if ttl else None)
+        self._cached_at[(namespace, key)] = time.monotonic()
+        self._track_expiry(namespace, key, ttl)
+
+    async def get(self, namespace: str, key):
+        cache_key = (namespace, key)
+        doc_id = self._doc_id(namespace, key)
+        entry = self._data.get(cache_key)
+        fresh = time.monotonic() - self._cached_at.get(cache_key, 0) < self.cache_ttl
+        if entry is not None and (fresh or doc_id in self._dirty):
+            return copy.deepcopy(entry[0]) if self._live(entry) else None
+        if entry is None and fresh and doc_id not in self._dirty:
+            return None  # recently confirmed missing
+
+        doc = await self.collection.find_one({"_id": doc_id})
+        if doc_id in self._dirty:
+            # A local write raced with the read; the local value is newer
+            entry = self._data.get(cache_key)
+            return copy.deepcopy(entry[0]) if self._live(entry) else None
+        expires_at = doc.get("expires_at") if doc else None
+        if expires_at is not None and expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)  # Motor returns naive datetimes, which are UTC
+        now = datetime.now(timezone.utc)
+        if not doc or (expires_at and expires_at <= now):
+            self._data.pop(cache_key, None)
+            if len(self._cached_at) >= self.max_cached:
+                # Negative entries are only an optimisation; forget them rather than grow
+                self._cached_at = {k: self._cached_at[k] for k in self._data if k in self._cached_at}
+            self._cached_at[cache_key] = time.monotonic()
+            return None
+        ttl = (expires_at - now).total_seconds() if expires_at else None
+        self._cache(namespace, key, doc["value"], ttl)
+        return copy.deepcopy(doc["value"])
+
+    async def set(self, namespace: str, key, value: dict, ttl: float | None = None):
+        value = copy.deepcopy(value)
+        self._cache(namespace, key, value, ttl)
+        doc_id = self._doc_id(namespace, key)
+        now = datetime.now(timezone.utc)
+        doc = {"_id": doc_id, "ns": namespace, "key": key, "value": value, "updated_at": now,
+               "expires_at": now + timedelta(seconds=ttl) if ttl else None}
+        self._mark_dirty(doc_id, ReplaceOne({"_id": doc_id}, doc, upsert=True))
+
+    async def delete(self, namespace: str, key):
+        self._data.pop((namespace, key), None)
+        self._track_expiry(namespace, key, None)
+        self._cached_at[(namespace, key)] = time.monotonic()
+        doc_id = self._doc_id(namespace, key)
+        self._mark_dirty(doc_id, DeleteOne({"_id": doc_id}))
+
+    def _mark_dirty(self, doc_id, op):
+        self._dirty.pop(doc_id, None)  # re-insert so the newest write goes last
+        self._dirty[doc_id] = op
+        if len(self._dirty) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Write all pending changes to MongoDB in bulk"""
+        while self._dirty:
+            batch_ids = list(self._dirty)[: self.max_batch]
+            ops = [self._dirty.pop(doc_id) for doc_id in batch_ids]
+            try:
+                await self.collection.bulk_write(ops, ordered=True)
+            except Exception as e:
+                logger.error(f"State store flush of {len(ops)} writes failed, will retry: {e}")
+                for doc_id, op in zip(batch_ids, ops):
+                    self._dirty.setdefault(doc_id, op)  # keep any newer write made meanwhile
+                return
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class StateNamespace:
+    """A store bound to one namespace and default TTL, used like an async dict"""
+
+    def __init__(self, store, name: str, ttl: float | None = None):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+
+    async def get(self, key):
+        return await self.store.get(self.name, key)
+
+    async def set(self, key, value: dict, ttl: float | None = None):
+        await self.store.set(self.name, key, value, ttl if ttl is not None else self.ttl)
+
+    async def delete(self, key):
+        await self.store.delete(self.name, key)
+
+    async def contains(self, key) -> bool:
+        return await self.get(key) is not None
+
+
+def create_state_store(backend: str, db=None, expiry=None, **kwargs):
+    """Build the state store named by `backend` ("memory" or "mongo")"""
+    if backend == "mongo":
+        return MongoStateStore(db.conversation_state, expiry=expiry, **kwargs)
+    if backend != "memory":
+        raise ValueError(f"Unknown state backend: {backend}")
+    return InMemoryStateStore(expiry)
+
+
+class UserDataSync:
+    """Keeps PTB's context.user_data in the state store.
+
+    A TypeHandler in group -1 loads the user's state into context.user_data before
+    the normal handlers run, and one in group 1 writes it back afterwards if it
+    changed. A user with no stored state (never started, or expired after `ttl`
+    seconds of inactivity) gets an empty user_data.
+
+    Because the store is the source of truth, PTB's own per-user copy is only a
+    working buffer; with an ExpiryService it is dropped after `idle_ttl` seconds
+    without updates so inactive users don't stay in memory.
+
+    The loaded state is snapshotted (deep-copied, so changes to nested values
+    count) on the update's CallbackContext, which PTB shares between handler
+    groups and drops with the update; an update whose save never runs
+    (ApplicationHandlerStop in group 0) leaves nothing behind.
+    """
+
+    def __init__(self, store, ttl: float | None = None, expiry=None, idle_ttl: float = 900):
+        self.state = store.namespace(USER_DATA_NAMESPACE, ttl)
+        self.expiry = expiry
+        self.idle_ttl = idle_ttl
+
+    async def load(self, update: Update, context):
+        user = update.effective_user
+        if not user or context.user_data is None:
+            return
+        stored = await self.state.get(user.id) or {}
+        context.user_data.clear()
+        context.user_data.update(stored)
+        context.user_data_snapshot = copy.deepcopy(stored)
+        if self.expiry is not None:
+            application, user_id = context.application, user.id
+            self.expiry.schedule(("ptb_user_data", user_id), self.idle_ttl, lambda: application.drop_user_data(user_id))
+
+    async def save(self, update: Update, context):
+        user = update.effective_user
+        if not user or context.user_data is None:
+            return
+        before = getattr(context, "user_data_snapshot", None)
+        current = dict(context.user_data)
+        if current == before:
+            return
+        if current:
+            await self.state.set(user.id, current)
+        else:
+            await self.state.delete(user.id)
+
+    def install(self, application):
+        application.add_handler(TypeHandler(Update, self.load), group=-1)
+        application.add_handler(TypeHandler(Update, self.save), group=1)
@@ -0,0 +1,100 @@
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from string import Formatter
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Characters that open an entity in Telegram's legacy Markdown (parse_mode='Markdown')
+_MARKDOWN_SPECIAL = str.maketrans({"_": "\\_", "*": "\\*", "`": "\\`", "[": "\\["})
+
+
+def escape_md(text) -> str:
+    """`text` made safe to embed in a legacy-Markdown message, e.g. a user name like "john_doe" """
+    return str(text).translate(_MARKDOWN_SPECIAL)
+
+
+class Raw(str):
+    """A template value inserted as is: already-escaped text, or text inside a `code` span (which can't be escaped)"""
+
+
+class MarkdownTemplate:
+    """A str.format()-style template parsed once.
+
+    render() substitutes values by name, Markdown-escaping each one unless it is
+    wrapped in Raw. Format specs are applied before escaping, so
+    "{created_at:%Y-%m-%d}" works for datetimes.
+    """
+
+    def __init__(self, text: str):
+        self._parts = [(literal, field, spec or "") for literal, field, spec, _ in Formatter().parse(text)]
+
+    def render(self, **values) -> str:
+        out = []
+        for literal, field, spec in self._parts:
+            out.append(literal)
+            if field is not None:
+                value = values[field]
+                out.append(value if isinstance(value, Raw) else escape_md(format(value, spec)))
+        return "".join(out)
+
+
+@lru_cache(maxsize=256)
+def field_label(key: str) -> str:
+    """Display label for a flow_details key: "cr_number" -> "Cr Number" """
+    return key.replace("_", " ").title()
+
+
+def _button(text: str, target: str) -> InlineKeyboardButton:
+    if target.startswith(("http://", "https://")):
+        return InlineKeyboardButton(text, url=target)
+    return InlineKeyboardButton(text, callback_data=target)
+
+
+@lru_cache(maxsize=256)
+def keyboard(*rows) -> InlineKeyboardMarkup:
+    """Inline keyboard from rows of (text, callback_data or URL) pairs, built once per layout.
+
+    Telegram objects are immutable, so the same markup can be sent any number of times.
+    """
+    return InlineKeyboardMarkup([[_button(text, target) for text, target in row] for row in rows])
+
+
+@lru_cache(maxsize=4096)
+def ticket_actions_keyboard(ticket_id: str, take: bool = True) -> InlineKeyboardMarkup:
+    """Buttons under a ticket card in the support groups: Take (until someone has it) and Close"""
+    rows = [(("🙋‍♂️ Take Ticket", f"take_{ticket_id}"),)] if take else []
+    return keyboard(*rows, (("🔒 Close Ticket", f"close_{ticket_id}"),))
+
+
+class RenderCache:
+    """LRU of rendered texts keyed by (ticket_id, updated_at).
+
+    Every change to a ticket bumps updated_at, so a stale entry is never served:
+    it just stops being looked up and ages out.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ticket: dict, render) -> str:
+        """Cached text for this version of `ticket`, calling render(ticket) on a miss"""
+        key = (ticket["ticket_id"], ticket.get("updated_at"))
+        text = self._entries.get(key)
+        if text is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return text
+        self.misses += 1
+        text = self._entries[key] = render(ticket)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return text
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
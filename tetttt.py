@@ -1,20 +1,43 @@
+import time
+STARTED_AT = time.perf_counter() # Start of the "imports" phase, see startup.py
 import os
+import sys
 import logging
 import asyncio
-from aiohttp import web
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import json
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from datetime import datetime, timedelta, date
-from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
 import re
 
+from cr_registry import CRRegistry, FileCRSource, MongoCRSource
+from database import MongoDatabase, index_step
+from expiry import ExpiryService
+from fanout import TicketFanout
+from flood_guard import FloodGuard
+from flow_engine import FlowRouter
+from group_cache import SupportGroupCache
+from metrics import InstrumentedRequest, LoopLagMonitor, instrument, observe_handler, registry
+from outbound import GLOBAL_MESSAGES_PER_SECOND, GROUP_MESSAGES_PER_MINUTE, OutboundScheduler
+from startup import StartupProfiler
+from state_store import UserDataSync, create_state_store
+from templates import MarkdownTemplate, Raw, RenderCache, escape_md, field_label, keyboard, ticket_actions_keyboard
+from ticket_counters import TicketCounters
+from ticket_ids import TicketIdAllocator
+from ticket_store import TicketStore, encode_cursor
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+profiler = StartupProfiler(STARTED_AT) # `python tetttt.py --profile-startup` prints where startup time goes
+profiler.record("imports", time.perf_counter() - STARTED_AT)
+WEB_SERVER = os.environ.get("WEB_SERVER", "1") == "1" # 0: no health/metrics server (and no aiohttp import) when polling
 
 # --- Your Custom Content Constants ---
 DERIV_AFFILIATE_LINK = "https://track.deriv.com/_qamZPcT5Sau2vdm9PpHVCmNd7ZgqdRLk/1/"
@@ -22,60 +45,25 @@ DERIV_PROCEDURE_LINK_TEXT = "https://t.me/forexbactest/1341" # For display
 DERIV_TAGGING_GUIDE_LINK = "https://t.me/derivaccountopeningguide/66"
 ADMIN_TELEGRAM_LINK = "https://t.me/Fxbactest_bot" # Replace with actual admin username/link
 
-# This is a very long list, store it efficiently
-CR_NUMBERS_LIST = {
-    "CR5499637", "CR5500382", "CR5529877", "CR5535613", "CR5544922", "CR5551288", "CR5552176", "CR5556284", 
-    "CR5556287", "CR5561483", "CR5563616", "CR5577880", "CR5585327", "CR5589802", "CR5592846", "CR5594968", 
-    "CR5595416", "CR5597602", "CR5605478", "CR5607701", "CR5616548", "CR5616657", "CR5617024", "CR5618746", 
-    "CR5634872", "CR5638055", "CR5658165", "CR5662243", "CR5681280", "CR5686151", "CR5693620", "CR5694136", 
-    "CR5729218", "CR5729228", "CR5729255", "CR5734377", "CR5734685", "CR5734864", "CR5751222", "CR5755906", 
-    "CR5784782", "CR5786213", "CR5786969", "CR5799865", "CR5799868", "CR5799916", "CR5822964", "CR5836935", 
-    "CR5836938", "CR5839647", "CR5839797", "CR5859465", "CR5864046", "CR5873762", "CR5881030", "CR5886556", 
-    "CR5890102", "CR5924066", "CR5930200", "CR5970531", "CR6007156", "CR6012579", "CR6012919", "CR6022355", 
-    "CR6024318", "CR6037913", "CR6043787", "CR6077426", "CR6086720", "CR6094490", "CR6102922", "CR6128596", 
-    "CR6135793", "CR6141138", "CR6141427", "CR6141685", "CR6142172", "CR6142245", "CR6143176", "CR6146767", 
-    "CR6146888", "CR6167387", "CR6172824", "CR6181075", "CR6181076", "CR6182660", "CR6194673", "CR6198415", 
-    "CR6209246", "CR6268178", "CR6283228", "CR6295186", "CR6299453", "CR6301714", "CR6313536", "CR6316942", 
-    "CR6316943", "CR6316945", "CR6321295", "CR6330598", "CR6341042", "CR6379985", "CR6399552", "CR6401733", 
-    "CR6403902", "CR6413389", "CR6423099", "CR6423523", "CR6462778", "CR6474692", "CR6487699", "CR6505876", 
-    "CR6520436", "CR6520451", "CR6523858", "CR6524558", "CR6528520", "CR6532131", "CR6532137", "CR6532275", 
-    "CR6610101", "CR6620010", "CR6653814", "CR6667537", "CR6669363", "CR6669366", "CR6675564", "CR6676337", 
-    "CR6676341", "CR6682471", "CR6691842", "CR6691852", "CR6710741", "CR6756501", "CR6756521", "CR6762445", 
-    "CR6772496", "CR6799617", "CR6800730", "CR6973584", "CR6978912", "CR6983840", "CR6984178", "CR6994219", 
-    "CR7016028", "CR7044018", "CR7052204", "CR7112762", "CR7114951", "CR7124896", "CR7237163", "CR7310563", 
-    "CR7380411", "CR7381612", "CR5217806", "CR5218145", "CR5247338", "CR5431311", "CR5455669", "CR5141478", 
-    "CR5466762", "CR6154878", "CR6514641", "CR7443452", "CR7462159", "CR7496923", "CR7514165", "CR7619347", 
-    "CR7625010", "CR7655242", "CR7707424", "CR7708242", "CR4965219", "CR4985194", "CR5053549", "CR5085020", 
-    "CR5076079", "CR5115383", "CR5127519", "CR5128799", "CR5128821", "CR5128906", "CR5108974", "CR5140335", 
-    "CR5140339", "CR5146592", "CR5146651", "CR5140283", "CR5150548", "CR5168586", "CR5182098", "CR5195948", 
-    "CR5195953", "CR5195954", "CR5208742", "CR5191512", "CR5191516", "CR5230088", "CR5242731", "CR5232901", 
-    "CR5304118", "CR5376438", "CR5383018", "CR5559722", "CR5576367", "CR5583683", "CR5747075", "CR5845914", 
-    "CR5851342", "CR5851788", "CR5882107", "CR6174976", "CR6200366", "CR6156707", "CR6158587", "CR6300261", 
-    "CR6352212", "CR6384361", "CR6399574", "CR6408968", "CR6439217", "CR6706694", "CR6771489", "CR6828268", 
-    "CR7283876", "CR7283878", "CR7383923", "CR7383924", "CR7383926", "CR5107260", "CR5107344", "CR5121522", 
-    "CR5124042", "CR5131270", "CR5131273", "CR5140709", "CR5145112", "CR5145144", "CR5150792", "CR5151132", 
-    "CR5152411", "CR5156334", "CR5168665", "CR5171621", "CR5171935", "CR5172416", "CR5174518", "CR5175283", 
-    "CR5175357", "CR5175623", "CR5176885", "CR5178412", "CR5183689", "CR5192564", "CR5192768", "CR5196405", 
-    "CR5201751", "CR5201863", "CR5208818", "CR5209139", "CR5211727", "CR5217038", "CR5217041", "CR5217294", 
-    "CR5217716", "CR5217841", "CR5218709", "CR5220504", "CR5221257", "CR5222812", "CR5224492", "CR5234722", 
-    "CR5250590", "CR5253563", "CR5253566", "CR5253922", "CR5268275", "CR5273673", "CR5273869", "CR5276090", 
-    "CR5276310", "CR5281994", "CR5283490", "CR5283554", "CR5283705", "CR5283721", "CR5291732", "CR5298913", 
-    "CR5299111", "CR5299430", "CR5303230", "CR5304735", "CR5305240", "CR5305810", "CR5310002", "CR5317151", 
-    "CR5321069", "CR5324653", "CR5325581", "CR5327120", "CR5328157", "CR5337678", "CR5337712", "CR5337783", 
-    "CR5337784", "CR5337791", "CR5337793", "CR5404655", "CR5421490", "CR5442253", "CR5442355", "CR5442531", 
-    "CR5442605", "CR5444280", "CR5445094", "CR5446889", "CR5466632", "CR5471054", "CR5477031", "CR5485897", 
-    "CR5487026", "CR5487767", "CR5487928", "CR5488506", "CR5491460", "CR3648598", "CR3654244", "CR3654335", 
-    "CR3762108", "CR3845409", "CR3925151", "CR4085158", "CR4090372", "CR4138661", "CR4210749", "CR4296364", 
-    "CR4373296", "CR4488218", "CR4583558", "CR4655132", "CR7792475", "CR7814776", "CR7816651", "CR7817244", 
-    "CR7818330", "CR5149678", "CR8010847", "CR8036589", "CR8047034", "CR8052255", "CR8581785", 
-    "CR8644473", "CR8648274", "CR8661054"
-}
+# Affiliated CR numbers live in a data file (and optionally a MongoDB collection) so
+# newly tagged clients can be added without a redeploy; see cr_registry.py
+CR_NUMBERS_FILE = os.environ.get("CR_NUMBERS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cr_numbers.txt"))
+CR_NUMBERS_COLLECTION = os.environ.get("CR_NUMBERS_COLLECTION") # e.g. "cr_numbers"; unset = file only
+CR_REGISTRY_RELOAD_SECONDS = int(os.environ.get("CR_REGISTRY_RELOAD_SECONDS", 300))
+INDEX_VERSION = 2 # Bump when an index definition in init_database changes, so the next boot re-runs them
 GREETING_KEYWORDS = {"hello", "hi", "hey", "good morning", "good afternoon", "good evening", "what's up", "howdy", "greetings", "hey there"}
 MIN_DEPOSIT_DERIV_VIP = 50 # As per "I can verify that you are tagged under us. Please proceed to fund your account with a minimum of $50"
 MIN_DEPOSIT_MENTORSHIP = 50
 MIN_DEPOSIT_CURRENCIES_OCTA = 100
 MIN_DEPOSIT_CURRENCIES_VANTAGE = 100 # From initial text, $50 is min deposit, but for premium signals it's $100
 
+# Flow steps that expect a funding screenshot: (flow, step) -> (minimum deposit, ticket type, ticket summary)
+FUNDING_SCREENSHOT_STEPS = {
+    ("deriv_vip", "awaiting_deriv_funding_screenshot"): (MIN_DEPOSIT_DERIV_VIP, "Deriv VIP", "Deriv VIP access request."),
+    ("mentorship", "awaiting_mentorship_funding_screenshot"): (MIN_DEPOSIT_MENTORSHIP, "Free Mentorship", "Free Mentorship access request."),
+    ("mentorship", "awaiting_mentorship_funding_screenshot_after_creation"): (MIN_DEPOSIT_MENTORSHIP, "Free Mentorship", "Free Mentorship access request."),
+}
+
 OCTAFX_INFO = """
 🚀 **Join Currencies Premium Channel (OctaFX) and Access Exclusive Signals!** 🚀
 What You Get:
@@ -105,25 +93,114 @@ VANTAGE EXCLUSIVES
 * FAST & EASY ACCOUNT OPENING
 """
 
+# Rendered once: the currencies intro is the longest static message the bot sends.
+# VANTAGE_INFO's "* " bullets are plain text, so they are escaped rather than left to pair up as bold.
+CURRENCIES_INFO_TEXT = (
+    "Welcome to Currencies VIP Services!\n\n"
+    "We offer premium signals through our partner brokers OctaFX and Vantage.\n"
+    "Please ensure you have followed the setup instructions for your chosen broker:\n\n"
+    f"{OCTAFX_INFO}\n\n---\n\n{escape_md(VANTAGE_INFO)}\n\n"
+    "I will now create a 'VIP Currencies Ticket' for you. Our admin team will follow up."
+)
+
+# Ticket texts; substituted values are Markdown-escaped (user names, descriptions, flow answers)
+TICKET_CARD = MarkdownTemplate("🆕 **New {ticket_type}**\n\n"
+                               "🎫 **ID:** `{ticket_id}`\n"
+                               "👤 **User:** {name} ({contact})\n"
+                               "📂 **Type/Category:** {category}\n"
+                               "📅 **Created:** {created_at:%Y-%m-%d %H:%M:%S UTC}\n\n"
+                               "📝 **Description/Details:**\n{description}\n\n")
+TICKET_DETAILS = MarkdownTemplate("🎫 **Ticket Details**\n\n"
+                                  "**ID:** `{ticket_id}`\n"
+                                  "**Status:** {status_emoji} {status}\n"
+                                  "**Type/Category:** {category}\n"
+                                  "**Priority:** {priority}\n"
+                                  "**Created:** {created_at:%Y-%m-%d %H:%M:%S UTC}\n"
+                                  "**Last Updated:** {updated_at:%Y-%m-%d %H:%M:%S UTC}\n\n"
+                                  "**Description:**\n{description}\n\n")
+DETAIL_LINE = MarkdownTemplate("- {label}: {value}\n")
+TAKEN_FOOTER = MarkdownTemplate("\n\n---\n**🧑‍💻 Taken by:** {name} at {at:%Y-%m-%d %H:%M}")
+CLOSED_FOOTER = MarkdownTemplate("\n\n---\n**🔴 Closed by:** {name} at {at:%Y-%m-%d %H:%M}")
+STATUS_EMOJIS = {"open": "🟢", "closed": "🔴", "pending": "🟡", "on-hold": "🟠"}
+
 
 class SupportBot:
     def __init__(self, bot_token, mongodb_uri):
         self.bot_token = bot_token
         self.mongodb_uri = mongodb_uri
+        self.database = None # Pooled client, warm-up and index migrations, see database.py
         self.db_client = None
         self.db = None
+        self.ticket_ids = None
+        self.tickets = None
+        self.counters = None
+        self.fanout = None
+        self.notifications = None # Durable outbox for messages to users, see notifications.py
+        self.group_cache = None
+        self.cr_registry = None
+        self.expiry = None # Background eviction of TTL'd state, see expiry.py
+        self.state = None # Shared conversation state (memory or MongoDB), see state_store.py
         # self.pending_tickets = {} # Deprecating in favor of context.user_data for multi-step flows
-        self.pending_connections = {}  # Store pending group connections
-
-    async def init_database(self):
-        """Initialize MongoDB connection"""
+        self.pending_connections = None  # Store pending group connections
+        self.ocr = None # Screenshot OCR, built with the first funding screenshot, see screenshot_ocr()
+        self.ticket_cards = RenderCache() # Support-group ticket cards by (ticket_id, updated_at)
+        self.ticket_details = RenderCache() # "Ticket Details" views, same key
+        self.router = self._build_router() # Callback/flow dispatch table, validated here at startup
+
+    async def init_database(self, primary: bool = True):
+        """Initialize MongoDB connection
+
+        Only the primary process (shard 0 when sharded) runs the counter reconciliation
+        and reloads the CR registry from its sources; the others follow it.
+        """
         try:
-            self.db_client = AsyncIOMotorClient(self.mongodb_uri)
-            self.db = self.db_client.support_bot_new # Use a new DB or collection if needed
-
-            await self.db.tickets.create_index("ticket_id", unique=True)
-            await self.db.tickets.create_index("user_id")
-            await self.db.groups.create_index("group_id", unique=True)
+            with profiler.phase("database.connect"):
+                self.database = MongoDatabase(self.mongodb_uri, "support_bot_new") # Use a new DB or collection if needed
+                self.db_client = self.database.client
+                self.db = self.database.db
+                await self.database.warm_up()
+            self.ticket_ids = TicketIdAllocator(self.db, block_size=int(os.environ.get("TICKET_ID_BLOCK_SIZE", 1)))
+            self.counters = TicketCounters(self.db, reconcile_interval=float(os.environ.get("TICKET_COUNTERS_RECONCILE_SECONDS", 3600)) if primary else 0)
+            self.fanout = TicketFanout(self.counters, max_concurrency=int(os.environ.get("FANOUT_CONCURRENCY", 10)))
+            self.group_cache = SupportGroupCache(self.db, ttl=float(os.environ.get("GROUP_CACHE_TTL", 300)))
+            self.expiry = ExpiryService()
+            state_backend = os.environ.get("STATE_BACKEND", "memory")
+            self.state = create_state_store(state_backend, self.db, expiry=self.expiry,
+                                            cache_ttl=float(os.environ.get("STATE_CACHE_TTL", 5))) # 0 with several unsharded replicas
+            self.pending_connections = self.state.namespace("pending_connections", ttl=600)
+            self.tickets = TicketStore(self.db.tickets, self.db.ticket_messages)
+            from notifications import NotificationOutbox
+            self.notifications = NotificationOutbox(self.db.notifications, workers=int(os.environ.get("NOTIFICATION_WORKERS", 4)))
+
+            index_steps = {
+                "tickets": index_step(self.db.tickets, IndexModel("ticket_id", unique=True), IndexModel("user_id")),
+                "groups": index_step(self.db.groups, IndexModel("group_id", unique=True)),
+                "ticket_counters": self.counters.ensure_indexes,
+                "ticket_store": self.tickets.ensure_indexes,
+                f"state:{state_backend}": self.state.ensure_indexes,
+                "notifications": self.notifications.ensure_indexes,
+            }
+            if CR_NUMBERS_COLLECTION:
+                index_steps[f"cr_numbers:{CR_NUMBERS_COLLECTION}"] = index_step(self.db[CR_NUMBERS_COLLECTION], IndexModel("cr_number", unique=True))
+            # A --profile-startup run skips the migration and the background tasks, so it measures
+            # a cold start and writes nothing
+            if not profiler.profiling:
+                with profiler.phase("database.indexes"):
+                    await self.database.migrate(INDEX_VERSION, index_steps)
+                self.group_cache.watch()
+                self.expiry.start()
+                self.counters.start()
+                self.state.start()
+
+            cr_sources = [FileCRSource(CR_NUMBERS_FILE)]
+            if CR_NUMBERS_COLLECTION:
+                cr_sources.append(MongoCRSource(self.db[CR_NUMBERS_COLLECTION]))
+            self.cr_registry = CRRegistry(cr_sources, reload_interval=CR_REGISTRY_RELOAD_SECONDS,
+                                          marker=self.db.cr_registry if SHARDS > 1 else None, follow=not primary)
+            with profiler.phase("cr_registry.load"):
+                await self.cr_registry.reload(force=True)
+            if not profiler.profiling:
+                self.cr_registry.start()
             # Knowledge base can be kept if you still want FAQ functionality
             # await self.db.knowledge_base.create_index("question")  
             # await self.db.knowledge_base.create_index("keywords")
@@ -134,6 +211,25 @@ class SupportBot:
             logger.error(f"Database initialization failed: {e}")
             raise
 
+    def screenshot_ocr(self):
+        """The OCR stage for funding screenshots; ocr.py is only imported once the first one arrives"""
+        if self.ocr is None:
+            from ocr import ScreenshotOCR
+
+            self.ocr = ScreenshotOCR(workers=int(os.environ.get("OCR_WORKERS", 2)), max_pending=int(os.environ.get("OCR_MAX_PENDING", 8)),
+                                     timeout=float(os.environ.get("OCR_TIMEOUT", 15))) # Optional, needs pytesseract
+        return self.ocr
+
+    async def close(self):
+        """Stop the background services init_database started and flush their pending writes"""
+        for service in (self.cr_registry, self.group_cache, self.counters, self.state, self.expiry):
+            if service:
+                await service.stop()
+        if self.ocr:
+            self.ocr.close()
+        if self.database:
+            self.database.close()
+
     # ... (init_default_knowledge_base, get_support_groups - keep if needed) ...
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -168,7 +264,6 @@ class SupportBot:
         user_message_lower = update.message.text.lower()
         user_data = context.user_data
         current_flow = user_data.get('vip_or_mentorship_flow')
-        current_step = user_data.get('current_step')
 
         # 1. Greeting Recognition
         if any(greeting in user_message_lower for greeting in GREETING_KEYWORDS) and not current_flow:
@@ -178,18 +273,9 @@ class SupportBot:
                  await update.message.reply_text(f"Hello! How can I help you? If you're looking for VIP access or mentorship, please use the /start command.")
             return
 
-        # 2. Handle ongoing flows based on user_data
-        if current_flow == 'deriv_vip':
-            if current_step == 'awaiting_deriv_creation_date':
-                await self.process_deriv_creation_date(update, context, update.message.text)
-                return
-            elif current_step == 'awaiting_deriv_cr_number':
-                await self.process_deriv_cr_number(update, context, update.message.text)
-                return
-        elif current_flow == 'mentorship':
-            if current_step == 'awaiting_mentorship_cr_number':
-                await self.process_mentorship_cr_number(update, context, update.message.text)
-                return
+        # 2. Handle ongoing flows: the router looks up the handler for (flow, step)
+        if await self.router.dispatch_step(update, context, "text", update.message.text):
+            return
         
         # Fallback to original message handling (e.g., FAQ search) if no specific flow is active
         # For now, we'll just acknowledge if no flow is active and it's not a greeting
@@ -201,42 +287,29 @@ class SupportBot:
 
 
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if await self.router.dispatch_step(update, context, "photo"):
+            return
+        # Not expecting a photo for the current flow/step
+        # Check if it's for a general ticket after description
+        # For now, just ignore if not in a specific funding step
+        if context.user_data.get('general_ticket_awaits_photo'): # A custom flag you might set
+             await update.message.reply_text("Photo received for your general ticket. An agent will review it.")
+             # process photo for general ticket if needed
+
+    async def process_funding_screenshot(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_data = context.user_data
         current_flow = user_data.get('vip_or_mentorship_flow')
         current_step = user_data.get('current_step')
-        
-        required_amount = 0
-        ticket_type = ""
-        success_message = ""
-
-        if current_flow == 'deriv_vip' and current_step == 'awaiting_deriv_funding_screenshot':
-            required_amount = MIN_DEPOSIT_DERIV_VIP
-            ticket_type = "Deriv VIP"
-            success_message = "Deriv VIP access request."
-        elif current_flow == 'mentorship' and current_step == 'awaiting_mentorship_funding_screenshot':
-            required_amount = MIN_DEPOSIT_MENTORSHIP
-            ticket_type = "Free Mentorship"
-            success_message = "Free Mentorship access request."
-        else:
-            # Not expecting a photo for the current flow/step
-            # Check if it's for a general ticket after description
-            # For now, just ignore if not in a specific funding step
-            if user_data.get('general_ticket_awaits_photo'): # A custom flag you might set
-                 await update.message.reply_text("Photo received for your general ticket. An agent will review it.")
-                 # process photo for general ticket if needed
-            return
+        required_amount, ticket_type, success_message = FUNDING_SCREENSHOT_STEPS[(current_flow, current_step)]
+
+        # Read the amount off the screenshot (off the event loop, see ocr.py); when OCR
+        # is unavailable, busy, times out or finds nothing, fall back to the caption
+        from ocr import caption_amount
+
+        amount_detected = await self.screenshot_ocr().extract_amount(update.message.photo[-1])
+        if amount_detected is None:
+            amount_detected = caption_amount(update.message.caption)
 
-        # Simplified amount extraction from caption
-        # For robust OCR, you'd need a library like pytesseract
-        amount_detected = None
-        if update.message.caption:
-            numbers = re.findall(r'\b\d+\.?\d*\b', update.message.caption)
-            if numbers:
-                try:
-                    amount_detected = float(numbers[0]) # Take the first number found
-                except ValueError:
-                    pass
-        
         photo_file_id = update.message.photo[-1].file_id
 
         if amount_detected is not None and amount_detected >= required_amount:
@@ -258,169 +331,233 @@ class SupportBot:
              await update.message.reply_text(f"The amount in your screenshot (${amount_detected:.2f}) is less than the required ${required_amount:.2f}. Please deposit the correct amount and send a new screenshot.")
         else:
             # Amount not found in caption or less than required
-            await update.message.reply_text(f"I couldn't automatically detect the deposit amount from your screenshot's caption, or it was less than ${required_amount:.2f}. "
+            await update.message.reply_text(f"I couldn't automatically detect the deposit amount from your screenshot, or it was less than ${required_amount:.2f}. "
                                             f"Please ensure the deposit is at least ${required_amount:.2f} and reply with the amount you deposited (e.g., '$50' or '50'), or send the screenshot again with the amount in the caption.")
             user_data['awaiting_manual_amount_confirmation_after_photo'] = True
             user_data['photo_for_confirmation_file_id'] = photo_file_id
             # If user replies with amount text, handle_message should pick it up if you add logic for 'awaiting_manual_amount_confirmation_after_photo'
 
+    def _build_router(self) -> FlowRouter:
+        """Register every button and flow step in one table and check the graph is complete"""
+        router = FlowRouter(observer=observe_handler)
+
+        # --- Main Menu Options ---
+        router.callback("select_vip_type", self.select_vip_type_callback)
+        router.callback("start_command_reset", self.start_command) # Go back to main menu
+        router.callback("back_to_menu", self.start_command) # Old callback from the previous menu
+
+        # --- Deriv VIP Flow ---
+        router.callback("vip_deriv_start", self.vip_deriv_start_callback)
+        router.callback("deriv_procedure_yes", self.deriv_procedure_yes_callback)
+        router.callback("deriv_procedure_no", self.deriv_procedure_no_callback)
+        router.step("deriv_vip", "awaiting_deriv_creation_date", self.process_deriv_creation_date)
+        router.step("deriv_vip", "awaiting_deriv_cr_number", self.process_deriv_cr_number)
+
+        # --- Currencies VIP Flow ---
+        router.callback("vip_currencies_start", self.vip_currencies_start_callback)
+
+        # --- Free Mentorship Flow ---
+        router.callback("free_mentorship_start", self.free_mentorship_start_callback)
+        router.callback("mentorship_account_yes", self.mentorship_account_yes_callback)
+        router.callback("mentorship_account_no", self.mentorship_account_no_callback)
+        router.callback("mentorship_account_actions_after_link", self.mentorship_account_actions_after_link_callback)
+        router.step("mentorship", "awaiting_mentorship_cr_number", self.process_mentorship_cr_number)
+
+        # --- Deriv CR / Kennedynespot flow ---
+        router.callback("deriv_kennedynespot_yes", self.deriv_kennedynespot_yes_callback)
+        router.callback("deriv_kennedynespot_no", self.deriv_kennedynespot_no_callback)
+
+        # --- Funding screenshots ---
+        for flow, step in FUNDING_SCREENSHOT_STEPS:
+            router.step(flow, step, self.process_funding_screenshot, kind="photo")
+
+        # --- Support groups and tickets ---
+        router.prefix("connect_", self.connect_group_callback)
+        router.callback("cancel_connection", self.cancel_connection_callback)
+        router.prefix("take_", self.take_ticket_callback)
+        router.prefix("close_", self.close_ticket_callback)
+        router.callback("my_tickets", self.my_tickets_callback)
+        router.prefix("tickets_older_", self.older_tickets_callback)
+        router.prefix("tickets_newer_", self.newer_tickets_callback)
+        router.prefix("ticket_", self.ticket_details_callback)
+
+        # Everything the keyboards can send and every step a transition waits on must be routable
+        router.expect_callbacks(
+            "select_vip_type", "start_command_reset", "vip_deriv_start", "deriv_procedure_yes", "deriv_procedure_no",
+            "vip_currencies_start", "free_mentorship_start", "mentorship_account_yes", "mentorship_account_no",
+            "mentorship_account_actions_after_link", "deriv_kennedynespot_yes", "deriv_kennedynespot_no",
+            "connect_CONNECT_0", "cancel_connection", "take_TKT-0", "close_TKT-0", "my_tickets", "ticket_TKT-0",
+            "tickets_older_0_0", "tickets_newer_0_0",
+        )
+        router.expect_step("deriv_vip", "awaiting_deriv_creation_date")
+        router.expect_step("deriv_vip", "awaiting_deriv_cr_number")
+        router.expect_step("mentorship", "awaiting_mentorship_cr_number")
+        for flow, step in FUNDING_SCREENSHOT_STEPS:
+            router.expect_step(flow, step, kind="photo")
+        router.validate()
+        return router
+
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
-        data = query.data
-        user_data = context.user_data
-
-        # Clear previous step message if any
-        # prev_message_id = user_data.pop('current_step_message_id', None)
-        # if prev_message_id and query.message.message_id == user_data.get('main_selection_message_id'):
-        #     try: # This might fail if the message is the main menu itself
-        #         await context.bot.delete_message(chat_id=query.message.chat_id, message_id=prev_message_id)
-        #     except Exception as e:
-        #         logger.info(f"Could not delete previous step message: {e}")
-        # else: # Edit the current message
-        #    pass
+        if not await self.router.dispatch_callback(update, context):
+            # For now, let's log unhandled callbacks during this refactoring
+            logger.info(f"Unhandled callback_data: {query.data} in main button_callback")
 
-        # --- Main Menu Options ---
-        if data == "select_vip_type":
-            user_data.clear() # Reset for new selection
-            user_data['vip_or_mentorship_flow'] = 'vip_selection'
+    # --- Main Menu Options ---
+    async def select_vip_type_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        user_data.clear() # Reset for new selection
+        user_data['vip_or_mentorship_flow'] = 'vip_selection'
+        keyboard = [
+            [InlineKeyboardButton("📈 Deriv VIP (Synthetic Indices)", callback_data="vip_deriv_start")],
+            [InlineKeyboardButton("📊 Currencies VIP", callback_data="vip_currencies_start")],
+            [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="start_command_reset")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text("Which VIP/Premium group do you wish to join?", reply_markup=reply_markup)
+
+    # --- Deriv VIP Flow ---
+    async def vip_deriv_start_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        user_data.clear()
+        user_data['vip_or_mentorship_flow'] = 'deriv_vip'
+        user_data['current_step'] = 'awaiting_deriv_procedure_confirm'
+        keyboard = [
+            [InlineKeyboardButton("Yes, I did", callback_data="deriv_procedure_yes")],
+            [InlineKeyboardButton("No, I didn't", callback_data="deriv_procedure_no")],
+            [InlineKeyboardButton("🔙 Back", callback_data="select_vip_type")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(f"Welcome to Deriv VIP Onboarding!\n\n"
+                                      f"Have you created a Deriv account using this specific procedure link? \n🔗 {DERIV_PROCEDURE_LINK_TEXT}",
+                                      reply_markup=reply_markup, disable_web_page_preview=True)
+
+    async def deriv_procedure_yes_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        if user_data.get('vip_or_mentorship_flow') == 'deriv_vip':
+            user_data['current_step'] = 'awaiting_deriv_creation_date'
+            msg = await query.edit_message_text("Great! When did you create the account? Please enter the date (e.g., YYYY-MM-DD or DD/MM/YYYY).")
+            user_data['current_step_message_id'] = msg.message_id
+
+    async def deriv_procedure_no_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        if user_data.get('vip_or_mentorship_flow') == 'deriv_vip':
+            user_data.clear() # End this flow attempt
+            keyboard = [[InlineKeyboardButton("View Procedure Guide", url=DERIV_PROCEDURE_LINK_TEXT)],[InlineKeyboardButton("🔙 Back to VIP Selection", callback_data="select_vip_type")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await query.edit_message_text("To join Deriv VIP, you need to create an account using our specific procedure. "
+                                          "Please follow the guide and then restart this process.", reply_markup=reply_markup)
+
+    # --- Currencies VIP Flow ---
+    async def vip_currencies_start_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        user_data.clear()
+        user_data['vip_or_mentorship_flow'] = 'currencies_vip'
+        user_data['current_step'] = 'creating_ticket' # Immediate ticket
+
+        # Provide info, then create ticket
+        await query.edit_message_text(CURRENCIES_INFO_TEXT, parse_mode='Markdown', disable_web_page_preview=True)
+        
+        await self.create_specific_ticket(
+            update, context, "VIP Currencies",
+            "User selected Currencies VIP. User has been shown OctaFX and Vantage instructions.",
+            {"flow": "currencies_vip"}
+        )
+        user_data.clear() # Reset after ticket
+        await query.message.reply_text("A 'VIP Currencies Ticket' has been created. Please wait for the admin team to contact you. You can go /start again for other options.", 
+                                       reply_markup=keyboard((("🔙 Main Menu", "start_command_reset"),)))
+
+    # --- Free Mentorship Flow ---
+    async def free_mentorship_start_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        user_data.clear()
+        user_data['vip_or_mentorship_flow'] = 'mentorship'
+        user_data['current_step'] = 'awaiting_mentorship_account_exists_confirm'
+        keyboard = [
+            [InlineKeyboardButton("Yes, I have a Deriv account", callback_data="mentorship_account_yes")],
+            [InlineKeyboardButton("No, I need to create one", callback_data="mentorship_account_no")],
+            [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="start_command_reset")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text("Welcome to Free Mentorship Onboarding!\n\n"
+                                      "This mentorship requires a Deriv account funded under our partner link.\n"
+                                      "Do you already have a Deriv account?",
+                                      reply_markup=reply_markup)
+
+    async def mentorship_account_yes_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        if user_data.get('vip_or_mentorship_flow') == 'mentorship':
+            user_data['current_step'] = 'awaiting_mentorship_cr_number'
+            msg = await query.edit_message_text("Okay, please provide your Deriv Client ID (CR Number, e.g., CR123456).")
+            user_data['current_step_message_id'] = msg.message_id
+
+    async def mentorship_account_no_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        if user_data.get('vip_or_mentorship_flow') == 'mentorship':
+            user_data['current_step'] = 'told_to_create_account_for_mentorship'
             keyboard = [
-                [InlineKeyboardButton("📈 Deriv VIP (Synthetic Indices)", callback_data="vip_deriv_start")],
-                [InlineKeyboardButton("📊 Currencies VIP", callback_data="vip_currencies_start")],
-                [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="start_command_reset")]
+                [InlineKeyboardButton("Open Deriv Account Now", url=DERIV_AFFILIATE_LINK)],
+                [InlineKeyboardButton("I've created it / I'll do it later", callback_data="mentorship_account_actions_after_link")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Which VIP/Premium group do you wish to join?", reply_markup=reply_markup)
-
-        elif data == "start_command_reset":
-            await self.start_command(update, context) # Go back to main menu
+            await query.edit_message_text(f"Please open a Deriv account using our recommended broker's link: \n🔗 {DERIV_AFFILIATE_LINK}\n\n"
+                                          "After creating and funding it with at least ${MIN_DEPOSIT_MENTORSHIP}, come back and we'll proceed.",
+                                          reply_markup=reply_markup, disable_web_page_preview=True)
 
-        # --- Deriv VIP Flow ---
-        elif data == "vip_deriv_start":
-            user_data.clear()
-            user_data['vip_or_mentorship_flow'] = 'deriv_vip'
-            user_data['current_step'] = 'awaiting_deriv_procedure_confirm'
-            keyboard = [
-                [InlineKeyboardButton("Yes, I did", callback_data="deriv_procedure_yes")],
-                [InlineKeyboardButton("No, I didn't", callback_data="deriv_procedure_no")],
-                [InlineKeyboardButton("🔙 Back", callback_data="select_vip_type")]
-            ]
+    async def mentorship_account_actions_after_link_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        # This could lead back to asking for CR number or funding proof
+        user_data['current_step'] = 'awaiting_mentorship_funding_screenshot_after_creation' # Or CR if they claim they already had one
+        await query.edit_message_text(f"Once your account is created using our link ({DERIV_AFFILIATE_LINK}) "
+                                      f"and funded with a minimum of ${MIN_DEPOSIT_MENTORSHIP}, please send a screenshot of the funded account balance here.\n"
+                                      "If you already had an account and just tagged it, we might need your CR number again if not yet provided.",
+                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="free_mentorship_start")]]))
+
+    # --- Deriv CR / Kennedynespot flow ---
+    async def deriv_kennedynespot_yes_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        if user_data.get('current_step') == 'awaiting_kennedynespot_confirm':
+            user_data['current_step'] = 'told_to_dm_kennedy_proof'
+            await query.edit_message_text("Please send us a direct message (DM) with a screenshot of the confirmation from our partner (Kennedynespot) showing you are tagged under them. "
+                                          f"You can message the admin here: {ADMIN_TELEGRAM_LINK}",
+                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to VIP Selection", callback_data="select_vip_type")]]))
+    
+    async def deriv_kennedynespot_no_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query; user_data = context.user_data
+        if user_data.get('current_step') == 'awaiting_kennedynespot_confirm':
+            user_data['current_step'] = 'told_to_follow_tagging_guide'
+            keyboard = [[InlineKeyboardButton("View Tagging Guide", url=DERIV_TAGGING_GUIDE_LINK)], [InlineKeyboardButton("🔙 Back to VIP Selection", callback_data="select_vip_type")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(f"Welcome to Deriv VIP Onboarding!\n\n"
-                                          f"Have you created a Deriv account using this specific procedure link? \n🔗 {DERIV_PROCEDURE_LINK_TEXT}",
+            await query.edit_message_text("Please follow the tagging guide to ensure your account is under our partner: "
+                                          f"{DERIV_TAGGING_GUIDE_LINK}\n\n"
+                                          "After completing the steps and waiting 24 hours for systems to update, please try the Deriv VIP verification again from /start.",
                                           reply_markup=reply_markup, disable_web_page_preview=True)
 
-        elif data == "deriv_procedure_yes":
-            if user_data.get('vip_or_mentorship_flow') == 'deriv_vip':
-                user_data['current_step'] = 'awaiting_deriv_creation_date'
-                msg = await query.edit_message_text("Great! When did you create the account? Please enter the date (e.g., YYYY-MM-DD or DD/MM/YYYY).")
-                user_data['current_step_message_id'] = msg.message_id
+    # --- Support groups and tickets ---
+    async def connect_group_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, connection_code: str):
+        await self.process_group_connection(update.callback_query, connection_code)
 
-        elif data == "deriv_procedure_no":
-            if user_data.get('vip_or_mentorship_flow') == 'deriv_vip':
-                user_data.clear() # End this flow attempt
-                keyboard = [[InlineKeyboardButton("View Procedure Guide", url=DERIV_PROCEDURE_LINK_TEXT)],[InlineKeyboardButton("🔙 Back to VIP Selection", callback_data="select_vip_type")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text("To join Deriv VIP, you need to create an account using our specific procedure. "
-                                              "Please follow the guide and then restart this process.", reply_markup=reply_markup)
+    async def cancel_connection_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.edit_message_text("❌ Connection request cancelled by user.")
 
-        # --- Currencies VIP Flow ---
-        elif data == "vip_currencies_start":
-            user_data.clear()
-            user_data['vip_or_mentorship_flow'] = 'currencies_vip'
-            user_data['current_step'] = 'creating_ticket' # Immediate ticket
-
-            # Provide info, then create ticket
-            info_text = (
-                "Welcome to Currencies VIP Services!\n\n"
-                "We offer premium signals through our partner brokers OctaFX and Vantage.\n"
-                "Please ensure you have followed the setup instructions for your chosen broker:\n\n"
-                f"{OCTAFX_INFO}\n\n---\n\n{VANTAGE_INFO}\n\n"
-                "I will now create a 'VIP Currencies Ticket' for you. Our admin team will follow up."
-            )
-            await query.edit_message_text(info_text, parse_mode='Markdown', disable_web_page_preview=True)
-            
-            await self.create_specific_ticket(
-                update, context, "VIP Currencies",
-                "User selected Currencies VIP. User has been shown OctaFX and Vantage instructions.",
-                {"flow": "currencies_vip"}
-            )
-            user_data.clear() # Reset after ticket
-            await query.message.reply_text("A 'VIP Currencies Ticket' has been created. Please wait for the admin team to contact you. You can go /start again for other options.", 
-                                           reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Main Menu", callback_data="start_command_reset")]]))
+    async def take_ticket_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
+        await self.handle_take_ticket(update.callback_query, context, ticket_id)
 
+    async def close_ticket_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
+        await self.handle_close_ticket(update.callback_query, context, ticket_id)
 
-        # --- Free Mentorship Flow ---
-        elif data == "free_mentorship_start":
-            user_data.clear()
-            user_data['vip_or_mentorship_flow'] = 'mentorship'
-            user_data['current_step'] = 'awaiting_mentorship_account_exists_confirm'
-            keyboard = [
-                [InlineKeyboardButton("Yes, I have a Deriv account", callback_data="mentorship_account_yes")],
-                [InlineKeyboardButton("No, I need to create one", callback_data="mentorship_account_no")],
-                [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="start_command_reset")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Welcome to Free Mentorship Onboarding!\n\n"
-                                          "This mentorship requires a Deriv account funded under our partner link.\n"
-                                          "Do you already have a Deriv account?",
-                                          reply_markup=reply_markup)
-
-        elif data == "mentorship_account_yes":
-            if user_data.get('vip_or_mentorship_flow') == 'mentorship':
-                user_data['current_step'] = 'awaiting_mentorship_cr_number'
-                msg = await query.edit_message_text("Okay, please provide your Deriv Client ID (CR Number, e.g., CR123456).")
-                user_data['current_step_message_id'] = msg.message_id
-        
-        elif data == "mentorship_account_no":
-            if user_data.get('vip_or_mentorship_flow') == 'mentorship':
-                user_data['current_step'] = 'told_to_create_account_for_mentorship'
-                keyboard = [
-                    [InlineKeyboardButton("Open Deriv Account Now", url=DERIV_AFFILIATE_LINK)],
-                    [InlineKeyboardButton("I've created it / I'll do it later", callback_data="mentorship_account_actions_after_link")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(f"Please open a Deriv account using our recommended broker's link: \n🔗 {DERIV_AFFILIATE_LINK}\n\n"
-                                              "After creating and funding it with at least ${MIN_DEPOSIT_MENTORSHIP}, come back and we'll proceed.",
-                                              reply_markup=reply_markup, disable_web_page_preview=True)
-
-        elif data == "mentorship_account_actions_after_link":
-            # This could lead back to asking for CR number or funding proof
-            user_data['current_step'] = 'awaiting_mentorship_funding_screenshot_after_creation' # Or CR if they claim they already had one
-            await query.edit_message_text(f"Once your account is created using our link ({DERIV_AFFILIATE_LINK}) "
-                                          f"and funded with a minimum of ${MIN_DEPOSIT_MENTORSHIP}, please send a screenshot of the funded account balance here.\n"
-                                          "If you already had an account and just tagged it, we might need your CR number again if not yet provided.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="free_mentorship_start")]]))
+    async def my_tickets_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.show_user_tickets(update.callback_query)
 
+    async def older_tickets_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, cursor: str):
+        await self.show_user_tickets(update.callback_query, cursor, older=True)
 
-        # --- Deriv CR / Kennedynespot flow ---
-        elif data == "deriv_kennedynespot_yes":
-            if user_data.get('current_step') == 'awaiting_kennedynespot_confirm':
-                user_data['current_step'] = 'told_to_dm_kennedy_proof'
-                await query.edit_message_text("Please send us a direct message (DM) with a screenshot of the confirmation from our partner (Kennedynespot) showing you are tagged under them. "
-                                              f"You can message the admin here: {ADMIN_TELEGRAM_LINK}",
-                                              reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to VIP Selection", callback_data="select_vip_type")]]))
-        
-        elif data == "deriv_kennedynespot_no":
-            if user_data.get('current_step') == 'awaiting_kennedynespot_confirm':
-                user_data['current_step'] = 'told_to_follow_tagging_guide'
-                keyboard = [[InlineKeyboardButton("View Tagging Guide", url=DERIV_TAGGING_GUIDE_LINK)], [InlineKeyboardButton("🔙 Back to VIP Selection", callback_data="select_vip_type")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text("Please follow the tagging guide to ensure your account is under our partner: "
-                                              f"{DERIV_TAGGING_GUIDE_LINK}\n\n"
-                                              "After completing the steps and waiting 24 hours for systems to update, please try the Deriv VIP verification again from /start.",
-                                              reply_markup=reply_markup, disable_web_page_preview=True)
-        
-        # Fallback for other button data (original bot functions)
-        # This part needs careful integration if you keep old FAQ/Ticket buttons
-        else:
-            # Basic navigation back
-            if data == "back_to_menu": # Assuming this was an old callback
-                await self.start_command(update, context)
-            # ... handle other pre-existing callbacks like faq_cat_, ticket_ etc. if you keep them ...
-            # For now, let's log unhandled callbacks during this refactoring
-            logger.info(f"Unhandled callback_data: {data} in main button_callback")
+    async def newer_tickets_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, cursor: str):
+        await self.show_user_tickets(update.callback_query, cursor, older=False)
 
+    async def ticket_details_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
+        await self.show_ticket_details(update.callback_query, ticket_id)
 
     async def process_deriv_creation_date(self, update: Update, context: ContextTypes.DEFAULT_TYPE, date_text: str):
         user_data = context.user_data
@@ -446,7 +583,7 @@ class SupportBot:
             await update.message.reply_text("Invalid CR number format. It should be 'CR' followed by numbers (e.g., CR12345). Please try again.")
             return
 
-        if cr_number in CR_NUMBERS_LIST:
+        if cr_number in self.cr_registry:
             user_data['cr_number_validated'] = cr_number
             user_data['current_step'] = 'awaiting_deriv_funding_screenshot'
             await update.message.reply_text(f"I can verify that CR number {cr_number} is tagged under us. Thank you!\n\n"
@@ -474,7 +611,7 @@ class SupportBot:
             await update.message.reply_text("Invalid CR number format. It should be 'CR' followed by numbers (e.g., CR12345). Please try again.")
             return
 
-        if cr_number in CR_NUMBERS_LIST:
+        if cr_number in self.cr_registry:
             user_data['cr_number_validated'] = cr_number
             user_data['current_step'] = 'awaiting_mentorship_funding_screenshot'
             await update.message.reply_text(f"CR number {cr_number} is verified under us. Great!\n\n"
@@ -515,8 +652,7 @@ class SupportBot:
             "name": f"{user.first_name or ''} {user.last_name or ''}".strip() or user.username or "N/A"
         }
         
-        count = await self.db.tickets.count_documents({"created_at": {"$gte": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)}})
-        ticket_id_num = f"TKT-{datetime.now().strftime('%Y%m%d')}-{count+1:04d}"
+        ticket_id_num = await self.ticket_ids.next_id()
         
         ticket_doc = {
             "ticket_id": ticket_id_num,
@@ -528,7 +664,6 @@ class SupportBot:
             "priority": "high", # VIP/Mentorship tickets might be high priority
             "created_at": datetime.now(),
             "updated_at": datetime.now(),
-            "messages": [{"from_user_id": user_id, "from_support": False, "sender_name": user_info["name"], "message": description, "timestamp": datetime.now()}],
             "assigned_to": None,
             "resolution": None,
             "ticket_type_custom": ticket_type, # explicit field for type
@@ -536,7 +671,19 @@ class SupportBot:
         }
         
         try:
-            await self.db.tickets.insert_one(ticket_doc)
+            for attempt in range(3):
+                try:
+                    await self.db.tickets.insert_one(ticket_doc)
+                    break
+                except DuplicateKeyError:
+                    # Only possible if something outside the allocator wrote this ID; take the next one
+                    if attempt == 2:
+                        raise
+                    ticket_doc.pop("_id", None)
+                    ticket_id_num = ticket_doc["ticket_id"] = await self.ticket_ids.next_id()
+            self.counters.opened()
+            context.application.create_task(self.tickets.add_message(ticket_id_num, {
+                "from_user_id": user_id, "from_support": False, "sender_name": user_info["name"], "message": description, "timestamp": ticket_doc["created_at"]}))
             confirmation_text = (f"✅ **{ticket_type} Ticket Created Successfully!**\n\n"
                                  f"🎫 **Ticket ID:** `{ticket_id_num}`\n"
                                  f"Our support team will review your request. You will be contacted shortly.")
@@ -545,7 +692,8 @@ class SupportBot:
             target_message = update.callback_query.message if update.callback_query else update.message
             await target_message.reply_text(confirmation_text, parse_mode='Markdown')
             
-            await self.forward_to_support_groups(context, ticket_doc)
+            # Fan-out runs in the background so the user isn't kept waiting on every group send
+            context.application.create_task(self.forward_to_support_groups(context, ticket_doc))
             logger.info(f"{ticket_type} ticket {ticket_id_num} created for user {user_id}")
 
         except Exception as e:
@@ -568,8 +716,7 @@ class SupportBot:
             logger.info("Default knowledge base initialized")
 
     async def get_support_groups(self): # Keep for forwarding tickets
-        cursor = self.db.groups.find({"status": "active"})
-        return await cursor.to_list(length=None)
+        return await self.group_cache.get_active()
 
     async def handle_group_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE): # Keep
         # ... (original code for group connection) ...
@@ -581,9 +728,10 @@ class SupportBot:
         existing_group = await self.db.groups.find_one({"group_id": chat.id})
         if existing_group:
             if existing_group.get("status") == "active": await update.message.reply_text(f"✅ This group is already connected as a support group!\nConnected on: {existing_group.get('connected_at', 'Unknown').strftime('%Y-%m-%d %H:%M:%S') if existing_group.get('connected_at') else 'Unknown'}"); return
-            else: await self.db.groups.update_one({"group_id": chat.id}, {"$set": {"status": "active", "reactivated_at": datetime.now()}}); await update.message.reply_text("✅ Support group reactivated successfully!"); return
+            else: await self.db.groups.update_one({"group_id": chat.id}, {"$set": {"status": "active", "reactivated_at": datetime.now()}}); await self.group_cache.invalidate(); await update.message.reply_text("✅ Support group reactivated successfully!"); return
         connection_code = f"CONNECT_{chat.id}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
-        self.pending_connections[connection_code] = {"group_id": chat.id, "group_name": chat.title, "admin_id": user.id, "admin_name": f"{user.first_name or ''} {user.last_name or ''}".strip() or user.username or "Admin", "expires_at": datetime.now() + timedelta(minutes=10)}
+        # One pending request per group: repeating /connect replaces it instead of piling up entries
+        await self.pending_connections.set(chat.id, {"code": connection_code, "group_id": chat.id, "group_name": chat.title, "admin_id": user.id, "admin_name": f"{user.first_name or ''} {user.last_name or ''}".strip() or user.username or "Admin", "expires_at": datetime.now() + timedelta(minutes=10)})
         keyboard = [[InlineKeyboardButton("🔗 Connect as Support Group", callback_data=f"connect_{connection_code}")], [InlineKeyboardButton("❌ Cancel", callback_data="cancel_connection")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(f"🔗 **Connect Support Group**\n\nGroup: {chat.title}\nAdmin: {user.first_name or user.username}\n\nClick the button below to connect this group as a support group. Support tickets will be forwarded here for your team to handle.\n\n⏰ This connection request expires in 10 minutes.", reply_markup=reply_markup, parse_mode='Markdown')
@@ -612,21 +760,24 @@ class SupportBot:
         group_check = await self.db.groups.find_one({"group_id": chat.id, "status": "active"})
         if not group_check: await update.message.reply_text("❌ This group is not currently connected as an active support group."); return
         result = await self.db.groups.update_one({"group_id": chat.id}, {"$set": {"status": "inactive", "disconnected_at": datetime.now()}})
-        if result.modified_count > 0: await update.message.reply_text("✅ Support group disconnected successfully. No new tickets will be forwarded to this group.")
+        if result.modified_count > 0: await self.group_cache.invalidate(); await update.message.reply_text("✅ Support group disconnected successfully. No new tickets will be forwarded to this group.")
         else: await update.message.reply_text("❌ This group is not connected as a support group or was already inactive.")
 
 
     async def process_group_connection(self, query: Update.callback_query, connection_code_from_button: str): # Keep
         # ... (original code for group connection processing) ...
         actual_code = connection_code_from_button.replace("connect_", "")
-        connection_data = self.pending_connections.get(actual_code)
-        if not connection_data: await query.edit_message_text("❌ Connection request invalid or already processed."); return
-        if datetime.now() > connection_data["expires_at"]: del self.pending_connections[actual_code]; await query.edit_message_text("❌ Connection request expired."); return
+        try: group_id = int(actual_code.split("_")[1])  # CONNECT_<group id>_<timestamp>
+        except (IndexError, ValueError): group_id = None
+        connection_data = await self.pending_connections.get(group_id) if group_id is not None else None
+        if not connection_data or connection_data.get("code") != actual_code: await query.edit_message_text("❌ Connection request invalid or already processed."); return
+        if datetime.now() > connection_data["expires_at"]: await self.pending_connections.delete(group_id); await query.edit_message_text("❌ Connection request expired."); return
         if query.from_user.id != connection_data["admin_id"]: await query.answer("Only the admin who initiated this can connect the group.", show_alert=True); return
         group_doc = {"group_id": connection_data["group_id"], "group_name": connection_data["group_name"], "admin_id": connection_data["admin_id"], "admin_name": connection_data["admin_name"], "status": "active", "connected_at": datetime.now(), "tickets_forwarded": 0}
         try:
             await self.db.groups.update_one({"group_id": connection_data["group_id"]}, {"$set": group_doc}, upsert=True)
-            del self.pending_connections[actual_code]
+            await self.group_cache.invalidate()
+            await self.pending_connections.delete(group_id)
             await query.edit_message_text(f"✅ **Support Group Connected Successfully!**\n\nGroup: {connection_data['group_name']}\nConnected by: {connection_data['admin_name']}\n\n🎫 Support tickets will now be forwarded to this group.\n📋 Use /disconnect to disconnect this group later.", parse_mode='Markdown')
             logger.info(f"Support group connected: {connection_data['group_name']} ({connection_data['group_id']})")
         except Exception as e: logger.error(f"Error connecting support group: {e}"); await query.edit_message_text("❌ Error connecting support group. Please try again.")
@@ -637,112 +788,108 @@ class SupportBot:
             logger.warning(f"Ticket {ticket_doc['ticket_id']} created, but no active support groups connected.")
             return
 
-        user_contact = f"@{ticket_doc['user_info']['username']}" if ticket_doc['user_info']['username'] else f"User ID: {ticket_doc['user_info']['id']}"
-        
-        # Enhanced support text for new ticket types
-        support_text = f"🆕 **New {ticket_doc.get('ticket_type_custom', 'Support Ticket')}**\n\n" \
-                       f"🎫 **ID:** `{ticket_doc['ticket_id']}`\n" \
-                       f"👤 **User:** {ticket_doc['user_info']['name']} ({user_contact})\n" \
-                       f"📂 **Type/Category:** {ticket_doc['category']}\n" \
-                       f"📅 **Created:** {ticket_doc['created_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n" \
-                       f"📝 **Description/Details:**\n{ticket_doc['description']}\n\n"
+        support_text = self.support_ticket_text(ticket_doc)
+        return await self.fanout.broadcast(context.bot, ticket_doc['ticket_id'], support_groups, support_text, ticket_actions_keyboard(ticket_doc['ticket_id']))
+
+    def support_ticket_text(self, ticket_doc) -> str:
+        """The ticket card posted to support groups (and re-rendered when it is taken or closed)"""
+        return self.ticket_cards.get(ticket_doc, self._render_ticket_card)
 
+    def _render_ticket_card(self, ticket_doc) -> str:
+        user_info = ticket_doc['user_info']
+        support_text = TICKET_CARD.render(
+            ticket_type=ticket_doc.get('ticket_type_custom', 'Support Ticket'), ticket_id=Raw(ticket_doc['ticket_id']),
+            name=user_info['name'], contact=f"@{user_info['username']}" if user_info['username'] else f"User ID: {user_info['id']}",
+            category=ticket_doc['category'], created_at=ticket_doc['created_at'], description=ticket_doc['description'])
         if ticket_doc.get('flow_details'):
             support_text += "**Flow Specific Info:**\n"
             for key, value in ticket_doc['flow_details'].items():
-                support_text += f"- {key.replace('_', ' ').title()}: {value}\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("🙋‍♂️ Take Ticket", callback_data=f"take_{ticket_doc['ticket_id']}")],
-            [InlineKeyboardButton("🔒 Close Ticket", callback_data=f"close_{ticket_doc['ticket_id']}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        for group in support_groups:
-            try:
-                await context.bot.send_message(chat_id=group["group_id"], text=support_text, reply_markup=reply_markup, parse_mode='Markdown')
-                await self.db.groups.update_one({"_id": group["_id"]}, {"$inc": {"tickets_forwarded": 1, "open_tickets_count": 1}}) # Assuming you track open tickets
-            except Exception as e:
-                logger.error(f"Failed to forward ticket {ticket_doc['ticket_id']} to group {group['group_name']} ({group['group_id']}): {e}")
+                support_text += DETAIL_LINE.render(label=field_label(key), value=value)
+        return support_text
 
     # Keep handle_take_ticket, handle_close_ticket, show_user_tickets, show_ticket_details
     # Their functionality related to agents handling general tickets is likely still useful.
     # You might want to adapt the displayed ticket details if `flow_details` is important for agents to see directly.
 
     async def handle_take_ticket(self, query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
-        # ... (original code) ...
         agent_user = query.from_user; agent_name = f"{agent_user.first_name or ''} {agent_user.last_name or ''}".strip() or agent_user.username
-        ticket = await self.db.tickets.find_one({"ticket_id": ticket_id})
-        if not ticket: await query.answer("Ticket not found.", show_alert=True); return
-        if ticket.get("assigned_to") and ticket.get("assigned_to") != agent_user.id: await query.answer(f"This ticket is already assigned to {ticket.get('assigned_to_name', 'another agent')}.", show_alert=True); return
-        elif ticket.get("assigned_to") == agent_user.id: await query.answer("You have already taken this ticket.", show_alert=True); return
-        if ticket.get("status") == "closed": await query.answer("This ticket is already closed.", show_alert=True); return
-        update_result = await self.db.tickets.update_one({"ticket_id": ticket_id, "status": {"$ne": "closed"}}, {"$set": {"assigned_to": agent_user.id, "assigned_to_name": agent_name, "status": "pending", "updated_at": datetime.now(), "$push": {"messages": {"from_support": True, "sender_name": "System", "message": f"Ticket taken by agent {agent_name}.", "timestamp": datetime.now()}}}})
-        if update_result.modified_count > 0:
-            await query.answer(f"You've taken ticket {ticket_id}.", show_alert=True)
-            original_message = query.message; new_text = original_message.text + f"\n\n---\n**🧑‍💻 Taken by:** {agent_name} at {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-            new_keyboard = [[InlineKeyboardButton("🔒 Close Ticket", callback_data=f"close_{ticket_id}")]]; await query.edit_message_text(text=new_text, reply_markup=InlineKeyboardMarkup(new_keyboard), parse_mode='Markdown')
-            try: await context.bot.send_message(chat_id=ticket["user_id"], text=f"ℹ️ Ticket `{ticket_id}` has been assigned to agent {agent_name}. They will review your issue shortly.", parse_mode='Markdown')
-            except Exception as e: logger.error(f"Failed to notify user {ticket['user_id']} about assignment: {e}")
-        else: await query.answer("Could not take the ticket. It might be closed or already assigned.", show_alert=True)
+        now = datetime.now()
+        # Precondition in the filter: of several agents clicking at once exactly one gets the ticket back
+        ticket = await self.tickets.take(ticket_id, agent_user.id, agent_name, now)
+        if not ticket:
+            # Only a refused click pays for a second read, to say why
+            current = await self.tickets.get(ticket_id, "status")
+            if not current: await query.answer("Ticket not found.", show_alert=True)
+            elif current.get("status") == "closed": await query.answer("This ticket is already closed.", show_alert=True)
+            elif current.get("assigned_to") == agent_user.id: await query.answer("You have already taken this ticket.", show_alert=True)
+            else: await query.answer(f"This ticket is already assigned to {current.get('assigned_to_name', 'another agent')}.", show_alert=True)
+            return
+        context.application.create_task(self.tickets.add_message(ticket_id, {
+            "from_support": True, "sender_name": "System", "message": f"Ticket taken by agent {agent_name}.", "timestamp": now}))
+        await query.answer(f"You've taken ticket {ticket_id}.", show_alert=True)
+        new_text = self.support_ticket_text(ticket) + TAKEN_FOOTER.render(name=ticket['assigned_to_name'], at=ticket['updated_at'])
+        await query.edit_message_text(text=new_text, reply_markup=ticket_actions_keyboard(ticket_id, take=False), parse_mode='Markdown')
+        # The user's DM goes through the outbox so the agent's click doesn't wait on it
+        await self.notifications.enqueue(f"ticket:{ticket_id}:taken", ticket["user_id"], f"ℹ️ Ticket `{ticket_id}` has been assigned to agent {escape_md(agent_name)}. They will review your issue shortly.")
 
     async def handle_close_ticket(self, query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE, ticket_id: str):
-        # ... (original code) ...
         agent_user = query.from_user; agent_name = f"{agent_user.first_name or ''} {agent_user.last_name or ''}".strip() or agent_user.username
-        ticket = await self.db.tickets.find_one({"ticket_id": ticket_id})
-        if not ticket: await query.answer("Ticket not found.", show_alert=True); return
-        if ticket.get("status") == "closed": await query.answer("This ticket is already closed.", show_alert=True); return
-        update_result = await self.db.tickets.update_one({"ticket_id": ticket_id}, {"$set": {"status": "closed", "closed_by_name": agent_name, "closed_by_id": agent_user.id, "updated_at": datetime.now(), "resolution": ticket.get("resolution", "Closed by support agent."), "$push": {"messages": {"from_support": True, "sender_name": "System", "message": f"Ticket closed by agent {agent_name}.", "timestamp": datetime.now()}}}})
-        if update_result.modified_count > 0:
-            await query.answer(f"Ticket {ticket_id} has been closed.", show_alert=True)
-            original_message = query.message; new_text = original_message.text.split("\n\n---")[0] + f"\n\n---\n**🔴 Closed by:** {agent_name} at {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-            await query.edit_message_text(text=new_text, reply_markup=None, parse_mode='Markdown')
-            if query.message and query.message.chat: await self.db.groups.update_one({"group_id": query.message.chat.id}, {"$inc": {"open_tickets_count": -1}})
-            try: await context.bot.send_message(chat_id=ticket["user_id"], text=f"✅ Ticket `{ticket_id}` has been marked as closed by our support team. If your issue is not resolved, please create a new ticket.", parse_mode='Markdown')
-            except Exception as e: logger.error(f"Failed to notify user {ticket['user_id']} about ticket closure: {e}")
-        else: await query.answer("Could not close the ticket.", show_alert=True)
-
-    async def show_user_tickets(self, query: Update.callback_query): # Minor adaptation for clarity
+        now = datetime.now()
+        ticket = await self.tickets.close(ticket_id, agent_user.id, agent_name, now)
+        if not ticket:
+            exists = await self.tickets.get(ticket_id, "status")
+            await query.answer("This ticket is already closed." if exists else "Ticket not found.", show_alert=True)
+            return
+        context.application.create_task(self.tickets.add_message(ticket_id, {
+            "from_support": True, "sender_name": "System", "message": f"Ticket closed by agent {agent_name}.", "timestamp": now}))
+        await query.answer(f"Ticket {ticket_id} has been closed.", show_alert=True)
+        new_text = self.support_ticket_text(ticket) + CLOSED_FOOTER.render(name=ticket['closed_by_name'], at=ticket['updated_at'])
+        await query.edit_message_text(text=new_text, reply_markup=None, parse_mode='Markdown')
+        # Every group the ticket went to counts it as open; tickets from before forwarded_to was recorded fall back to this group
+        self.counters.closed(ticket.get("forwarded_to") or ([query.message.chat.id] if query.message and query.message.chat else []))
+        await self.notifications.enqueue(f"ticket:{ticket_id}:closed", ticket["user_id"], f"✅ Ticket `{ticket_id}` has been marked as closed by our support team. If your issue is not resolved, please create a new ticket.")
+
+    async def show_user_tickets(self, query: Update.callback_query, cursor: str | None = None, older: bool = True): # Minor adaptation for clarity
         user_id = query.from_user.id
-        tickets_cursor = self.db.tickets.find({"user_id": user_id}).sort("created_at", -1).limit(10)
-        tickets = await tickets_cursor.to_list(length=None)
+        tickets, has_newer, has_older = await self.tickets.user_tickets_page(user_id, cursor, older)
+        if not tickets and cursor: # Nothing past a stale cursor: start again from the newest
+            tickets, has_newer, has_older = await self.tickets.user_tickets_page(user_id)
 
         if not tickets:
             await query.edit_message_text("📊 **My Tickets**\n\nYou don't have any support tickets yet.\n"
                                           "Use /start to create a VIP/Mentorship request or a general ticket.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data="start_command_reset")]]), parse_mode='Markdown')
+                                          reply_markup=keyboard((("🔙 Back to Menu", "start_command_reset"),)), parse_mode='Markdown')
             return
 
-        keyboard = []
-        status_emojis = {"open": "🟢", "closed": "🔴", "pending": "🟡", "on-hold": "🟠"}
+        rows = []
         for ticket in tickets:
-            emoji = status_emojis.get(ticket["status"], "⚪️")
+            emoji = STATUS_EMOJIS.get(ticket["status"], "⚪️")
             ticket_display_category = ticket.get('ticket_type_custom', ticket['category'].title())
-            keyboard.append([InlineKeyboardButton(f"{emoji} {ticket['ticket_id']} - {ticket_display_category} ({ticket['status']})", callback_data=f"ticket_{ticket['ticket_id']}")])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="start_command_reset")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"📊 **My Tickets** (Showing last {len(tickets)})\n\nSelect a ticket to view details:", reply_markup=reply_markup, parse_mode='Markdown')
+            rows.append([InlineKeyboardButton(f"{emoji} {ticket['ticket_id']} - {ticket_display_category} ({ticket['status']})", callback_data=f"ticket_{ticket['ticket_id']}")])
+
+        pager = []
+        if has_newer: pager.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"tickets_newer_{encode_cursor(tickets[0])}"))
+        if has_older: pager.append(InlineKeyboardButton("Older ➡️", callback_data=f"tickets_older_{encode_cursor(tickets[-1])}"))
+        if pager: rows.append(pager)
+        rows.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="start_command_reset")])
+        reply_markup = InlineKeyboardMarkup(rows)
+        await query.edit_message_text(f"📊 **My Tickets** (Showing {len(tickets)})\n\nSelect a ticket to view details:", reply_markup=reply_markup, parse_mode='Markdown')
 
     async def show_ticket_details(self, query: Update.callback_query, ticket_id_str: str): # Adapt to show flow_details
-        ticket = await self.db.tickets.find_one({"ticket_id": ticket_id_str, "user_id": query.from_user.id})
+        ticket = await self.tickets.get(ticket_id_str, "details", user_id=query.from_user.id)
         if not ticket:
             await query.edit_message_text("❌ Ticket not found or you don't have permission to view it.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📊 My Tickets", callback_data="my_tickets")]]))
+                                          reply_markup=keyboard((("📊 My Tickets", "my_tickets"),)))
             return
 
-        status_emojis = {"open": "🟢", "closed": "🔴", "pending": "🟡", "on-hold": "🟠"}
-        status_emoji = status_emojis.get(ticket["status"], "⚪️")
-        ticket_display_category = ticket.get('ticket_type_custom', ticket['category'].title())
+        reply_markup = keyboard((("📊 Back to My Tickets", "my_tickets"),), (("🔙 Main Menu", "start_command_reset"),))
+        await query.edit_message_text(self.ticket_details.get(ticket, self._render_ticket_details), reply_markup=reply_markup, parse_mode='Markdown')
 
-        details_text = f"🎫 **Ticket Details**\n\n" \
-                       f"**ID:** `{ticket['ticket_id']}`\n" \
-                       f"**Status:** {status_emoji} {ticket['status'].title()}\n" \
-                       f"**Type/Category:** {ticket_display_category}\n" \
-                       f"**Priority:** {ticket.get('priority', 'Normal').title()}\n" \
-                       f"**Created:** {ticket['created_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}\n" \
-                       f"**Last Updated:** {ticket['updated_at'].strftime('%Y-%m-%d %H:%M:%S UTC')}\n\n" \
-                       f"**Description:**\n{ticket['description']}\n\n"
+    def _render_ticket_details(self, ticket) -> str:
+        details_text = TICKET_DETAILS.render(
+            ticket_id=Raw(ticket['ticket_id']), status_emoji=STATUS_EMOJIS.get(ticket["status"], "⚪️"), status=ticket['status'].title(),
+            category=ticket.get('ticket_type_custom', ticket['category'].title()), priority=ticket.get('priority', 'Normal').title(),
+            created_at=ticket['created_at'], updated_at=ticket['updated_at'], description=ticket['description'])
 
         if ticket.get('flow_details'):
             details_text += "**Submission Details:**\n"
@@ -750,17 +897,12 @@ class SupportBot:
                 if key == "screenshot_file_id": # Don't show file_id to user
                     details_text += f"- Screenshot Provided: Yes\n"
                 else:
-                    details_text += f"- {key.replace('_', ' ').title()}: {value}\n"
+                    details_text += DETAIL_LINE.render(label=field_label(key), value=value)
             details_text += "\n"
             
-        if ticket.get('assigned_to_name'): details_text += f"**Assigned To:** {ticket['assigned_to_name']}\n"
-        if ticket.get('resolution'): details_text += f"**Resolution:**\n{ticket['resolution']}\n"
-        
-        # ... rest of message history if needed ...
-        keyboard = [[InlineKeyboardButton("📊 Back to My Tickets", callback_data="my_tickets")],
-                    [InlineKeyboardButton("🔙 Main Menu", callback_data="start_command_reset")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(details_text, reply_markup=reply_markup, parse_mode='Markdown')
+        if ticket.get('assigned_to_name'): details_text += f"**Assigned To:** {escape_md(ticket['assigned_to_name'])}\n"
+        if ticket.get('resolution'): details_text += f"**Resolution:**\n{escape_md(ticket['resolution'])}\n"
+        return details_text
 
     # Any other original methods like show_faq_categories, process_ticket_input (if general tickets are kept)
     # would need to be reviewed to ensure they integrate smoothly or are explicitly chosen paths.
@@ -768,47 +910,322 @@ class SupportBot:
 
 
 # === Main Application Setup ===
-async def main():
-    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
-    mongodb_uri = os.environ.get("MONGODB_URI")
+SHARDS = int(os.environ.get("SHARDS", 1)) # >1: updates are handled by this many worker processes, see sharding.py
 
-    if not bot_token or not mongodb_uri:
-        logger.error("TELEGRAM_BOT_TOKEN or MONGODB_URI environment variables not set.")
-        return
 
-    bot_app = SupportBot(bot_token, mongodb_uri)
-    await bot_app.init_database()
+async def build_application(bot_app, bot_token, shards: int = 1):
+    """The PTB application with every handler registered; used by single-process mode and by each shard.
 
-    application = Application.builder().token(bot_token).build()
+    Returns (application, outbound scheduler, flood guard).
+    """
+    # Bot API calls go through an instrumented request so their latency shows up on /metrics,
+    # and sends/edits are queued and paced to Telegram's limits by the outbound scheduler.
+    # Shards share the bot's global and per-group limits (any shard may post to a group), so each gets an equal part of them.
+    outbound = OutboundScheduler(global_rate=GLOBAL_MESSAGES_PER_SECOND / shards, group_per_minute=GROUP_MESSAGES_PER_MINUTE / shards, max_queue=int(os.environ.get("OUTBOUND_MAX_QUEUE", 5000)))
+    application = Application.builder().token(bot_token).request(InstrumentedRequest(connection_pool_size=256)).rate_limiter(outbound).build()
+
+    # Per-user flood limits run first, so spam is dropped before any state load or database work
+    flood_guard = FloodGuard({"text": int(os.environ.get("FLOOD_TEXT_PER_MINUTE", 20)), "photo": int(os.environ.get("FLOOD_PHOTOS_PER_MINUTE", 5))},
+                             shared=bot_app.db.flood_windows if os.environ.get("FLOOD_SHARED") == "1" else None)
+    if not profiler.profiling:
+        await flood_guard.ensure_indexes()
+    flood_guard.install(application)
 
     # Add handlers for new flows
-    application.add_handler(CommandHandler("start", bot_app.start_command))
-    application.add_handler(CommandHandler("help", bot_app.help_command))
+    application.add_handler(CommandHandler("start", instrument("start_command", bot_app.start_command)))
+    application.add_handler(CommandHandler("help", instrument("help_command", bot_app.help_command)))
     
     # Group management commands
-    application.add_handler(CommandHandler("connect", bot_app.connect_command))
-    application.add_handler(CommandHandler("disconnect", bot_app.disconnect_command))
+    application.add_handler(CommandHandler("connect", instrument("connect_command", bot_app.connect_command)))
+    application.add_handler(CommandHandler("disconnect", instrument("disconnect_command", bot_app.disconnect_command)))
 
     # Message handler needs to be more sophisticated for states
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot_app.handle_message))
-    application.add_handler(MessageHandler(filters.PHOTO, bot_app.handle_photo))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("handle_message", bot_app.handle_message)))
+    application.add_handler(MessageHandler(filters.PHOTO, instrument("handle_photo", bot_app.handle_photo)))
     
-    application.add_handler(CallbackQueryHandler(bot_app.button_callback))
+    application.add_handler(CallbackQueryHandler(instrument("button_callback", bot_app.button_callback)))
+
+    # Load/save each user's flow state around the handlers above so flows survive restarts
+    UserDataSync(bot_app.state, ttl=int(os.environ.get("USER_STATE_TTL", 86400)), expiry=bot_app.expiry,
+                 idle_ttl=float(os.environ.get("USER_DATA_IDLE_TTL", 900))).install(application)
+    return application, outbound, flood_guard
 
-    # Add other handlers from original bot if still needed (e.g., for general tickets, FAQ Browse)
-    # Example: If you still want the old "create_ticket" button to work for general inquiries:
-    # application.add_handler(CallbackQueryHandler(bot_app.button_callback, pattern="^create_ticket$")) 
-    # But ensure the button_callback logic for "create_ticket" is distinct or adapted.
 
-    logger.info("Bot starting...")
+def register_gauges(bot_app, update_queue_depth):
+    registry.gauge("bot_update_queue_depth", "Updates waiting to be processed", update_queue_depth)
+    registry.gauge("bot_ocr_queue_depth", "Screenshots being OCR'd", lambda: bot_app.ocr.queue_depth() if bot_app.ocr else 0)
+    registry.gauge("bot_expiring_entries", "Live entries awaiting expiry, by kind", lambda: bot_app.expiry.stats()["live_by_kind"], ("kind",))
+    registry.gauge("bot_cr_registry_numbers", "CR numbers in the affiliate registry", lambda: len(bot_app.cr_registry) if bot_app.cr_registry else 0)
+    registry.gauge("bot_cr_registry_bytes", "Memory used by the CR registry index", lambda: bot_app.cr_registry.memory_usage() if bot_app.cr_registry else 0)
+
+
+async def run_shard(index: int, bot_token, mongodb_uri):
+    """One worker process of the sharded runtime: handles the updates the front routes to it over stdin"""
+    from sharding import serve_shard
+
+    bot_app = SupportBot(bot_token, mongodb_uri)
+    await bot_app.init_database(primary=index == 0)
+    application, _outbound, _flood_guard = await build_application(bot_app, bot_token, SHARDS)
     await application.initialize()
     await application.start()
-    await application.updater.start_polling()
-    logger.info("Bot started and polling.")
-    
-    # Keep the application running
-    while True:
-        await asyncio.sleep(3600) # Sleep for an hour, or use a more robust keep-alive
+    if index == 0:
+        bot_app.notifications.start(application.bot) # the outbox is shared, so one shard delivers it
+    register_gauges(bot_app, application.update_queue.qsize)
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    logger.info(f"Shard {index} ready")
+    try:
+        await serve_shard(application, SHARDS, workers=int(os.environ.get("WEBHOOK_WORKERS", 4)),
+                          queue_size=int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000)), lag_monitor=lag_monitor,
+                          metrics=registry)
+    finally:
+        await bot_app.notifications.stop()
+        await application.stop()
+        await application.shutdown()
+        await lag_monitor.stop()
+        await bot_app.close()
+
+
+async def run_sharded_front(bot_token):
+    """Front process of the sharded runtime: receives updates (webhook or polling) and routes them to SHARDS workers.
+
+    Its /metrics includes every shard's metrics (labelled shard="N"), and /stats/shards and /health/shards
+    report the shards themselves. The services live in the shards, so the other /stats/* routes and the
+    ticket export are not served in this mode.
+    """
+    from aiohttp import web
+    from sharding import ShardSupervisor
+
+    supervisor = ShardSupervisor([sys.executable, os.path.abspath(__file__)], SHARDS)
+    await supervisor.start()
+
+    async def health_check(request):
+        return web.Response(text="OK")
+
+    web_app = web.Application()
+    web_app.router.add_get("/", health_check)
+    web_app.router.add_get("/health", health_check)
+    supervisor.install_health(web_app)
+    registry.federate(supervisor.metric_snapshots, "shard")
+    registry.install(web_app)
+
+    bot = Bot(bot_token, request=InstrumentedRequest())
+    await bot.initialize()
+    bot_mode = os.environ.get("BOT_MODE", "polling").lower()
+    if bot_mode == "webhook":
+        webhook_url = os.environ.get("WEBHOOK_URL")
+        webhook_secret = os.environ.get("WEBHOOK_SECRET")
+        if not webhook_url or not webhook_secret:
+            logger.error("WEBHOOK_URL and WEBHOOK_SECRET environment variables are required in webhook mode.")
+            await supervisor.stop()
+            return
+        webhook_path = os.environ.get("WEBHOOK_PATH", "/telegram")
+        supervisor.install(web_app, webhook_path, webhook_secret)
+
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    port = int(os.environ.get("PORT", 8080))
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info(f"Web server started on port {port}; routing updates to {SHARDS} shards")
+    LoopLagMonitor().start()
+
+    try:
+        if bot_mode == "webhook":
+            await bot.set_webhook(url=webhook_url.rstrip("/") + webhook_path, secret_token=webhook_secret,
+                                  allowed_updates=Update.ALL_TYPES,
+                                  max_connections=int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40)))
+            logger.info("Front started and receiving updates via webhook.")
+            while True:
+                await asyncio.sleep(3600)
+        else:
+            await bot.delete_webhook()
+            logger.info("Front started and polling.")
+            offset = None
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, read_timeout=40, allowed_updates=Update.ALL_TYPES)
+                except Exception as e:
+                    logger.error(f"getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    await supervisor.send(update.to_dict())
+                    offset = update.update_id + 1
+    finally:
+        await supervisor.stop()
+        await bot.shutdown()
+        await runner.cleanup()
+
+
+def build_web_app(bot_app, outbound, flood_guard):
+    """Health, stats and /metrics routes; aiohttp is only imported when the server is wanted"""
+    from aiohttp import web
+
+    async def health_check(request):
+        return web.Response(text="OK")
+
+    web_app = web.Application()
+    web_app.router.add_get("/", health_check)
+    web_app.router.add_get("/health", health_check)
+
+    async def expiry_stats(request):
+        return web.json_response(bot_app.expiry.stats())
+
+    web_app.router.add_get("/stats/expiry", expiry_stats)
+
+    async def ocr_stats(request):
+        return web.json_response(bot_app.ocr.stats() if bot_app.ocr else {"started": False})
+
+    web_app.router.add_get("/stats/ocr", ocr_stats)
+
+    async def group_cache_stats(request):
+        return web.json_response(bot_app.group_cache.stats())
+
+    web_app.router.add_get("/stats/groups", group_cache_stats)
+
+    async def cr_registry_stats(request):
+        stats = bot_app.cr_registry.stats() if bot_app.cr_registry else {"loaded": False}
+        return web.json_response(stats, dumps=lambda obj: json.dumps(obj, default=str))
+
+    web_app.router.add_get("/stats/cr_registry", cr_registry_stats)
+
+    async def ticket_stats(request):
+        return web.json_response(await bot_app.counters.read(), dumps=lambda obj: json.dumps(obj, default=str))
+
+    web_app.router.add_get("/stats/tickets", ticket_stats)
+
+    async def outbound_stats(request):
+        return web.json_response(outbound.stats())
+
+    web_app.router.add_get("/stats/outbound", outbound_stats)
+
+    async def notification_stats(request):
+        return web.json_response(await bot_app.notifications.stats())
+
+    web_app.router.add_get("/stats/notifications", notification_stats)
+
+    async def flood_stats(request):
+        return web.json_response(flood_guard.stats())
+
+    web_app.router.add_get("/stats/flood", flood_stats)
+
+    async def mongo_stats(request):
+        return web.json_response(bot_app.database.stats())
+
+    web_app.router.add_get("/stats/mongo", mongo_stats)
+    if os.environ.get("ADMIN_API_TOKEN"):
+        from ticket_export import install_export
+
+        install_export(web_app, bot_app.db.tickets, os.environ["ADMIN_API_TOKEN"])
+    registry.install(web_app)
+    return web_app
+
+
+async def main():
+    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    mongodb_uri = os.environ.get("MONGODB_URI")
+
+    if not bot_token or not mongodb_uri:
+        logger.error("TELEGRAM_BOT_TOKEN or MONGODB_URI environment variables not set.")
+        return
+
+    if SHARDS > 1:
+        from sharding import shard_index
+
+        index = shard_index()
+        if index is not None:
+            await run_shard(index, bot_token, mongodb_uri)
+        else:
+            await run_sharded_front(bot_token)
+        return
+
+    bot_mode = os.environ.get("BOT_MODE", "polling").lower()
+    if bot_mode == "webhook":
+        webhook_url = os.environ.get("WEBHOOK_URL")
+        webhook_secret = os.environ.get("WEBHOOK_SECRET")
+        if not webhook_url or not webhook_secret:
+            logger.error("WEBHOOK_URL and WEBHOOK_SECRET environment variables are required in webhook mode.")
+            return
+        webhook_path = os.environ.get("WEBHOOK_PATH", "/telegram")
+
+    bot_app = SupportBot(bot_token, mongodb_uri)
+    application = runner = ingestor = lag_monitor = None
+    try:
+        with profiler.phase("init_database"):
+            await bot_app.init_database()
+        with profiler.phase("build_application"):
+            application, outbound, flood_guard = await build_application(bot_app, bot_token)
+
+        # Add other handlers from original bot if still needed (e.g., for general tickets, FAQ Browse)
+        # Example: If you still want the old "create_ticket" button to work for general inquiries:
+        # application.add_handler(CallbackQueryHandler(bot_app.button_callback, pattern="^create_ticket$")) 
+        # But ensure the button_callback logic for "create_ticket" is distinct or adapted.
+
+        logger.info("Bot starting...")
+        with profiler.phase("ptb.initialize"):
+            await application.initialize()
+        if profiler.profiling:
+            # Report and stop before the outbox or PTB start, so nothing can reach Telegram or its users
+            profiler.ready()
+            print(profiler.report())
+            return
+        with profiler.phase("ptb.start"):
+            await application.start()
+        bot_app.notifications.start(application.bot)
+
+        # Health endpoint (and webhook receiver in webhook mode) share one aiohttp server
+        if WEB_SERVER or bot_mode == "webhook":
+            with profiler.phase("web_server"):
+                from aiohttp import web
+
+                web_app = build_web_app(bot_app, outbound, flood_guard)
+                if bot_mode == "webhook":
+                    from webhook import WebhookIngestor
+
+                    ingestor = WebhookIngestor(application, webhook_secret,
+                                               workers=int(os.environ.get("WEBHOOK_WORKERS", 4)),
+                                               queue_size=int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000)))
+                    ingestor.install(web_app, webhook_path)
+
+                runner = web.AppRunner(web_app)
+                await runner.setup()
+                port = int(os.environ.get("PORT", 8080))
+                await web.TCPSite(runner, "0.0.0.0", port).start()
+                logger.info(f"Web server started on port {port}")
+
+        register_gauges(bot_app, lambda: application.update_queue.qsize() + (ingestor.queue_depth() if ingestor else 0))
+        lag_monitor = LoopLagMonitor()
+        lag_monitor.start()
+        profiler.ready()
+
+        if ingestor:
+            await ingestor.start()
+            await application.bot.set_webhook(url=webhook_url.rstrip("/") + webhook_path, secret_token=webhook_secret,
+                                              allowed_updates=Update.ALL_TYPES,
+                                              max_connections=int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40)))
+            logger.info("Bot started and receiving updates via webhook.")
+        else:
+            await application.updater.start_polling()
+            logger.info("Bot started and polling.")
+        
+        # Keep the application running
+        while True:
+            await asyncio.sleep(3600) # Sleep for an hour, or use a more robust keep-alive
+    finally:
+        if ingestor:
+            await ingestor.stop()
+        if application:
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            await bot_app.notifications.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+        if lag_monitor:
+            await lag_monitor.stop()
+        if runner:
+            await runner.cleanup()
+        await bot_app.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = "tickets:stats"
+# Statuses a ticket can have before it is closed; the reconciliation query lists them
+# explicitly so it can use the status index instead of scanning for $ne "closed"
+OPEN_STATUSES = ("open", "pending", "on-hold")
+
+
+class TicketCounters:
+    """Per-group and global ticket counters kept up to date incrementally.
+
+    opened/forwarded/closed only add to in-memory deltas; a background task writes
+    them every `flush_interval` seconds with one bulk_write per collection. Each
+    group document carries `open_tickets_count` and `tickets_forwarded`, and the
+    counters collection holds the global totals under STATS_KEY, so a dashboard
+    reads them in O(1) with read().
+
+    Which groups a ticket is open in is recorded on the ticket (`forwarded_to`),
+    so closing it decrements every one of them. reconcile() rebuilds the open
+    counts, and restores lost tickets_forwarded increments, from the tickets
+    collection every `reconcile_interval` seconds to undo any drift (crashes
+    between event and flush, a close racing its own fan-out); 0 turns that off,
+    for processes that leave it to another one.
+    """
+
+    def __init__(self, db, flush_interval: float = 1.0, reconcile_interval: float = 3600):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.reconcile_interval = reconcile_interval
+        self._group_deltas = defaultdict(lambda: defaultdict(int))  # group_id -> field -> delta
+        self._global_deltas = defaultdict(int)
+        self._forwarded_to = defaultdict(set)  # ticket_id -> group_ids to record on the ticket
+        self._lock = asyncio.Lock()
+        self._tasks = []
+        self.last_reconciled_at = None
+
+    async def ensure_indexes(self):
+        await self.db.tickets.create_index("status")
+        # Sparse, so it holds exactly the tickets reconcile() matches with {"forwarded_to": {"$exists": True}}
+        await self.db.tickets.create_index("forwarded_to", sparse=True)
+
+    # --- events ---
+    def opened(self):
+        self._global_deltas["open"] += 1
+        self._global_deltas["total"] += 1
+
+    def forwarded(self, ticket_id: str, group_ids):
+        for group_id in group_ids:
+            deltas = self._group_deltas[group_id]
+            deltas["tickets_forwarded"] += 1
+            deltas["open_tickets_count"] += 1
+            self._forwarded_to[ticket_id].add(group_id)
+
+    def closed(self, group_ids):
+        for group_id in group_ids:
+            self._group_deltas[group_id]["open_tickets_count"] -= 1
+        self._global_deltas["open"] -= 1
+        self._global_deltas["closed"] += 1
+
+    # --- writes ---
+    async def flush(self):
+        """Write the accumulated deltas; on failure they are kept for the next flush"""
+        async with self._lock:
+            await self._flush()
+
+    async def _flush(self):
+        group_deltas, self._group_deltas = self._group_deltas, defaultdict(lambda: defaultdict(int))
+        global_deltas, self._global_deltas = self._global_deltas, defaultdict(int)
+        forwarded_to, self._forwarded_to = self._forwarded_to, defaultdict(set)
+        try:
+            if forwarded_to:
+                await self.db.tickets.bulk_write(
+                    [UpdateOne({"ticket_id": ticket_id}, {"$addToSet": {"forwarded_to": {"$each": sorted(ids)}}}) for ticket_id, ids in forwarded_to.items()],
+                    ordered=False)
+                forwarded_to = {}
+            ops = [UpdateOne({"group_id": group_id}, {"$inc": {k: v for k, v in deltas.items() if v}})
+                   for group_id, deltas in group_deltas.items() if any(deltas.values())]
+            if ops:
+                await self.db.groups.bulk_write(ops, ordered=False)
+            group_deltas = {}
+            increments = {k: v for k, v in global_deltas.items() if v}
+            if increments:
+                await self.db.counters.update_one({"_id": STATS_KEY}, {"$inc": increments}, upsert=True)
+        except Exception as e:
+            logger.error(f"Ticket counter flush failed, will retry: {e}")
+            # Put back whatever was not written, merged with events that arrived meanwhile
+            for group_id, deltas in group_deltas.items():
+                for k, v in deltas.items():
+                    self._group_deltas[group_id][k] += v
+            for k, v in global_deltas.items():
+                self._global_deltas[k] += v
+            for ticket_id, ids in forwarded_to.items():
+                self._forwarded_to[ticket_id] |= ids
+
+    async def reconcile(self):
+        """Recompute the counters from the tickets collection and overwrite the stored ones.
+
+        tickets_forwarded is only raised to the recomputed value ($max): it can only drift
+        down (increments lost before a flush), and tickets forwarded before they recorded
+        forwarded_to still count in the stored total but can't be recounted.
+        """
+        async with self._lock:
+            await self._flush()  # so pending deltas don't land on top of the recomputed totals
+            open_by_group, forwarded_by_group = {}, {}
+            pipeline = [
+                {"$match": {"forwarded_to": {"$exists": True}}},
+                {"$unwind": "$forwarded_to"},
+                {"$group": {"_id": "$forwarded_to", "forwarded": {"$sum": 1},
+                            "open": {"$sum": {"$cond": [{"$in": ["$status", list(OPEN_STATUSES)]}, 1, 0]}}}},
+            ]
+            async for row in self.db.tickets.aggregate(pipeline):
+                forwarded_by_group[row["_id"]] = row["forwarded"]
+                if row["open"]:
+                    open_by_group[row["_id"]] = row["open"]
+            open_total = 0
+            for status in OPEN_STATUSES:
+                open_total += await self.db.tickets.count_documents({"status": status})
+            closed_total = await self.db.tickets.count_documents({"status": "closed"})
+
+            ops = [UpdateOne({"group_id": group_id}, {"$set": {"open_tickets_count": open_by_group.get(group_id, 0)},
+                                                      "$max": {"tickets_forwarded": forwarded}})
+                   for group_id, forwarded in forwarded_by_group.items()]
+            if ops:
+                await self.db.groups.bulk_write(ops, ordered=False)
+            # Groups with no open tickets left
+            await self.db.groups.update_many({"group_id": {"$nin": list(open_by_group)}, "open_tickets_count": {"$ne": 0}},
+                                             {"$set": {"open_tickets_count": 0}})
+            self.last_reconciled_at = datetime.now(timezone.utc)
+            await self.db.counters.update_one({"_id": STATS_KEY}, {"$set": {
+                "open": open_total, "closed": closed_total, "total": open_total + closed_total, "reconciled_at": self.last_reconciled_at}}, upsert=True)
+        logger.info(f"Ticket counters reconciled: {open_total} open, {closed_total} closed across {len(open_by_group)} groups")
+
+    async def read(self) -> dict:
+        """Global totals plus open/forwarded counts per active group"""
+        stats = await self.db.counters.find_one({"_id": STATS_KEY}) or {}
+        groups = await self.db.groups.find({"status": "active"}, {"_id": 0, "group_id": 1, "group_name": 1, "open_tickets_count": 1, "tickets_forwarded": 1}).to_list(length=None)
+        return {"open": stats.get("open", 0), "closed": stats.get("closed", 0), "total": stats.get("total", 0),
+                "reconciled_at": stats.get("reconciled_at"), "groups": groups}
+
+    # --- background tasks ---
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _reconcile_loop(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Ticket counter reconciliation failed: {e}")
+            await asyncio.sleep(self.reconcile_interval)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._flush_loop())]
+            if self.reconcile_interval > 0:
+                self._tasks.append(asyncio.create_task(self._reconcile_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
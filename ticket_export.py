@@ -0,0 +1,204 @@
+"""Stream tickets out of (and back into) MongoDB as NDJSON or CSV.
+
+    python ticket_export.py export --db support_bot --status open --since 2024-01-01 > tickets.ndjson
+    python ticket_export.py export --db support_bot --format csv --type "Deriv VIP" --out tickets.csv
+    python ticket_export.py import --db support_bot_new --in tickets.ndjson
+
+The connection string comes from MONGODB_URI (or --uri). Exports read the
+collection in `_id` order through a batched cursor and write each batch as it
+arrives, so memory stays flat however many tickets match. NDJSON uses MongoDB
+extended JSON, so ObjectIds and dates survive an export/import round trip.
+CSV has one row per ticket with the columns in CSV_COLUMNS and is meant for
+spreadsheets, not re-import.
+"""
+import argparse
+import asyncio
+import csv
+import hmac
+import io
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+from database import MongoDatabase
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Dotted paths into the ticket document; dicts and lists are written as JSON
+CSV_COLUMNS = ("ticket_id", "user_id", "user_info.username", "user_info.name", "category", "ticket_type_custom", "status",
+               "priority", "created_at", "updated_at", "assigned_to_name", "closed_by_name", "resolution", "description",
+               "flow_details")
+DUPLICATE_KEY = 11000
+
+
+def ticket_filter(since: datetime | None = None, until: datetime | None = None, status: str | None = None,
+                  ticket_type: str | None = None) -> dict:
+    """Query for tickets created in [since, until) with the given status and ticket_type_custom"""
+    query = {}
+    if since or until:
+        query["created_at"] = {key: value for key, value in (("$gte", since), ("$lt", until)) if value}
+    if status:
+        query["status"] = status
+    if ticket_type:
+        query["ticket_type_custom"] = ticket_type
+    return query
+
+
+def _csv_value(doc: dict, path: str):
+    value = doc
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _csv_rows(rows) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _encode_batch(batch: list, fmt: str) -> bytes:
+    if fmt == "ndjson":
+        return "".join(json_util.dumps(doc) + "\n" for doc in batch).encode()
+    return _csv_rows([_csv_value(doc, column) for column in CSV_COLUMNS] for doc in batch)
+
+
+async def stream_tickets(collection, query: dict, fmt: str = "ndjson", batch_size: int = 500):
+    """Yield the matching tickets encoded as `fmt`, one chunk of bytes per cursor batch.
+
+    Sorted on _id, which is always indexed, so the server never has to sort in memory.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == "csv":
+        yield _csv_rows([CSV_COLUMNS])
+    batch = []
+    async for doc in collection.find(query).sort("_id", 1).batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield _encode_batch(batch, fmt)
+            batch = []
+    if batch:
+        yield _encode_batch(batch, fmt)
+
+
+async def import_tickets(collection, lines, chunk_size: int = 1000) -> dict:
+    """Insert NDJSON tickets from `lines` in chunks of `chunk_size` with insert_many(ordered=False).
+
+    Documents whose _id or ticket_id already exists are counted as duplicates and
+    skipped, so an interrupted import can simply be run again.
+    """
+    counts = {"inserted": 0, "duplicates": 0}
+
+    async def flush(chunk):
+        try:
+            result = await collection.insert_many(chunk, ordered=False)
+            counts["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            other = [error for error in errors if error.get("code") != DUPLICATE_KEY]
+            counts["inserted"] += e.details.get("nInserted", 0)
+            counts["duplicates"] += len(errors) - len(other)
+            if other:
+                raise
+
+    chunk = []
+    for line in lines:
+        if line.strip():
+            chunk.append(json_util.loads(line))
+        if len(chunk) >= chunk_size:
+            await flush(chunk)
+            chunk = []
+            logger.info(f"Imported {counts['inserted']} tickets ({counts['duplicates']} duplicates skipped)")
+    if chunk:
+        await flush(chunk)
+    return counts
+
+
+def _parse_date(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value else None
+
+
+def install_export(web_app, collection, token: str, path: str = "/admin/tickets/export"):
+    """Serve exports on `path` to requests with `Authorization: Bearer <token>`.
+
+    Query parameters: format (ndjson|csv), since, until (ISO dates), status, type.
+    """
+    from aiohttp import web
+
+    async def export(request):
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(supplied.encode("utf-8", "surrogateescape"), token.encode()):
+            raise web.HTTPForbidden()
+        fmt = request.query.get("format", "ndjson")
+        try:
+            query = ticket_filter(_parse_date(request.query.get("since")), _parse_date(request.query.get("until")),
+                                  request.query.get("status"), request.query.get("type"))
+        except ValueError:
+            raise web.HTTPBadRequest(text="since/until must be ISO dates")
+        if fmt not in FORMATS:
+            raise web.HTTPBadRequest(text=f"format must be one of {', '.join(FORMATS)}")
+        response = web.StreamResponse(headers={"Content-Type": FORMATS[fmt],
+                                               "Content-Disposition": f'attachment; filename="tickets.{fmt}"'})
+        await response.prepare(request)
+        async for chunk in stream_tickets(collection, query, fmt):
+            await response.write(chunk)  # waits while the client is slower than the cursor
+        await response.write_eof()
+        return response
+
+    web_app.router.add_get(path, export)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("--uri", default=os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))
+    parser.add_argument("--db", default="support_bot_new")
+    parser.add_argument("--collection", default="tickets")
+    parser.add_argument("--format", choices=tuple(FORMATS), default="ndjson")
+    parser.add_argument("--since", type=_parse_date, help="created at or after this ISO date")
+    parser.add_argument("--until", type=_parse_date, help="created before this ISO date")
+    parser.add_argument("--status")
+    parser.add_argument("--type", dest="ticket_type", help="ticket_type_custom")
+    parser.add_argument("--batch-size", type=int, default=500, help="cursor batch (export) or insert_many chunk (import)")
+    parser.add_argument("--out", help="export to this file instead of stdout")
+    parser.add_argument("--in", dest="infile", help="import from this file instead of stdin")
+    args = parser.parse_args()
+
+    database = MongoDatabase(args.uri, args.db)
+    collection = database.db[args.collection]
+    try:
+        if args.command == "export":
+            out = open(args.out, "wb") if args.out else sys.stdout.buffer
+            try:
+                async for chunk in stream_tickets(collection, ticket_filter(args.since, args.until, args.status, args.ticket_type),
+                                                  args.format, args.batch_size):
+                    out.write(chunk)
+            finally:
+                if args.out:
+                    out.close()
+        else:
+            lines = open(args.infile, encoding="utf-8") if args.infile else sys.stdin
+            try:
+                counts = await import_tickets(collection, lines, args.batch_size)
+            finally:
+                if args.infile:
+                    lines.close()
+            logger.info(f"Import finished: {counts['inserted']} inserted, {counts['duplicates']} duplicates skipped")
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(main())
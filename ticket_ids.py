@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+TICKET_ID_PREFIX = "TKT"
+
+
+def format_ticket_id(day: str, seq: int) -> str:
+    """Build a ticket ID in the TKT-YYYYMMDD-NNNN format"""
+    return f"{TICKET_ID_PREFIX}-{day}-{seq:04d}"
+
+
+def parse_ticket_id(ticket_id: str) -> tuple[str, int] | None:
+    """(day, seq) of a TKT-YYYYMMDD-NNNN ticket ID, or None for any other format"""
+    prefix, _, rest = ticket_id.partition("-")
+    day, _, seq = rest.partition("-")
+    if prefix != TICKET_ID_PREFIX or not (seq.isascii() and seq.isdigit()):
+        return None
+    return day, int(seq)
+
+
+def counter_key(day: str) -> str:
+    """_id of the counters document that allocates `day`'s ticket numbers"""
+    return f"ticket_id:{day}"
+
+
+class TicketIdAllocator:
+    """Hands out TKT-YYYYMMDD-NNNN ticket IDs from an atomic per-day counter.
+
+    Each day has one document in the counters collection, bumped with $inc/upsert,
+    so allocation is a single indexed round trip no matter how many tickets exist.
+    With block_size > 1 a process reserves a run of numbers per round trip and
+    serves them locally; numbers left in a block at shutdown are simply skipped.
+    """
+
+    def __init__(self, db, block_size: int = 1, collection: str = "counters"):
+        self.db = db
+        self.counters = db[collection]
+        self.block_size = max(1, int(block_size))
+        self._lock = asyncio.Lock()
+        self._day = None
+        self._next = 0
+        self._high = 0
+        self._seeded_days = set()
+
+    async def _seed_from_existing(self, day: str):
+        """Make sure the counter starts above tickets created before the allocator existed"""
+        if day in self._seeded_days:
+            return
+        prefix = f"{TICKET_ID_PREFIX}-{day}-"
+        # Sequence numbers are only zero-padded to 4 digits, so "...-10000" sorts below "...-9999" as a
+        # string; take the numeric max instead. The projection is covered by the ticket_id index.
+        existing_max = 0
+        async for doc in self.db.tickets.find({"ticket_id": {"$regex": f"^{prefix}"}}, {"ticket_id": 1, "_id": 0}):
+            parsed = parse_ticket_id(doc["ticket_id"])
+            if parsed:
+                existing_max = max(existing_max, parsed[1])
+        if existing_max:
+            # $max is atomic and idempotent, so racing replicas can all seed safely
+            await self.counters.update_one({"_id": counter_key(day)}, {"$max": {"seq": existing_max}}, upsert=True)
+        # Only today's seeding matters, so the set never grows past one entry
+        self._seeded_days = {day}
+
+    async def _reserve(self, day: str, count: int) -> int:
+        """Atomically reserve `count` numbers for `day` and return the highest one"""
+        await self._seed_from_existing(day)
+        for attempt in range(3):
+            try:
+                doc = await self.counters.find_one_and_update(
+                    {"_id": counter_key(day)},
+                    {"$inc": {"seq": count}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                return doc["seq"]
+            except DuplicateKeyError:
+                # Two upserts raced to create today's counter; the loser simply retries the $inc
+                if attempt == 2:
+                    raise
+
+    async def next_id(self) -> str:
+        """Return the next unused ticket ID for today"""
+        day = datetime.now().strftime('%Y%m%d')
+        if self.block_size == 1:
+            # No local block to protect, so concurrent callers go straight to the counter
+            return format_ticket_id(day, await self._reserve(day, 1))
+        async with self._lock:
+            if day != self._day or self._next > self._high:
+                self._high = await self._reserve(day, self.block_size)
+                self._next = self._high - self.block_size + 1
+                self._day = day
+            seq = self._next
+            self._next += 1
+        return format_ticket_id(day, seq)
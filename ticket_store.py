@@ -0,0 +1,110 @@
+import logging
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1)
+MESSAGES_PER_BUCKET = 50
+# Fields a ticket list row needs; everything else (messages, flow_details, ...) stays on the server
+LIST_PROJECTION = {"ticket_id": 1, "status": 1, "category": 1, "ticket_type_custom": 1, "created_at": 1}
+# Named projections, one per use case. Tickets created before history moved to ticket_messages
+# still carry an embedded `messages` array; views that show history take only its head.
+PROJECTIONS = {
+    "list": LIST_PROJECTION,
+    "status": {"status": 1, "assigned_to": 1, "assigned_to_name": 1},
+    "card": {"ticket_id": 1, "user_id": 1, "user_info": 1, "category": 1, "description": 1, "created_at": 1, "updated_at": 1,
+             "ticket_type_custom": 1, "flow_details": 1, "assigned_to_name": 1, "closed_by_name": 1, "forwarded_to": 1},
+    "details": {"ticket_id": 1, "status": 1, "category": 1, "ticket_type_custom": 1, "priority": 1, "created_at": 1, "updated_at": 1,
+                "description": 1, "flow_details": 1, "assigned_to_name": 1, "resolution": 1, "messages": {"$slice": 5}},
+}
+
+
+def encode_cursor(ticket: dict) -> str:
+    """Position of a ticket in the (created_at, _id) order, compact enough for callback_data"""
+    millis = (ticket["created_at"] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}_{ticket['_id']}"
+
+
+def decode_cursor(cursor: str):
+    """Inverse of encode_cursor(); returns (created_at, _id) or None if the cursor is malformed"""
+    try:
+        millis, oid = cursor.split("_", 1)
+        return _EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+    except Exception:
+        return None
+
+
+class TicketStore:
+    """Ticket reads and writes shared by both bots.
+
+    Every read names the projection it needs (see PROJECTIONS), so no query pulls
+    a ticket's history just to show its status. The history lives in the
+    `messages` collection (ticket_messages) in buckets of MESSAGES_PER_BUCKET
+    entries, so ticket documents stay small no matter how long a ticket lives.
+    """
+
+    def __init__(self, collection, messages=None, page_size: int = 10):
+        self.collection = collection
+        self.messages = messages
+        self.page_size = page_size
+
+    async def ensure_indexes(self):
+        # Serves the "my tickets" listing (equality on user_id, sort on created_at/_id) without an in-memory sort
+        await self.collection.create_index([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+        if self.messages is not None:
+            await self.messages.create_index([("ticket_id", ASCENDING), ("count", ASCENDING)])
+
+    async def get(self, ticket_id: str, view: str, **conditions):
+        """The ticket with `ticket_id` (and matching `conditions`), limited to the named projection"""
+        return await self.collection.find_one({"ticket_id": ticket_id, **conditions}, PROJECTIONS[view])
+
+    async def take(self, ticket_id: str, agent_id: int, agent_name: str, now: datetime):
+        """Assign an unassigned, open ticket in one atomic step; returns its card view, or None if refused"""
+        return await self.collection.find_one_and_update(
+            {"ticket_id": ticket_id, "status": {"$ne": "closed"}, "assigned_to": None},
+            {"$set": {"assigned_to": agent_id, "assigned_to_name": agent_name, "status": "pending", "updated_at": now}},
+            projection=PROJECTIONS["card"], return_document=ReturnDocument.AFTER)
+
+    async def close(self, ticket_id: str, agent_id: int, agent_name: str, now: datetime):
+        """Close a ticket that is not closed yet; returns its card view, or None if refused"""
+        return await self.collection.find_one_and_update(
+            {"ticket_id": ticket_id, "status": {"$ne": "closed"}},
+            {"$set": {"status": "closed", "closed_by_name": agent_name, "closed_by_id": agent_id, "updated_at": now}},
+            projection=PROJECTIONS["card"], return_document=ReturnDocument.AFTER)
+
+    async def add_message(self, ticket_id: str, message: dict):
+        """Append to the ticket's history: the last bucket while it has room, else a new bucket"""
+        await self.messages.update_one(
+            {"ticket_id": ticket_id, "count": {"$lt": MESSAGES_PER_BUCKET}},
+            {"$push": {"messages": message}, "$inc": {"count": 1}, "$setOnInsert": {"started_at": message.get("timestamp")}},
+            upsert=True)
+
+    async def first_messages(self, ticket_id: str, limit: int = 5) -> list:
+        bucket = await self.messages.find_one({"ticket_id": ticket_id}, {"messages": {"$slice": limit}}, sort=[("_id", ASCENDING)])
+        return bucket["messages"] if bucket else []
+
+    async def user_tickets_page(self, user_id: int, cursor: str | None = None, older: bool = True):
+        """One page of a user's tickets, newest first, by keyset pagination.
+
+        Without a cursor this is the newest page. With one, the page holds the tickets
+        just older (or newer, if `older` is False) than the cursor's ticket.
+        Returns (tickets, has_newer, has_older).
+        """
+        query = {"user_id": user_id}
+        position = decode_cursor(cursor) if cursor else None
+        if position:
+            created_at, oid = position
+            op = "$lt" if older else "$gt"
+            query["$or"] = [{"created_at": {op: created_at}}, {"created_at": created_at, "_id": {op: oid}}]
+        direction = DESCENDING if older or not position else ASCENDING
+        tickets = await self.collection.find(query, LIST_PROJECTION).sort(
+            [("created_at", direction), ("_id", direction)]).limit(self.page_size + 1).to_list(length=None)
+        more = len(tickets) > self.page_size
+        tickets = tickets[:self.page_size]
+        if direction == ASCENDING:
+            tickets.reverse()
+            return tickets, more, True
+        return tickets, position is not None, more
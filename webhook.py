@@ -0,0 +1,140 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+_MESSAGE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+
+def routing_key(data: dict) -> int:
+    """Pick the id that orders an update: the chat for groups, otherwise the user.
+
+    Works on the raw JSON so the front end never has to build an Update object.
+    """
+    for key in _MESSAGE_KEYS:
+        message = data.get(key)
+        if message:
+            chat = message.get("chat") or {}
+            if chat.get("type") in ("group", "supergroup", "channel"):
+                return chat.get("id", 0)
+            return (message.get("from") or {}).get("id", chat.get("id", 0))
+    callback = data.get("callback_query")
+    if callback:
+        chat = (callback.get("message") or {}).get("chat") or {}
+        if chat.get("type") in ("group", "supergroup"):
+            return chat.get("id", 0)
+        return (callback.get("from") or {}).get("id", 0)
+    for payload in data.values():
+        if isinstance(payload, dict):
+            if isinstance(payload.get("chat"), dict):
+                return payload["chat"].get("id", 0)
+            if isinstance(payload.get("from"), dict):
+                return payload["from"].get("id", 0)
+    return 0
+
+
+async def read_update(request: web.Request, secret_token: str) -> dict:
+    """Check a webhook post's secret token and return its JSON body; raises 403/400 otherwise"""
+    token = request.headers.get(SECRET_HEADER, "")
+    if not secret_token or not hmac.compare_digest(token.encode("utf-8", "surrogateescape"), secret_token.encode()):
+        raise web.HTTPForbidden()
+    try:
+        data = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest()
+    return data
+
+
+class WebhookIngestor:
+    """Accepts Telegram webhook posts on an aiohttp app and feeds them to PTB.
+
+    Each update goes to one of `workers` bounded queues chosen by routing_key(), so
+    updates from the same user (or group) are handled in order while different
+    users proceed in parallel. When a queue is full the post is answered with 503
+    and Telegram redelivers it later.
+
+    Behind a ShardSupervisor every key this process sees is congruent modulo
+    `shards`, so the key is divided by `shards` before picking a queue;
+    otherwise workers sharing a factor with the shard count would sit idle.
+    """
+
+    def __init__(self, application, secret_token: str, workers: int = 4, queue_size: int = 1000, shards: int = 1):
+        self.application = application
+        self.secret_token = secret_token
+        self.workers = max(1, workers)
+        self.shards = max(1, shards)
+        per_worker = max(1, queue_size // self.workers)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._tasks = []
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {"received": self.received, "rejected": self.rejected, "processed": self.processed,
+                "failed": self.failed, "queue_depth": self.queue_depth(), "workers": self.workers}
+
+    def _queue_for(self, data: dict) -> asyncio.Queue:
+        return self._queues[(routing_key(data) // self.shards) % self.workers]
+
+    def submit(self, data: dict) -> bool:
+        """Queue an update for its worker; False if that worker's queue is full"""
+        try:
+            self._queue_for(data).put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    async def put(self, data: dict):
+        """Queue an update for its worker, waiting for room"""
+        await self._queue_for(data).put(data)
+        self.received += 1
+
+    async def handle(self, request: web.Request) -> web.Response:
+        data = await read_update(request, self.secret_token)
+        return web.Response() if self.submit(data) else web.Response(status=503)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            data = await queue.get()
+            try:
+                update = Update.de_json(data, self.application.bot)
+                await self.application.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing webhook update {data.get('update_id')}: {e}")
+            finally:
+                queue.task_done()
+
+    def install(self, web_app: web.Application, path: str):
+        web_app.router.add_post(path, self.handle)
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+        logger.info(f"Webhook ingestor started with {self.workers} workers")
+
+    async def stop(self, drain_timeout: float = 10):
+        """Give queued updates a chance to finish, then stop the workers"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping webhook workers with {self.queue_depth()} updates still queued")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []